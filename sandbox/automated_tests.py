@@ -2,11 +2,38 @@
 It is a deep irony that test-driven development is the only way I'll be able to
 keep my wits about developing this package...
 """
-import unittest
+import unittest, os, sys, subprocess, tempfile
 
-from mistake import frontend, planning, semantics
+from mistake import frontend, planning, utility, semantics, runtime, domain, sources, caching, parallel, statistics, metrics, sharing
 import toys
 
+try: import numpy
+except ImportError: numpy = None
+
+
+def count_scans(table) -> list:
+	""" Make the table note the predicate of each scan in the list this returns. """
+	scans = []
+	def counting_scan(predicate, environment, original=table.scan):
+		scans.append(predicate)
+		return original(predicate, environment)
+	table.scan = counting_scan
+	return scans
+
+def register_spy(module) -> list:
+	"""
+	Register `spy`, another tensor over the table behind `quantity_sold`, which notes
+	the number of criteria it gets to stream with in the list this returns.
+	"""
+	seen = []
+	class Spy(sources.TableTensor):
+		def stream(self, predicate, environment):
+			seen.append(len(predicate))
+			return super().stream(predicate, environment)
+	original = module.get_tensor('quantity_sold')
+	module.register_tensor('spy', Spy(original.table, 'quantity', original.tensor_type().unit))
+	return seen
+
 
 class SmokeTest(unittest.TestCase):
 	""" When you turn it on, does smoke come out? """
@@ -111,6 +138,945 @@ class SmokeTest(unittest.TestCase):
 		""")
 
 
+class TestSources(unittest.TestCase):
+	""" The indexed table source should give the same answers as the toy, only by doing less work. """
+	
+	SCRIPT = """
+		gross is quantity_sold * unit_price
+		one_order is gross where orderid = $order
+		some_products is (gross where productid >= 70) by [productid]
+		revenue_by_country is gross sum { orderid -> shipcountry } by [shipcountry]
+	"""
+	
+	@classmethod
+	def setUpClass(cls):
+		cls.kiss = toys.sample_module().script(cls.SCRIPT)
+		cls.indexed = toys.sample_module(indexed=True).script(cls.SCRIPT)
+	
+	def test_same_answers(self):
+		for name in ['one_order', 'some_products', 'revenue_by_country']:
+			with self.subTest(name):
+				expect = dict((tuple(sorted(p.items())), v) for p,v in self.kiss.query(name, order=10256).content())
+				actual = dict((tuple(sorted(p.items())), v) for p,v in self.indexed.query(name, order=10256).content())
+				self.assertEqual(expect.keys(), actual.keys())
+				for k in expect: self.assertAlmostEqual(expect[k], actual[k])
+	
+	def test_index_selects_only_matching_rows(self):
+		table = self.indexed.get_tensor('quantity_sold').table
+		by_order = runtime.ScalarComparison('orderid', 'EQ', runtime.Variable('order'))
+		few_products = runtime.ScalarComparison('productid', 'LT', runtime.Constant(3))
+		selected, residual = table.select(domain.Predicate([by_order]), {'order': 10256})
+		self.assertEqual(2, len(selected))
+		self.assertEqual(0, len(residual))
+		selected, residual = table.select(domain.Predicate([few_products, by_order.complement()]), {'order': 10256})
+		self.assertTrue(all(table.column('productid')[i] < 3 for i in selected))
+		self.assertEqual(1, len(residual)) # Not-equal is not served by a hash index.
+	
+	def test_capabilities_split_predicates(self):
+		capabilities = self.indexed.get_tensor('quantity_sold').capabilities()
+		self.assertEqual(len(self.indexed.get_tensor('quantity_sold').table), capabilities.cardinality)
+		by_order = runtime.ScalarComparison('orderid', 'EQ', runtime.Variable('order'))
+		not_order = by_order.complement()
+		few_products = runtime.ScalarComparison('productid', 'LT', runtime.Constant(3))
+		pushed, residual = capabilities.split(domain.Predicate([by_order, not_order, few_products]))
+		self.assertEqual([by_order, few_products], list(pushed))
+		self.assertEqual([not_order], list(residual))
+	
+	def test_planner_pushes_down_only_what_sources_serve(self):
+		module = toys.sample_module(indexed=True)
+		seen = register_spy(module)
+		module.script("x is (spy where orderid = $order) where productid <> 11")
+		result = module.query('x', order=10248)
+		self.assertEqual([1], seen)
+		self.assertEqual({42, 72}, {p['productid'] for p, v in result.content()})
+	
+	def test_fields_of_one_table_share_one_scan(self):
+		module = toys.sample_module(indexed=True).script("""
+			gross is quantity_sold * unit_price
+			net_value is gross - gross * discount_rate
+		""")
+		self.assertIsInstance(module.get_tensor('net_value'), runtime.FusedScan)
+		table = module.get_tensor('quantity_sold').table
+		scans = count_scans(table)
+		result = module.query('net_value')
+		self.assertEqual(1, len(scans))
+		q, u, d = [[float(x) for x in table.column(c)] for c in ('quantity', 'unitprice', 'discount')]
+		for i, (o, p) in enumerate(zip(table.column('orderid'), table.column('productid'))):
+			self.assertAlmostEqual(q[i]*u[i]*(1-d[i]), result.get({'orderid':o, 'productid':p}))
+	
+	def test_fused_expression_compiles_to_one_kernel(self):
+		module = toys.sample_module(indexed=True).script("""
+			gross is quantity_sold * unit_price
+			net_value is gross - gross * discount_rate
+		""")
+		kernel = module.get_tensor('net_value').kernel()
+		self.assertEqual(1, kernel.source.count('def '))
+		self.assertEqual(3, kernel.source.count('(row)')) # Each field gets extracted once.
+	
+	def test_fused_quotient_matches_streaming_quotient(self):
+		module = self.indexed
+		q, u = module.get_tensor('quantity_sold'), module.get_tensor('unit_price')
+		tt = q.tensor_type()
+		fused = runtime.fuse(runtime.fused_quotient, q, u, tt)
+		self.assertIsNotNone(fused)
+		predicate = domain.Predicate([runtime.ScalarComparison('productid', 'LT', runtime.Constant(5))])
+		expect = sorted((p['orderid'], p['productid'], v) for p, v in runtime.Quotient(q, u, tt).stream(predicate, {}))
+		actual = sorted((p['orderid'], p['productid'], v) for p, v in fused.stream(predicate, {}))
+		self.assertEqual(expect, actual)
+	
+	def test_repeated_keys_do_not_fuse(self):
+		unit = semantics.UnitOfMeasure({'widget':1})
+		table = sources.Table([{'a':1, 'b':1, 'x':2, 'y':3}, {'a':1, 'b':1, 'x':5, 'y':7}], {'a':int, 'b':int})
+		self.assertFalse(table.unique)
+		x, y = sources.TableTensor(table, 'x', unit), sources.TableTensor(table, 'y', unit)
+		tt = x.tensor_type()
+		self.assertIsNone(runtime.fuse(runtime.fused_product, x, y, tt))
+		self.assertIsNone(runtime.fuse(runtime.fused_quotient, x, y, tt))
+		self.assertEqual(70.0, runtime.TensorBuffer(runtime.Product(x, y, tt), domain.Predicate([]), {}).get({'a':1, 'b':1}))
+		self.assertTrue(self.indexed.get_tensor('quantity_sold').table.unique)
+	
+	@unittest.skipIf(numpy is None, "NumPy is not installed.")
+	def test_batches_agree_with_stream(self):
+		tensor = self.indexed.get_tensor('unit_price')
+		predicate = domain.Predicate([runtime.ScalarComparison('productid', 'GE', runtime.Constant(70))])
+		expect = sorted((p['orderid'], p['productid'], v) for p,v in tensor.stream(predicate, {}))
+		actual = sorted(
+			(o, p, v)
+			for batch, values in tensor.batches(predicate, {}, size=100)
+			for o, p, v in zip(batch['orderid'].tolist(), batch['productid'].tolist(), values.tolist())
+		)
+		self.assertEqual(expect, actual)
+
+
+class TestSetCriteria(unittest.TestCase):
+	""" Membership and interval criteria, served by indexes where possible. """
+	
+	SCRIPT = """
+		gross is quantity_sold * unit_price
+		few is gross where productid in [10, 20)
+		not_few is gross where productid not in [10, 20)
+		half_open is gross where productid in (10, $top]
+		picked is gross where orderid in {10248, $order}
+		unlisted is gross where orderid not in @orders
+	"""
+	NAMES = ['few', 'not_few', 'half_open', 'picked', 'unlisted']
+	ENV = dict(top=20, order=10250, orders=[10248, 10249, 10250])
+	
+	@classmethod
+	def setUpClass(cls):
+		cls.kiss = toys.sample_module().script(cls.SCRIPT)
+		cls.indexed = toys.sample_module(indexed=True).script(cls.SCRIPT)
+	
+	def test_same_answers(self):
+		for name in self.NAMES:
+			with self.subTest(name):
+				expect = dict((tuple(sorted(p.items())), v) for p,v in self.kiss.query(name, **self.ENV).content())
+				actual = dict((tuple(sorted(p.items())), v) for p,v in self.indexed.query(name, **self.ENV).content())
+				self.assertTrue(expect)
+				self.assertEqual(expect.keys(), actual.keys())
+				for k in expect: self.assertAlmostEqual(expect[k], actual[k])
+		few = {p['productid'] for p, v in self.indexed.query('few').content()}
+		self.assertEqual(10, min(few))
+		self.assertEqual(19, max(few))
+		self.assertNotIn(10, {p['productid'] for p, v in self.indexed.query('half_open', **self.ENV).content()})
+		self.assertEqual({10248, 10250}, {p['orderid'] for p, v in self.indexed.query('picked', **self.ENV).content()})
+		total = len(self.indexed.query('gross'))
+		self.assertEqual(total, len(self.indexed.query('few')) + len(self.indexed.query('not_few')))
+		listed = sum(o in self.ENV['orders'] for o in self.indexed.get_tensor('quantity_sold').table.column('orderid'))
+		self.assertEqual(total - listed, len(self.indexed.query('unlisted', **self.ENV)))
+	
+	def test_indexes_serve_positive_forms(self):
+		table = self.indexed.get_tensor('quantity_sold').table
+		interval = runtime.Interval('productid', runtime.Constant(10), runtime.Constant(20), True, False)
+		members = runtime.Membership('orderid', runtime.Variable('orders'))
+		selected, residual = table.select(domain.Predicate([interval, members]), self.ENV)
+		self.assertEqual(0, len(residual))
+		expect = [i for i, (o, p) in enumerate(zip(table.column('orderid'), table.column('productid'))) if 10 <= p < 20 and o in self.ENV['orders']]
+		self.assertEqual(expect, selected)
+		pushed, residual = table.capabilities().split(domain.Predicate([interval, interval.complement(), members.complement()]))
+		self.assertEqual([interval], list(pushed))
+		self.assertEqual('productid in [10, 20)', str(interval))
+	
+	def test_scan_touches_only_the_slice(self):
+		table = self.indexed.get_tensor('quantity_sold').table
+		registry = metrics.enable()
+		try: self.indexed.query('few')
+		finally: metrics.disable()
+		in_range = sum(10 <= p < 20 for p in table.column('productid'))
+		self.assertEqual(in_range, registry.snapshot()['mistake_scan_rows_total{table="order-details"}'])
+
+
+class TestNormalization(unittest.TestCase):
+	""" Predicates shed redundant criteria, and contradictory ones never reach the source. """
+	
+	def test_merges_ranges_and_drops_repeats(self):
+		def c(relop, x): return runtime.ScalarComparison('productid', relop, runtime.Constant(x))
+		lt10, ge3 = c('LT', 10), c('GE', 3)
+		other = runtime.ScalarComparison('orderid', 'EQ', runtime.Variable('order'))
+		predicate = domain.Predicate([c('LT', 20), lt10, ge3, other, c('GE', 3), c('NE', 50)])
+		self.assertEqual([lt10, ge3, other], list(predicate.normalized({'order':1})))
+		one = c('EQ', 5)
+		self.assertEqual([one], list(domain.Predicate([lt10, one, ge3]).normalized({})))
+		some = runtime.Membership('productid', runtime.Variable('ids'))
+		self.assertEqual([lt10, some], list(domain.Predicate([lt10, some]).normalized({'ids':[1, 2, 30]})))
+		self.assertEqual([some], list(domain.Predicate([lt10, some]).normalized({'ids':[1, 2]})))
+	
+	def test_detects_contradictions(self):
+		lt10 = runtime.ScalarComparison('productid', 'LT', runtime.Constant(10))
+		window = runtime.Interval('productid', runtime.Constant(10), runtime.Variable('top'), True, False)
+		self.assertIsNone(domain.Predicate([lt10, lt10.complement()]).normalized({}))
+		self.assertIsNone(domain.Predicate([lt10, window]).normalized({'top':20}))
+		self.assertIsNone(domain.Predicate([window]).normalized({'top':10}))
+		five = runtime.ScalarComparison('productid', 'EQ', runtime.Variable('five'))
+		self.assertIsNone(domain.Predicate([five, five.complement()]).normalized({'five':5}))
+		self.assertIsNotNone(domain.Predicate([window.complement(), window]).normalized({'top':20})) # The normaliser can't see this one.
+	
+	def test_deep_chain_scans_once(self):
+		module = toys.sample_module(indexed=True).script("""
+			gross is quantity_sold * unit_price
+			a is gross where productid < 10 else gross
+			b is a where productid < 20 else a
+			c is b where productid < 30 else b
+			deep is c where productid >= 30
+			plain is gross where productid >= 30
+		""")
+		table = module.get_tensor('quantity_sold').table
+		scans = count_scans(table)
+		expect = dict((tuple(sorted(p.items())), v) for p, v in module.query('plain').content())
+		scans.clear()
+		actual = dict((tuple(sorted(p.items())), v) for p, v in module.query('deep').content())
+		self.assertEqual([1], [len(predicate) for predicate in scans])
+		self.assertEqual(expect, actual)
+
+
+class TestCaching(unittest.TestCase):
+	
+	def setUp(self):
+		self.now = 0.0
+		self.cache = caching.QueryCache(budget=10**6, ttl=60, clock=lambda: self.now)
+		self.universe = toys.sample_module(indexed=True).script("""
+			gross is quantity_sold * unit_price
+			one_order is gross where orderid = $order
+		""")
+		self.universe.cache = self.cache
+	
+	def test_hit_depends_only_on_variables_the_plan_reads(self):
+		first = self.universe.query('one_order', order=10248, unrelated=1)
+		self.assertIs(first, self.universe.query('one_order', order=10248, unrelated=2))
+		self.assertIsNot(first, self.universe.query('one_order', order=10249))
+		self.assertEqual((1, 2), (self.cache.hits, self.cache.misses))
+		self.assertEqual(frozenset(['order']), self.universe.get_tensor('one_order').parameters())
+	
+	def test_expiry(self):
+		first = self.universe.query('one_order', order=10248)
+		self.now += 61
+		self.assertIsNot(first, self.universe.query('one_order', order=10248))
+	
+	def test_source_change_invalidates(self):
+		first = self.universe.query('one_order', order=10248)
+		unrelated = self.universe.query('quantity_sold')
+		self.universe.get_tensor('unit_price').changed()
+		self.assertIsNot(first, self.universe.query('one_order', order=10248))
+		self.assertIs(unrelated, self.universe.query('quantity_sold'))
+	
+	def test_memory_budget_evicts_least_recently_used(self):
+		self.cache = self.universe.cache = caching.QueryCache(budget=3, weigh=lambda result: 1)
+		orders = [10248, 10249, 10250, 10251]
+		results = {o: self.universe.query('one_order', order=o) for o in orders[1:]}
+		self.universe.query('one_order', order=orders[1]) # Make it recently used
+		self.universe.query('one_order', order=orders[0]) # Needs room.
+		self.assertLessEqual(self.cache.size, self.cache.budget)
+		self.assertIs(results[orders[1]], self.universe.query('one_order', order=orders[1]))
+		self.assertIsNot(results[orders[2]], self.universe.query('one_order', order=orders[2]))
+
+
+class TestAggregation(unittest.TestCase):
+	
+	def setUp(self):
+		self.universe = toys.sample_module(indexed=True).script("""
+			discount is quantity_sold * unit_price * discount_rate
+			by_product is discount by [ProductID]
+		""")
+	
+	def test_projects_and_combines_early(self):
+		points = list(self.universe.get_tensor('by_product').stream(domain.Predicate([]), {}))
+		self.assertTrue(all(p.keys() == {'productid'} for p, v in points))
+		self.assertEqual(len(points), len({p['productid'] for p, v in points}))
+	
+	def test_bounded_combiner_keeps_totals(self):
+		stream = [({'a':i%3, 'b':i}, 1.0) for i in range(10)]
+		combined = list(runtime.combine(iter(stream), frozenset(['a']), limit=2))
+		self.assertGreater(len(combined), 3)
+		totals = {}
+		for p, v in combined: totals[p['a']] = totals.get(p['a'], 0) + v
+		self.assertEqual({0:4.0, 1:3.0, 2:3.0}, totals)
+
+	def test_schema_keys_round_trip(self):
+		pair, single, empty = domain.Schema.of(frozenset(['b', 'a'])), domain.Schema.of(['a']), domain.Schema.of(())
+		self.assertIs(pair, domain.Schema.of(['a', 'b']))
+		point = {'a':1, 'b':2, 'c':3}
+		self.assertEqual((1, 2), pair.key(point))
+		self.assertEqual(1, single.key(point))
+		self.assertEqual((), empty.key(point))
+		self.assertEqual({'a':1, 'b':2}, pair.point(pair.key(point)))
+		self.assertEqual({'a':1}, single.point(single.key(point)))
+		self.assertEqual({}, empty.point(()))
+		self.assertEqual(2, pair.getter('b')((1, 2)))
+		self.assertEqual(1, single.getter('a')(1))
+
+	def test_same_answer_as_summing_the_basis(self):
+		expect = {}
+		for p, v in self.universe.query('discount').content():
+			expect[p['productid']] = expect.get(p['productid'], 0) + v
+		actual = {p['productid']:v for p, v in self.universe.query('by_product').content()}
+		self.assertEqual(expect.keys(), actual.keys())
+		for k in expect: self.assertAlmostEqual(expect[k], actual[k])
+
+
+class TestJoins(unittest.TestCase):
+	""" Every join strategy should agree; the planner should pick a sensible one. """
+	
+	def setUp(self):
+		unit = semantics.UnitOfMeasure({'widget':1})
+		space = {'a':int, 'b':int}
+		def table(rows, **kwargs): return sources.Table([{'a':a, 'b':b, 'v':v} for a, b, v in rows], space, **kwargs)
+		left = [(1, 1, 2.0), (1, 2, 3.0), (2, 1, 5.0), (2, 1, 1.0), (3, 3, 7.0)]
+		right = [(1, 1, 10.0), (2, 1, 4.0), (2, 2, 8.0), (3, 3, 0.0), (4, 4, 1.0)]
+		self.lhs = sources.TableTensor(table(left, sort_order=['a', 'b']), 'v', unit)
+		self.rhs = sources.TableTensor(table(right, hashed=['a'], sort_order=['a', 'b']), 'v', unit)
+		self.tt = semantics.TensorType(frozenset(space), unit)
+	
+	def totals(self, tensor):
+		result = {}
+		for p, v in tensor.stream(domain.Predicate([]), {}):
+			key = (p['a'], p['b'])
+			result[key] = result.get(key, 0) + v
+		return result
+	
+	def test_strategies_agree(self):
+		for kind, expect in [
+			(runtime.Product, {(1,1):20.0, (1,2):0.0, (2,1):24.0, (3,3):0.0}),
+			(runtime.Quotient, {(1,1):0.2, (2,1):1.5}),
+		]:
+			for join in runtime.JOINS:
+				with self.subTest(kind=kind.__name__, join=join):
+					actual = self.totals(kind(self.lhs, self.rhs, self.tt, join))
+					self.assertEqual(expect.keys(), actual.keys())
+					for k in expect: self.assertAlmostEqual(expect[k], actual[k])
+	
+	def test_sort_order_must_hold(self):
+		with self.assertRaises(ValueError):
+			sources.Table([{'a':2}, {'a':1}], {'a':int}, sort_order=['a'])
+	
+	def test_choose_join(self):
+		self.assertEqual('merge', planning.choose_join(self.lhs, self.rhs))
+		def big(**kwargs):
+			rows = [{'a':a, 'b':b, 'v':1} for a in range(10) for b in range(10)]
+			return sources.TableTensor(sources.Table(rows, {'a':int, 'b':int}, **kwargs), 'v', self.tt.unit)
+		self.assertEqual('index', planning.choose_join(self.lhs, big(hashed=['b'])))
+		self.assertEqual('semijoin', planning.choose_join(self.lhs, big()))
+		self.assertEqual('build_right', planning.choose_join(big(), self.lhs))
+	
+	def test_semijoin_prunes_the_other_side(self):
+		module = toys.sample_module(indexed=True).script("x is (quantity_sold where orderid = $order) * unit_price")
+		plan = runtime.Product(*module.get_tensor('x').operands(), module.get_tensor('x').tensor_type(), 'semijoin')
+		result = runtime.TensorBuffer(plan, domain.Predicate([]), {'order':10248})
+		self.assertEqual({(10248, 11), (10248, 42), (10248, 72)}, {(p['orderid'], p['productid']) for p, v in result.content()})
+		self.assertEqual(3, plan.passed) # The index on orderid fetched only that order's rows...
+		self.assertEqual(0, plan.eliminated) # ... so the key set had nothing left to reject.
+		kiss = toys.sample_module().script("x is (quantity_sold where orderid = $order) * unit_price")
+		kiss.query('x', order=10248)
+		self.assertEqual(3, kiss.get_tensor('x').passed)
+		self.assertGreater(kiss.get_tensor('x').eliminated, 2000)
+
+
+class TestSpilling(unittest.TestCase):
+	""" A buffer over budget spills to disk and carries on with the same answers. """
+	
+	def setUp(self):
+		unit = semantics.UnitOfMeasure({'widget':1})
+		rows = [{'a':i % 997, 'b':str(i % 7), 'v':float(i)} for i in range(5000)]
+		self.tensor = sources.TableTensor(sources.Table(rows, {'a':int, 'b':str}), 'v', unit)
+	
+	def buffers(self, budget):
+		everything = domain.Predicate([])
+		return runtime.TensorBuffer(self.tensor, everything, {}), runtime.TensorBuffer(self.tensor, everything, {}, budget=budget)
+	
+	def test_same_content_and_lookups(self):
+		for budget in [50, 10000]: # Partitions of about 400 must partition again; or no spill at all.
+			with self.subTest(budget=budget):
+				plain, bounded = self.buffers(budget)
+				self.assertEqual(budget < len(plain), bounded.spilled)
+				self.assertEqual(len(plain), len(bounded))
+				self.assertEqual(sorted(plain.content(), key=repr), sorted(bounded.content(), key=repr))
+				for point in [{'a':5, 'b':'5'}, {'a':996, 'b':'2'}, {'a':5, 'b':'6'}]:
+					self.assertEqual(plain.get(point), bounded.get(point))
+				probes = [({'a':a, 'b':str(a % 7)}, 1.0) for a in range(0, 1200, 3)]
+				self.assertEqual(sorted((p['a'], plain.get(p)) for p, v in probes), sorted((p['a'], d) for p, v, d in bounded.probe(iter(probes))))
+	
+	def test_leaves_fit_the_budget(self):
+		from mistake import spilling
+		for budget in [100, 1000]:
+			with self.subTest(budget=budget):
+				spill = spilling.Spill({}, ((i, 1.0) for i in range(20000)), budget)
+				sizes = [sum(1 for _ in spilling._read(path)) for path in spill.leaves()]
+				self.assertEqual(20000, sum(sizes))
+				self.assertLessEqual(max(sizes), budget)
+				spill.close()
+	
+	def test_files_go_away(self):
+		from mistake import spilling
+		spill = spilling.Spill({}, (((i, 'x'), 1.0) for i in range(100)), 10)
+		self.assertEqual(100, spill.size)
+		self.assertTrue(os.path.isdir(spill.directory))
+		spill.close()
+		self.assertFalse(os.path.exists(spill.directory))
+	
+	def test_joins_spill_the_build_side(self):
+		module = toys.sample_module(indexed=True).script("""
+			gross is quantity_sold * unit_price
+			by_order is gross by [orderid]
+			units is quantity_sold by [orderid]
+			average is by_order / units
+		""")
+		expect = dict((p['orderid'], v) for p, v in module.query('average').content())
+		saved, runtime.BUFFER_BUDGET = runtime.BUFFER_BUDGET, 10
+		registry = metrics.enable()
+		try: actual = dict((p['orderid'], v) for p, v in module.query('average').content())
+		finally: runtime.BUFFER_BUDGET = saved; metrics.disable()
+		self.assertEqual(2, registry.snapshot()['mistake_buffer_spills_total']) # The build side, and the result.
+		self.assertEqual(expect.keys(), actual.keys())
+		for k in expect: self.assertAlmostEqual(expect[k], actual[k])
+	
+	def test_every_join_respects_the_budget(self):
+		module = toys.sample_module(indexed=True).script("""
+			gross is quantity_sold * unit_price
+			by_order is gross by [orderid]
+			units is quantity_sold by [orderid]
+		""")
+		lhs, rhs = module.get_tensor('by_order'), module.get_tensor('units')
+		expect = {p['orderid']:v for p, v in runtime.Quotient(lhs, rhs, lhs.tensor_type(), 'build_right').stream(domain.Predicate([]), {})}
+		for join in ['build_left', 'semijoin']:
+			with self.subTest(join):
+				plan = runtime.Quotient(lhs, rhs, lhs.tensor_type(), join)
+				saved, runtime.BUFFER_BUDGET = runtime.BUFFER_BUDGET, 10
+				registry = metrics.enable()
+				try: actual = list(plan.stream(domain.Predicate([]), {}))
+				finally: runtime.BUFFER_BUDGET = saved; metrics.disable()
+				self.assertEqual(2, registry.snapshot()['mistake_buffer_spills_total']) # One for each side.
+				self.assertEqual(len(expect), len(actual))
+				for p, v in actual: self.assertAlmostEqual(expect[p['orderid']], v)
+
+
+class TestStatistics(unittest.TestCase):
+	""" Estimates should be in the neighborhood of the truth, and the planner should act on them. """
+	
+	def setUp(self):
+		self.universe = toys.sample_module(indexed=True)
+		self.table = self.universe.get_tensor('quantity_sold').table
+	
+	def test_table_describes_itself(self):
+		stats = self.table.statistics()
+		self.assertEqual(len(self.table), stats.rows)
+		self.assertEqual(len(set(self.table.column('orderid'))), stats.axes['orderid'].distinct)
+		products = stats.axes['productid']
+		self.assertEqual((1, 77), (products.low, products.high))
+		truth = sum(p < 40 for p in self.table.column('productid')) / stats.rows
+		self.assertAlmostEqual(truth, products.below(40, False), delta=1/statistics.BUCKETS)
+		self.assertEqual(3, len(products.quantiles(4)))
+	
+	def test_filters_shrink_estimates(self):
+		self.universe.script("""
+			one_order is quantity_sold where orderid = $order
+			some_products is quantity_sold where productid >= 70
+		""")
+		self.assertLess(self.universe.get_tensor('one_order').cardinality(), 5)
+		truth = sum(p >= 70 for p in self.table.column('productid'))
+		estimate = self.universe.get_tensor('some_products').statistics().filtered(domain.Predicate([]), {}).rows
+		self.assertAlmostEqual(truth, estimate, delta=len(self.table)/statistics.BUCKETS)
+	
+	def test_unselective_criteria_stay_out_of_the_index(self):
+		seen = register_spy(self.universe)
+		self.universe.script("x is spy where productid >= $least")
+		self.assertEqual(2117, len(self.universe.query('x', least=2)))
+		self.assertEqual(38, len(self.universe.query('x', least=77)))
+		self.assertEqual([0, 1], seen)
+	
+	def test_catalog_informs_planner_and_persists(self):
+		module = toys.sample_module()
+		catalog = module.collect_statistics()
+		self.assertEqual(2155, catalog.get('quantity_sold').rows)
+		self.assertEqual(len(toys.COUNTRY_CONTINENT), catalog.transform(['orderid'], ['shipcountry'])['shipcountry'].distinct)
+		with tempfile.TemporaryDirectory() as folder:
+			path = os.path.join(folder, 'northwind.stats')
+			catalog.save(path)
+			self.assertEqual(catalog.names(), statistics.Catalog.load(path).names())
+			self.assertEqual([], statistics.Catalog.load(os.path.join(folder, 'missing')).names())
+		module.script("x is (quantity_sold where orderid = $order) * unit_price")
+		plan = module.get_tensor('x')
+		self.assertLess(plan.cardinality(), 5)
+		self.assertEqual('semijoin', plan.join)
+
+
+class TestExplain(unittest.TestCase):
+	
+	def setUp(self):
+		self.universe = toys.sample_module().script("""
+			gross is quantity_sold * unit_price
+			one_order is (quantity_sold where orderid = $order) * unit_price
+			by_country is gross sum { orderid -> shipcountry } by [shipcountry]
+		""")
+	
+	def test_plan_shows_tree(self):
+		report = self.universe.explain('one_order')
+		self.assertEqual([0, 1, 2, 1], [n.depth for n in report.nodes])
+		text = str(report)
+		self.assertIn('Product [orderid, productid] (semijoin)', text)
+		self.assertIn('where orderid = $order', text)
+		self.assertNotIn('actual', text)
+	
+	def test_analyze_counts_rows(self):
+		report = self.universe.explain('one_order', analyze=True, order=10248)
+		self.assertEqual(3, report.result_size)
+		join, where, left, right = report.nodes
+		self.assertEqual((6, 3), (join.rows_in, join.rows_out))
+		self.assertGreater(join.filtered, 2000)
+		self.assertEqual(6, join.peak)
+		self.assertEqual(3, where.rows_out)
+		self.assertIn('actual', str(report))
+		for node in report.nodes: self.assertNotIn('stream', vars(node.tensor)) # Meters come back off.
+		report = self.universe.explain('by_country', analyze=True)
+		self.assertEqual(21, report.nodes[0].rows_out)
+		self.assertEqual(21, report.nodes[0].peak)
+		self.assertEqual(len(self.universe.query('gross')), report.nodes[0].rows_in)
+
+
+class TestMetrics(unittest.TestCase):
+	
+	def setUp(self):
+		self.registry = metrics.enable()
+	
+	def tearDown(self):
+		metrics.disable()
+	
+	def test_reports_from_all_over(self):
+		universe = toys.sample_module(indexed=True)
+		universe.cache = caching.QueryCache(1 << 20)
+		universe.script("one_order is (quantity_sold where orderid = $order) * unit_price")
+		for order in (10248, 10248, 10249): universe.query('one_order', order=order)
+		snapshot = self.registry.snapshot()
+		self.assertEqual(3, snapshot['mistake_queries_total{tensor="one_order"}'])
+		self.assertEqual(1, snapshot['mistake_cache_requests_total{result="hit"}'])
+		self.assertEqual(2, snapshot['mistake_cache_requests_total{result="miss"}'])
+		self.assertEqual(2, snapshot['mistake_execute_seconds_count{tensor="one_order"}'])
+		self.assertEqual(1, snapshot['mistake_plan_seconds_count'])
+		self.assertEqual(5, snapshot['mistake_buffer_points_sum{buffer="dict"}'])
+		self.assertEqual(5, snapshot['mistake_scan_rows_total{table="order-details"}'])
+	
+	def test_prometheus_export(self):
+		self.registry.count('things_total', 2, kind='a"b')
+		self.registry.observe('latency', 0.5)
+		text = self.registry.prometheus()
+		self.assertIn('# TYPE things_total counter\nthings_total{kind="a\\"b"} 2\n', text)
+		self.assertIn('# TYPE latency summary\nlatency_count 1\nlatency_sum 0.5\n', text)
+		with tempfile.TemporaryDirectory() as folder:
+			path = os.path.join(folder, 'mistake.prom')
+			self.registry.write(path)
+			with open(path) as ifh: self.assertEqual(text, ifh.read())
+	
+	def test_disabled_means_silent(self):
+		metrics.disable()
+		toys.sample_module(indexed=True).script("x is quantity_sold").query('x')
+		self.assertEqual({}, self.registry.snapshot())
+
+
+class TestTransforms(unittest.TestCase):
+	
+	def setUp(self):
+		self.universe = toys.sample_module(indexed=True)
+		self.basis = self.universe.get_tensor('quantity_sold')
+		self.calls = []
+		self.lookup = {int(row['orderid']):row['shipcountry'] for row in toys.northwind('orders')}
+		def ship_country(orderid):
+			self.calls.append(orderid)
+			return self.lookup[orderid]
+		self.attribute = domain.attribute('orderid', 'shipcountry', ship_country)
+		self.plan = runtime.Transformation(self.basis, frozenset(['productid', 'shipcountry']), self.attribute)
+	
+	def test_function_is_memoized_per_query(self):
+		points = list(self.plan.stream(domain.Predicate([]), {}))
+		distinct = {p['orderid'] for p, v in self.basis.stream(domain.Predicate([]), {})}
+		self.assertEqual(sorted(distinct), sorted(self.calls))
+		self.assertTrue(all(p.keys() == {'productid', 'shipcountry'} for p, v in points))
+		list(self.plan.stream(domain.Predicate([]), {}))
+		self.assertEqual(2 * len(distinct), len(self.calls))
+	
+	def test_translated_criterion_does_not_repeat_work(self):
+		predicate = domain.Predicate([runtime.ScalarComparison('shipcountry', 'EQ', runtime.Constant('Mexico'))])
+		points = list(self.plan.stream(predicate, {}))
+		self.assertTrue(points)
+		self.assertTrue(all(p['shipcountry'] == 'Mexico' for p, v in points))
+		self.assertEqual(len(self.calls), len(set(self.calls)))
+	
+	def test_table_form(self):
+		table_form = domain.attribute('orderid', 'shipcountry', self.lookup)
+		self.assertIs(table_form, table_form.for_query())
+		point = {'orderid': 10248}
+		table_form.update(point)
+		self.assertEqual('France', point['shipcountry'])
+	
+	@unittest.skipIf(numpy is None, "NumPy is not installed.")
+	def test_batch_forms_agree(self):
+		from mistake import columnar
+		batch = {'orderid': numpy.array([10248, 10249, 10248, 10250])}
+		expect = ['France', 'Germany', 'France', 'Brazil']
+		vectorized = domain.attribute('orderid', 'shipcountry', self.lookup, numpy.vectorize(self.lookup.__getitem__))
+		general = domain.Transform(self.attribute.domain, self.attribute.range, self.attribute.update)
+		for transform in [self.attribute, vectorized, general]:
+			self.assertEqual(expect, columnar.transformed(transform, batch)['shipcountry'].tolist())
+			if transform is self.attribute: self.assertEqual(3, len(self.calls)) # Once per distinct member.
+	
+	def test_criteria_on_range_become_criteria_on_domain(self):
+		universe = self.universe.script("""
+			gross is quantity_sold * unit_price
+			one_country is (gross sum { orderid -> shipcountry } by [shipcountry]) where shipcountry = $country
+			other_countries is (gross sum { orderid -> shipcountry } by [shipcountry]) where shipcountry <> $country
+		""")
+		table = self.basis.table
+		selections = []
+		def spy(predicate, environment, original=table.select):
+			selected, residual = original(predicate, environment)
+			selections.append((selected, len(residual)))
+			return selected, residual
+		table.select = spy
+		mexico = {oid for oid, country in self.lookup.items() if country == 'Mexico'}
+		result = universe.query('one_country', country='Mexico')
+		(selected, residual), = selections
+		self.assertEqual(0, residual)
+		self.assertEqual(sorted(i for i, oid in enumerate(table.column('orderid')) if oid in mexico), selected)
+		expect = sum(float(table.column('quantity')[i]) * float(table.column('unitprice')[i]) for i in selected)
+		self.assertAlmostEqual(expect, result.get({'shipcountry':'Mexico'}))
+		others = universe.query('other_countries', country='Mexico')
+		self.assertEqual(0, others.get({'shipcountry':'Mexico'}))
+		self.assertNotEqual(0, others.get({'shipcountry':'France'}))
+	
+	def test_inverse_of_function_attribute(self):
+		transform = domain.attribute('orderid', 'shipcountry', self.lookup.get, inverse=lambda c: {10248} if c == 'France' else set())
+		criterion = runtime.ScalarComparison('shipcountry', 'EQ', runtime.Variable('c')).preimage(transform)
+		self.assertEqual('IN', criterion.relop)
+		self.assertEqual(frozenset([10248]), criterion.members({'c': 'France'}))
+		self.assertFalse(criterion.complement().test({'orderid':10248}, {'c': 'France'}))
+	
+	def test_compose(self):
+		first = domain.attribute('a', 'b', lambda a: a + 1)
+		second = domain.attribute('b', 'c', lambda b: b * 10)
+		both = domain.compose(first, second)
+		self.assertEqual((frozenset('a'), frozenset('bc')), (both.domain, both.range))
+		point = {'a': 1}
+		both.update(point)
+		self.assertEqual({'a':1, 'b':2, 'c':20}, point)
+
+
+class TestParallel(unittest.TestCase):
+	
+	SCRIPT = """
+		gross is quantity_sold * unit_price
+		net_value is gross - gross * discount_rate
+		revenue_by_country is net_value sum { orderid -> shipcountry } by [shipcountry]
+		one_country is revenue_by_country where shipcountry = $country
+	"""
+	
+	@classmethod
+	def setUpClass(cls):
+		cls.universe = toys.sample_module(indexed=True).script(cls.SCRIPT)
+	
+	def compare(self, executor, name, **env):
+		expect = {tuple(sorted(p.items())):v for p, v in self.universe.query(name, **env).content()}
+		self.universe.executor = executor
+		try: result = self.universe.query(name, **env)
+		finally: self.universe.executor = None
+		actual = {tuple(sorted(p.items())):v for p, v in result.content()}
+		self.assertEqual(expect.keys(), actual.keys())
+		for k in expect: self.assertAlmostEqual(expect[k], actual[k])
+	
+	def test_hash_partitions(self):
+		with parallel.PartitionedExecutor(3) as executor:
+			for name in ['net_value', 'revenue_by_country']:
+				with self.subTest(name): self.compare(executor, name)
+			self.compare(executor, 'one_country', country='Mexico')
+	
+	def test_range_partitions(self):
+		with parallel.PartitionedExecutor(2, axis='productid', boundaries=[20, 40, 60]) as executor:
+			self.compare(executor, 'net_value')
+	
+	def test_partitions_from_statistics(self):
+		with parallel.PartitionedExecutor(3, axis='productid', boundaries='auto') as executor:
+			partitions = executor.partitions(frozenset(['productid']), self.universe.get_tensor('gross').statistics())
+			self.assertEqual(3, len(partitions))
+			self.compare(executor, 'net_value')
+	
+	def test_workers_last_until_closed(self):
+		source = self.universe.get_tensor('quantity_sold')
+		watchers = len(getattr(source, '_AbstractTensor__watchers', ()))
+		with parallel.PartitionedExecutor(2) as executor:
+			self.compare(executor, 'one_country', country='Mexico')
+			self.compare(executor, 'one_country', country='France')
+			self.assertEqual(1, executor.forks)
+			self.compare(executor, 'net_value')
+			self.compare(executor, 'one_country', country='Brazil')
+			self.assertEqual(2, executor.forks) # Once more, for the plan the workers hadn't seen.
+			source.changed()
+			self.compare(executor, 'net_value')
+			self.assertEqual(3, executor.forks) # The workers had the data from before.
+		self.assertEqual(watchers, len(source._AbstractTensor__watchers))
+		self.compare(executor, 'net_value') # Closed, but still good for another query.
+		executor.close()
+	
+	def test_indexes_split_the_scan(self):
+		table = self.universe.get_tensor('quantity_sold').table
+		for axis in ['orderid', 'productid']: # A hash index, and a sorted one.
+			with self.subTest(axis):
+				partitions = parallel.PartitionedExecutor(4, axis=axis).partitions(frozenset([axis]))
+				pushed, residual = table.capabilities().split(partitions[0])
+				self.assertEqual(0, len(residual))
+				shares = []
+				for predicate in partitions:
+					selected, residual = table.select(predicate, {})
+					self.assertEqual(0, len(residual))
+					self.assertTrue(all(predicate.test({axis:table.column(axis)[i]}, {}) for i in selected))
+					shares.append(selected)
+				self.assertEqual(list(range(len(table))), sorted(i for share in shares for i in share))
+				self.assertLess(max(map(len, shares)), len(table) / 2)
+	
+	def test_partitions_cover_everything_once(self):
+		hashed = parallel.PartitionedExecutor(4).partitions(frozenset(['x']))
+		ranged = parallel.PartitionedExecutor(2, boundaries=['m', 'f']).partitions(frozenset(['x']))
+		self.assertEqual(3, len(ranged))
+		for partitions, members in [(hashed, [0, 1, 7, 'apple', 'zebra']), (ranged, ['apple', 'f', 'mango', 'zebra'])]:
+			for x in members:
+				self.assertEqual(1, sum(p.test({'x':x}, {}) for p in partitions))
+
+
+class TestReload(unittest.TestCase):
+	""" Re-loading an edited script re-plans what changed and what depends on it, and nothing else. """
+	
+	SCRIPT = """
+		gross is quantity_sold * unit_price
+		discount is gross * discount_rate
+		by_product is discount by [productid]
+		one_order is gross where orderid = $order
+	"""
+	
+	def setUp(self):
+		self.module = toys.sample_module(indexed=True)
+		self.module.cache = caching.QueryCache(1 << 24)
+		self.module.reload(self.SCRIPT)
+		self.plans = {name:self.module.get_tensor(name) for name in ['gross', 'discount', 'by_product', 'one_order']}
+	
+	def same(self): return {name for name, plan in self.plans.items() if self.module.tensor_types().get(name) and self.module.get_tensor(name) is plan}
+	
+	def test_moving_and_commenting_changes_nothing(self):
+		self.module.query('by_product')
+		self.module.reload("-- Now with comments.\n" + self.SCRIPT.replace('gross is', '\n\tgross   is').replace('[productid]', '[productid] -- by product'))
+		self.assertEqual(set(self.plans), self.same())
+		self.module.query('by_product')
+		self.assertEqual(1, self.module.cache.hits)
+	
+	def test_edit_replans_dependents_only(self):
+		self.module.query('one_order', order=10248)
+		edited = self.SCRIPT.replace('gross * discount_rate', 'gross - gross * discount_rate')
+		self.module.reload(edited)
+		self.assertEqual({'gross', 'one_order'}, self.same())
+		self.module.query('one_order', order=10248)
+		self.assertEqual(1, self.module.cache.hits)
+		expect = toys.sample_module(indexed=True).script(edited).query('by_product')
+		actual = {p['productid']:v for p, v in self.module.query('by_product').content()}
+		self.assertEqual(len(expect), len(actual))
+		for p, v in expect.content(): self.assertAlmostEqual(v, actual[p['productid']])
+	
+	def test_removal_and_variables(self):
+		script = self.SCRIPT.replace('orderid = $order', 'productid = $order').replace('by_product is discount by [productid]', '')
+		self.module.reload(script)
+		self.assertEqual({'gross', 'discount'}, self.same())
+		with self.assertRaises(KeyError): self.module.get_tensor('by_product')
+		self.assertEqual({11}, {p['productid'] for p, v in self.module.query('one_order', order=11).content()})
+	
+	def test_big_script_edits_quickly(self):
+		lines = ['gross is quantity_sold * unit_price'] + ['d%d is (gross where productid >= %d) by [productid]'%(i, i) for i in range(300)]
+		text = '\n'.join(lines)
+		self.module.reload(text)
+		edited = text.replace('>= 7)', '>= 8)')
+		planned = []
+		def register_definition(name, tensor, definition, original=self.module.register_definition):
+			planned.append(name)
+			return original(name, tensor, definition)
+		self.module.register_definition = register_definition
+		self.module.reload(edited)
+		self.assertEqual(['d7'], planned)
+		self.assertIs(self.plans['gross'], self.module.get_tensor('gross'))
+	
+	def test_reloading_lets_go_of_old_plans(self):
+		source = self.module.get_tensor('quantity_sold')
+		self.module.query('one_order', order=10248)
+		watching = len(source._AbstractTensor__watchers)
+		for i in range(20):
+			self.module.reload(self.SCRIPT.replace('one_order is gross', 'one_order is discount') if i % 2 else self.SCRIPT)
+			self.module.query('one_order', order=10248)
+		self.assertEqual(watching, len(source._AbstractTensor__watchers))
+		self.assertEqual(1, len(self.module.cache._QueryCache__parameters))
+
+
+class TestQueryStream(unittest.TestCase):
+	""" Streaming results arrive as they're computed, and stop when you say. """
+	
+	def setUp(self):
+		self.universe = toys.sample_module(indexed=True).script("""
+			gross is quantity_sold * unit_price
+			some is gross where productid >= 10
+			per_unit is gross / quantity_sold
+		""")
+		table = self.universe.get_tensor('quantity_sold').table
+		self.rows, self.closed = [0], []
+		def counting_scan(predicate, environment, original=table.scan):
+			try:
+				for pair in original(predicate, environment):
+					self.rows[0] += 1
+					yield pair
+			finally: self.closed.append(self.rows[0])
+		table.scan = counting_scan
+	
+	def test_same_points_as_query(self):
+		for name in ['some', 'per_unit']:
+			with self.subTest(name):
+				expect = {tuple(sorted(p.items())):v for p, v in self.universe.query(name).content()}
+				actual = {}
+				with self.universe.query_stream(name) as result:
+					for chunk in result.chunks(100):
+						self.assertLessEqual(len(chunk), 100)
+						for p, v in chunk:
+							k = tuple(sorted(p.items()))
+							actual[k] = actual.get(k, 0) + v
+				self.assertEqual(len(actual), result.count)
+				self.assertEqual(expect.keys(), actual.keys())
+				for k in expect: self.assertAlmostEqual(expect[k], actual[k])
+	
+	def test_first_chunk_early_and_close_stops_the_scan(self):
+		total = len(self.universe.query('some'))
+		self.rows[0] = 0
+		result = self.universe.query_stream('some')
+		first = next(result.chunks(10))
+		self.assertEqual(10, len(first))
+		self.assertLess(self.rows[0], total)
+		result.close()
+		self.assertEqual([self.rows[0]], self.closed[-1:])
+		self.assertEqual([], list(result))
+
+
+class TestQuerySet(unittest.TestCase):
+	""" Common subexpressions across (and within) the tensors of a report get computed once. """
+	
+	SCRIPT = """
+		gross is quantity_sold * unit_price
+		by_product is gross by [productid]
+		units is quantity_sold by [productid]
+		average_price is by_product / units
+		net is by_product - by_product * discount_rate by [productid]
+		big is by_product where productid >= 40
+	"""
+	NAMES = ['by_product', 'average_price', 'net', 'big']
+	
+	def setUp(self):
+		self.universe = toys.sample_module(indexed=True).script(self.SCRIPT)
+		table = self.universe.get_tensor('quantity_sold').table
+		self.scans = count_scans(table)
+	
+	def test_finds_common_subexpressions(self):
+		plans = [self.universe.get_tensor(name) for name in self.NAMES]
+		self.assertEqual([self.universe.get_tensor('by_product')], sharing.common(plans))
+		self.assertEqual([], sharing.common(plans[-1:]))
+	
+	def test_one_scan_per_distinct_subplan(self):
+		separately = {name: self.universe.query(name) for name in self.NAMES}
+		expect_scans, self.scans[:] = len(self.scans), []
+		together = self.universe.query_set(self.NAMES)
+		self.assertLess(len(self.scans), expect_scans)
+		self.assertEqual(3, len(self.scans)) # One each for by_product, units, and discount_rate by [productid].
+		for name in self.NAMES:
+			expect = {tuple(sorted(p.items())):v for p, v in separately[name].content()}
+			actual = {tuple(sorted(p.items())):v for p, v in together[name].content()}
+			self.assertEqual(expect.keys(), actual.keys())
+			for k in expect: self.assertAlmostEqual(expect[k], actual[k])
+		self.assertNotIn('stream', vars(self.universe.get_tensor('by_product'))) # Put back as it was.
+	
+	def test_references_to_a_source_share(self):
+		self.universe.script("""
+			few is quantity_sold where productid < 10
+			few_again is quantity_sold where productid < 10
+		""")
+		few, few_again = (self.universe.get_tensor(name) for name in ['few', 'few_again'])
+		self.assertIs(few.operands()[0], few_again.operands()[0])
+		together = self.universe.query_set(['few', 'few_again'])
+		self.assertEqual(1, len(self.scans)) # The criteria are separate objects, but equal.
+		few, few_again = ({tuple(sorted(p.items())):v for p, v in together[name].content()} for name in ['few', 'few_again'])
+		self.assertTrue(few)
+		self.assertEqual(few, few_again)
+	
+	def test_criteria_match_by_value(self):
+		transform = domain.attribute('orderid', 'shipcountry', lambda orderid: 'France')
+		def key(relop):
+			criterion = runtime.ScalarComparison('shipcountry', relop, runtime.Variable('country'))
+			translated, = domain.Predicate([criterion]).transformed(transform.for_query())
+			self.assertIsInstance(translated, domain.TranslatedCriterion)
+			return translated.key()
+		self.assertEqual(key('EQ'), key('EQ'))
+		self.assertNotEqual(key('EQ'), key('NE'))
+
+
+class TestQueryMany(unittest.TestCase):
+	
+	SCRIPT = """
+		gross is quantity_sold * unit_price
+		revenue_by_country is gross sum { orderid -> shipcountry } by [shipcountry]
+		one_country is revenue_by_country where shipcountry = $country
+		one_order is gross where orderid = $order
+		by_product is one_order by [productid]
+		not_this_order is gross where orderid = $order else gross * discount_rate
+		partly_one_order is (gross where orderid = $order) + gross
+	"""
+	
+	def setUp(self):
+		self.universe = toys.sample_module(indexed=True).script(self.SCRIPT)
+		table = self.universe.get_tensor('quantity_sold').table
+		self.scans = count_scans(table)
+	
+	def check(self, name, environments, expect_scans):
+		actual = self.universe.query_many(name, environments)
+		self.assertEqual(expect_scans, len(self.scans))
+		self.assertEqual(len(environments), len(actual))
+		for env, result in zip(environments, actual):
+			expect = {tuple(sorted(p.items())):v for p, v in self.universe.query(name, **env).content()}
+			self.assertEqual(expect, {tuple(sorted(p.items())):v for p, v in result.content()})
+	
+	def test_sweep_makes_one_pass(self):
+		countries = ['Mexico', 'France', 'Germany', 'Atlantis']
+		self.check('one_country', [{'country':c} for c in countries], 1)
+	
+	def test_sweep_through_index(self):
+		self.check('one_order', [{'order':o} for o in [10248, 10249, 10250]], 1)
+	
+	def test_fall_back_when_axis_is_summed_away(self):
+		self.check('by_product', [{'order':o} for o in [10248, 10249]], 2)
+	
+	def test_fall_back_for_multiplex(self):
+		self.check('not_this_order', [{'order':o} for o in [10248, 10249]], 4) # Two scans per query.
+	
+	def test_fall_back_when_some_operand_is_unfiltered(self):
+		self.check('partly_one_order', [{'order':o} for o in [10248, 10249]], 4) # Each operand scans, per query.
+	
+	def test_same_binding_computes_once(self):
+		self.check('one_country', [{'country':'Mexico', 'irrelevant':n} for n in range(3)], 1)
+
+
 class TestSemantics(unittest.TestCase):
 	"""
 	Don't get hung up on the class name. It's a start.
@@ -170,5 +1136,138 @@ class TestSemantics(unittest.TestCase):
 		else: assert False
 
 
+@unittest.skipIf(numpy is None, "NumPy is not installed.")
+class TestColumnar(unittest.TestCase):
+	""" The column-oriented machinery must agree with the dictionary-oriented machinery. """
+	
+	SCRIPT = """
+		gross is quantity_sold * unit_price
+		by_product is gross by [ProductID]
+		revenue_by_country is gross sum { orderid -> shipcountry } by [shipcountry]
+	"""
+	
+	def setUp(self):
+		from mistake import columnar
+		self.columnar = columnar
+		self.universe = toys.sample_module().script(self.SCRIPT)
+	
+	def assertSameContent(self, expect:runtime.TensorBuffer, actual):
+		def as_dict(buffer): return {tuple(sorted(p.items())):v for p,v in buffer.content()}
+		e, a = as_dict(expect), as_dict(actual)
+		self.assertEqual(e.keys(), a.keys())
+		for k in e: self.assertAlmostEqual(e[k], a[k])
+	
+	def test_buffer_agrees_with_dictionary_buffer(self):
+		for name in ['gross', 'by_product', 'revenue_by_country']:
+			with self.subTest(name):
+				expect = self.universe.query(name)
+				self.universe.buffer_class = self.columnar.ColumnarBuffer
+				actual = self.universe.query(name)
+				self.universe.buffer_class = runtime.TensorBuffer
+				self.assertIsInstance(actual, self.columnar.ColumnarBuffer)
+				self.assertSameContent(expect, actual)
+				for point, value in expect.content():
+					self.assertAlmostEqual(value, actual.get(point))
+	
+	def test_fused_scan_goes_column_wise(self):
+		universe = toys.sample_module(indexed=True).script("""
+			gross is quantity_sold * unit_price
+			odd is quantity_sold / discount_rate * unit_price -- Division by zero leaves gaps.
+		""")
+		plan = universe.get_tensor('odd')
+		self.assertIsInstance(plan, runtime.FusedScan)
+		predicate = domain.Predicate([runtime.ScalarComparison('productid', 'LT', runtime.Constant(30))])
+		expect = runtime.TensorBuffer(plan, predicate, {})
+		actual = self.columnar.ColumnarBuffer(plan, predicate, {})
+		self.assertSameContent(expect, actual)
+		self.assertLess(len(actual), len(runtime.TensorBuffer(universe.get_tensor('gross'), predicate, {})))
+	
+	def test_get_missing_point_is_zero(self):
+		buffer = self.columnar.ColumnarBuffer.from_columns({'a': [1, 2, 1], 'b': ['x', 'y', 'x']}, [1.0, 2.0, 3.0])
+		self.assertEqual(4.0, buffer.get({'a':1, 'b':'x'}))
+		self.assertEqual(0, buffer.get({'a':1, 'b':'y'}))
+		self.assertEqual(0, buffer.get({'a':3, 'b':'x'}))
+		self.assertEqual(0, buffer.get({'a':0, 'b':'a'}))
+	
+	def test_bulk_export(self):
+		buffer = self.columnar.ColumnarBuffer.from_columns({'a': [3, 1, 3]}, [1.0, 2.0, 3.0])
+		keys, values = buffer.columns()
+		self.assertEqual([1, 3], keys['a'].tolist())
+		self.assertEqual([2.0, 4.0], values.tolist())
+	
+	def test_empty_buffer(self):
+		buffer = self.columnar.ColumnarBuffer.from_columns({'a': []}, [])
+		self.assertEqual([], list(buffer.content()))
+		self.assertEqual(0, buffer.get({'a':1}))
+	
+	def test_predicate_mask_agrees_with_test(self):
+		batch = {'orderid': numpy.array([10248, 10249, 10250, 10251]), 'productid': numpy.array([11, 42, 11, 72])}
+		small = runtime.ScalarComparison('productid', 'LT', runtime.Constant(40))
+		order = runtime.ScalarComparison('orderid', 'GE', runtime.Variable('first'))
+		country = runtime.ScalarComparison('shipcountry', 'EQ', runtime.Constant('France'))
+		translated = domain.TranslatedCriterion(self.universe.find_transform(['orderid'], ['shipcountry']), country)
+		environment = {'first': 10249}
+		for predicate in [
+			domain.Predicate([]),
+			domain.Predicate([small]),
+			domain.Predicate([small.complement(), order]),
+			domain.Predicate([translated]),
+			domain.Predicate([translated.complement(), order.complement()]),
+		]:
+			expect = [predicate.test(p, environment) for p in self.columnar.rows(batch)]
+			self.assertEqual(expect, predicate.mask(batch, environment).tolist())
+	
+	def test_default_batches_respect_predicate(self):
+		tensor = self.universe.get_tensor('gross')
+		predicate = domain.Predicate([runtime.ScalarComparison('orderid', 'EQ', runtime.Constant(10256))])
+		batches = list(tensor.batches(predicate, {}, size=1))
+		self.assertEqual(2, len(batches))
+		for batch, values in batches: self.assertEqual([10256], batch['orderid'].tolist())
+
+
+
+class TestStartup(unittest.TestCase):
+	""" Importing the planner should be quick: no parser generator, no grammar compilation. """
+	
+	IMPORT_BUDGET = 0.5 # Seconds. Generous, so slow machines don't fail, but it catches a compile.
+	
+	def test_import_is_quick_and_defers_boozetools(self):
+		script = (
+			"import sys, time\n"
+			"start = time.perf_counter()\n"
+			"import mistake.planning\n"
+			"print(time.perf_counter() - start, 'boozetools.support.runtime' in sys.modules)\n"
+		)
+		env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(planning.__file__)))
+		seconds, loaded = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True, check=True).stdout.split()
+		self.assertEqual('False', loaded)
+		self.assertLess(float(seconds), self.IMPORT_BUDGET)
+	
+	def test_prebuilt_tables_match_the_grammar(self):
+		# If this fails, the grammar changed: run `python -m mistake.utility` to rebuild the tables.
+		tables = frontend.tables()
+		self.assertEqual(frontend.TABLES, tables)
+		self.assertIsInstance(tables['version'], list) # Came from the shipped JSON, not a fresh compile.
+	
+	def test_cache_is_keyed_by_content_and_version(self):
+		calls = []
+		def method(path):
+			calls.append(path)
+			return path.read_text()
+		with tempfile.TemporaryDirectory() as folder:
+			source = os.path.join(folder, 'grammar.md')
+			with open(source, 'w') as ofh: ofh.write('one')
+			for version in ['1', '1', '2']: self.assertEqual('one', utility.pickle_cache(source, folder, method, version))
+			self.assertEqual(2, len(calls))
+			with open(source, 'w') as ofh: ofh.write('two')
+			self.assertEqual('two', utility.pickle_cache(source, folder, method, '2'))
+			for name in os.listdir(folder):
+				if name.endswith('.pickle'):
+					with open(os.path.join(folder, name), 'wb') as ofh: ofh.write(b'garbage')
+			self.assertEqual('two', utility.pickle_cache(source, folder, method, '2'))
+			self.assertEqual(4, len(calls))
+			self.assertFalse([name for name in os.listdir(folder) if name.endswith('.tmp')])
+
+
 if __name__ == "__main__":
 	unittest.main()
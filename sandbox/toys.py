@@ -8,9 +8,9 @@ These toys are meant for experimentation:
 
 from typing import Dict, Generator, Callable, Any, NamedTuple, Mapping
 import zipfile, re, datetime
-from mistake.domain import AbstractTensor, Predicate, Transform
+from mistake.domain import AbstractTensor, AbstractRelation, Predicate, Transform
 from mistake.planning import MistakeModule
-from mistake import semantics
+from mistake import semantics, sources
 
 #----------------------------------------------------------------------------------------------------
 # There's not a "countries" relation in the Northwind database, but I want the continent
@@ -76,24 +76,40 @@ def northwind(table_name):
 def parse_date(date_time_str):
 	return datetime.datetime.strptime(date_time_str, '%Y-%m-%d %H:%M:%S.%f')
 
+class KissRelation(AbstractRelation):
+	""" Two of these are the same relation if they read the same table with the same key space. """
+	def __init__(self, table_name, key_space:Dict[str,Callable[[str],object]]):
+		self.__identity = table_name, tuple(sorted(key_space.items()))
+		self.__table_name = table_name
+		self.__key_space = key_space
+	
+	def __eq__(self, other): return isinstance(other, KissRelation) and self.__identity == other.__identity
+	def __hash__(self): return hash(self.__identity)
+	
+	def scan(self, predicate: Predicate, environment) -> Generator:
+		for row in northwind(self.__table_name):
+			point = {k:fn(row[k]) for k,fn in self.__key_space.items()}
+			if predicate.test(point, environment): yield point, row
+
 class KissTensor(AbstractTensor):
 	def __init__(self, table_name, field:str, key_space:Dict[str,Callable[[str],object]], unit:semantics.UnitOfMeasure):
 		assert isinstance(unit, semantics.UnitOfMeasure), type(unit)
-		self.__table_name = table_name
-		self.__key_space = key_space
+		self.__relation = KissRelation(table_name, key_space)
 		self.__field = field
-		self.__tensor_type = semantics.TensorType(frozenset(self.__key_space.keys()), unit)
+		self.__tensor_type = semantics.TensorType(frozenset(key_space.keys()), unit)
 	
 	def stream(self, predicate: Predicate, environment) -> Generator:
-		for row in northwind(self.__table_name):
-			point = {k:fn(row[k]) for k,fn in self.__key_space.items()}
-			if predicate.test(point, environment): yield point, float(row[self.__field])
+		for point, row in self.__relation.scan(predicate, environment):
+			yield point, float(row[self.__field])
+	
+	def relation(self) -> KissRelation: return self.__relation
+	def extract(self, row) -> float: return float(row[self.__field])
 	
 	def tensor_type(self) -> semantics.TensorType:
 		return self.__tensor_type
 
 
-def sample_module() -> MistakeModule:
+def sample_module(indexed=False) -> MistakeModule:
 	universe = semantics.UniverseOfDiscourse()
 	widget = universe.create_fundamental_unit('widget')
 	dollar = universe.create_fundamental_unit('dollar')
@@ -103,13 +119,19 @@ def sample_module() -> MistakeModule:
 	module = MistakeModule(universe)
 	
 	key_space = dict(productid=int, orderid=int)
-	module.register_tensor('quantity_sold', KissTensor('order-details', 'quantity', key_space, widget))
-	module.register_tensor('unit_price', KissTensor('order-details', 'unitprice', key_space, dollar/widget))
-	module.register_tensor('discount_rate', KissTensor('order-details', 'discount', key_space, semantics.dimensionless))
-	
-	orders = {int(row['orderid']):row for row in northwind('orders')}
+	if indexed:
+		# Same data, but loaded once and indexed, in place of re-reading the zip file on every query.
+		table = sources.Table(northwind('order-details'), key_space, hashed=['orderid'], ordered=['productid'], name='order-details')
+		module.register_tensor('quantity_sold', sources.TableTensor(table, 'quantity', widget))
+		module.register_tensor('unit_price', sources.TableTensor(table, 'unitprice', dollar/widget))
+		module.register_tensor('discount_rate', sources.TableTensor(table, 'discount', semantics.dimensionless))
+	else:
+		module.register_tensor('quantity_sold', KissTensor('order-details', 'quantity', key_space, widget))
+		module.register_tensor('unit_price', KissTensor('order-details', 'unitprice', key_space, dollar/widget))
+		module.register_tensor('discount_rate', KissTensor('order-details', 'discount', key_space, semantics.dimensionless))
 	
-	module.register_attribute('orderid', 'shipcountry', lambda oid:orders[oid]['shipcountry'])
+	ship_country = {int(row['orderid']):row['shipcountry'] for row in northwind('orders')}
+	module.register_attribute('orderid', 'shipcountry', ship_country) # A lookup-table attribute.
 	
 	return module
 	
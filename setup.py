@@ -14,7 +14,7 @@ setuptools.setup(
 	packages=['mistake', ],
 	package_dir = {'': 'src'},
 	package_data={
-		'mistake': ['mistake_grammar.md',],
+		'mistake': ['mistake_grammar.md', 'mistake_grammar.md.automaton',],
 	},
 	license='MIT',
 	description='A tensor-oriented programming language with semantic validation',
@@ -34,5 +34,8 @@ setuptools.setup(
 	python_requires='>=3.7',
 	install_requires=[
 		'booze-tools>=0.4.4',
-	]
+	],
+	extras_require={
+		'numpy': ['numpy'],
+	},
 )
\ No newline at end of file
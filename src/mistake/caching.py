@@ -0,0 +1,108 @@
+"""
+Query result caching. This is opt-in: give a `QueryCache` to your `MistakeModule`.
+
+A cached result is keyed on the identity of the plan together with the values of
+only those environment variables the plan actually reads. So a query which doesn't
+depend on `$country` gets a cache hit regardless of what `$country` happens to be.
+Entries leave the cache when they're too old, when the memory budget runs short
+(least-recently-used first), or when a source under the plan signals a change.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Mapping, Hashable, Any, Optional
+from .domain import AbstractTensor
+from . import metrics
+
+ENTRY_OVERHEAD = 200 # Rough bytes per point held in a dictionary-based buffer.
+
+
+def footprint(buffer) -> int:
+	""" Rough size of a buffer in bytes, good enough to budget by. """
+	if hasattr(buffer, 'columns'):
+		keys, values = buffer.columns()
+		return values.nbytes + sum(column.nbytes for column in keys.values())
+	return len(buffer) * ENTRY_OVERHEAD
+
+
+def _freeze(value) -> Hashable:
+	""" Environment values like lists (for plural variables) need to become hashable to serve as keys. """
+	if isinstance(value, (list, tuple)): return tuple(map(_freeze, value))
+	if isinstance(value, (set, frozenset)): return frozenset(value)
+	return value
+
+
+class QueryCache:
+	"""
+	budget: the most bytes (as estimated by `weigh`) the cache may hold at once.
+		A result bigger than the whole budget just doesn't get cached.
+	ttl: if given, the number of seconds an entry stays fresh.
+	"""
+
+	def __init__(self, budget:int, ttl:Optional[float]=None, *, weigh:Callable[[Any], int]=footprint, clock:Callable[[], float]=time.monotonic):
+		self.budget, self.ttl = budget, ttl
+		self.__weigh, self.__clock = weigh, clock
+		self.__entries: "OrderedDict[tuple, tuple]" = OrderedDict() # key -> (result, size, expiry)
+		self.__parameters: Dict[AbstractTensor, tuple] = {}
+		self.__keys_by_plan: Dict[AbstractTensor, set] = {}
+		self.__unwatch: Dict[AbstractTensor, Callable[[], None]] = {}
+		self.size = 0
+		self.hits = self.misses = 0
+
+	def __len__(self): return len(self.__entries)
+
+	def key(self, plan:AbstractTensor, environment:Mapping) -> tuple:
+		try: names = self.__parameters[plan]
+		except KeyError:
+			names = self.__parameters[plan] = tuple(sorted(plan.parameters()))
+			self.__unwatch[plan] = plan.watch(lambda source: self.forget(plan))
+		return (plan,) + tuple(_freeze(environment.get(name)) for name in names)
+
+	def fetch(self, plan:AbstractTensor, environment:Mapping, compute:Callable[[], Any]):
+		""" Return the cached result for this plan and environment, calling `compute()` if necessary. """
+		key = self.key(plan, environment)
+		entry = self.__entries.get(key)
+		if entry is not None:
+			if self.ttl is None or self.__clock() < entry[2]:
+				self.hits += 1
+				metrics.count('mistake_cache_requests_total', result='hit')
+				self.__entries.move_to_end(key)
+				return entry[0]
+			self.__discard(key)
+		self.misses += 1
+		metrics.count('mistake_cache_requests_total', result='miss')
+		result = compute()
+		self.__store(key, result)
+		return result
+
+	def __store(self, key:tuple, result):
+		size = self.__weigh(result)
+		if size > self.budget: return
+		while self.size + size > self.budget: self.__discard(next(iter(self.__entries)))
+		expiry = float('inf') if self.ttl is None else self.__clock() + self.ttl
+		self.__entries[key] = (result, size, expiry)
+		self.__keys_by_plan.setdefault(key[0], set()).add(key)
+		self.size += size
+
+	def __discard(self, key:tuple):
+		result, size, expiry = self.__entries.pop(key)
+		self.__keys_by_plan[key[0]].discard(key)
+		self.size -= size
+
+	def forget(self, plan:AbstractTensor):
+		""" Drop every entry for the given plan. (Sources changing under a plan trigger this.) """
+		for key in list(self.__keys_by_plan.get(plan, ())): self.__discard(key)
+
+	def release(self, plan:AbstractTensor):
+		"""
+		Forget the plan altogether, for when nobody will ask about it again (as when `reload`
+		replaces it). Its entries go, and so does the cache's subscription to its sources.
+		"""
+		self.forget(plan)
+		self.__keys_by_plan.pop(plan, None)
+		self.__parameters.pop(plan, None)
+		unwatch = self.__unwatch.pop(plan, None)
+		if unwatch is not None: unwatch()
+
+	def clear(self):
+		for key in list(self.__entries): self.__discard(key)
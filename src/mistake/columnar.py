@@ -0,0 +1,160 @@
+"""
+Column-oriented counterparts to some of the runtime structures, backed by NumPy.
+
+NumPy is an optional dependency. Nothing else in the package imports this module
+until someone actually asks for it, so the rest of the system carries on fine
+without NumPy installed. If you want these structures, you'll need NumPy.
+"""
+
+from typing import Dict, Generator, Mapping, Tuple, Iterable, Callable
+import numpy
+from .domain import AbstractTensor, Predicate, Point, Batch, Transform
+from . import metrics
+
+Columns = Dict[str, numpy.ndarray]
+
+
+def gather(stream:Iterable, space:Iterable[str], size:int) -> Generator:
+	""" Collect a stream of <point, value> pairs into <batch, values> pairs of at most `size` rows. """
+	schedule = tuple(space)
+	def flush():
+		return {k:numpy.asarray(keys[k]) for k in schedule}, numpy.asarray(values, dtype=float)
+	keys, values = {k:[] for k in schedule}, []
+	for point, value in stream:
+		for k in schedule: keys[k].append(point[k])
+		values.append(value)
+		if len(values) >= size:
+			yield flush()
+			keys, values = {k:[] for k in schedule}, []
+	if values: yield flush()
+
+def rows(batch:Batch) -> Generator:
+	""" Go the other way: yield one point (dictionary) per row of a batch. """
+	schedule = tuple(batch)
+	for key in zip(*(numpy.asarray(batch[k]).tolist() for k in schedule)):
+		yield dict(zip(schedule, key))
+
+def size_of(batch:Batch) -> int:
+	for column in batch.values(): return len(column)
+	raise ValueError("A batch with no columns has no definite size.")
+
+def everything(batch:Batch) -> numpy.ndarray:
+	return numpy.ones(size_of(batch), dtype=bool)
+
+def row_wise(test:Callable[[Point, Mapping], bool], batch:Batch, environment:Mapping) -> numpy.ndarray:
+	""" The slow-but-sure way to get a mask: call a per-point test on each row. """
+	return numpy.fromiter((test(point, environment) for point in rows(batch)), dtype=bool, count=size_of(batch))
+
+def transformed(transform:Transform, batch:Batch) -> Batch:
+	"""
+	Return a new batch which also has the columns for the range of the transform.
+	A vectorized attribute maps the whole column at once. An attribute with a lookup
+	gets consulted once per distinct member. Anything else gets applied row by row.
+	"""
+	result = dict(batch)
+	if transform.lookup is not None:
+		(domain_,), (range_,) = transform.domain, transform.range
+		column = numpy.asarray(batch[domain_])
+		if transform.vectorized is not None:
+			result[range_] = numpy.asarray(transform.vectorized(column))
+		else:
+			members, inverse = numpy.unique(column, return_inverse=True)
+			images = numpy.asarray([transform.lookup(m) for m in members.tolist()])
+			result[range_] = images[inverse.reshape(-1)] if len(images) else images
+		return result
+	domain = {k:batch[k] for k in transform.domain}
+	extra = {k:[] for k in transform.range}
+	for point in rows(domain):
+		transform.update(point)
+		for k in extra: extra[k].append(point[k])
+	for k, column in extra.items(): result[k] = numpy.asarray(column)
+	return result
+
+
+class ColumnarBuffer:
+	"""
+	Same contract as `runtime.TensorBuffer` (namely `get` and `content`) but the
+	storage is a set of parallel key columns and one value column, all NumPy arrays.
+	There is no per-point dictionary or tuple anywhere in the finished product.
+
+	Duplicate points get combined by sorting rather than hashing: Each axis is
+	reduced to integer codes against that axis's sorted distinct members. The codes
+	are folded together one axis at a time, re-densifying after each step so that
+	nothing can overflow no matter how wide the key space. Finally, runs of equal
+	codes are summed with `reduceat`. The same chain of sorted arrays then serves
+	`get` by binary search.
+	"""
+
+	def __init__(self, upstream:AbstractTensor, predicate:Predicate, environment:Mapping):
+		schedule = tuple(upstream.tensor_type().space)
+		keys = {k:[] for k in schedule}
+		values = []
+		for batch, vs in upstream.batches(predicate, environment):
+			for k in schedule: keys[k].append(numpy.asarray(batch[k]))
+			values.append(vs)
+		def concatenate(arrays): return numpy.concatenate(arrays) if arrays else numpy.zeros(0)
+		self.__build(schedule, {k:concatenate(v) for k,v in keys.items()}, concatenate(values).astype(float))
+		metrics.observe('mistake_buffer_points', len(self), buffer='columnar')
+
+	@classmethod
+	def from_columns(cls, keys:Mapping[str, numpy.ndarray], values:numpy.ndarray) -> "ColumnarBuffer":
+		""" Build a buffer straight from (possibly un-combined) parallel arrays. """
+		self = cls.__new__(cls)
+		self.__build(tuple(keys), {k:numpy.asarray(v) for k,v in keys.items()}, numpy.asarray(values))
+		return self
+
+	def __build(self, schedule:tuple, keys:Columns, values:numpy.ndarray):
+		self.__schedule = schedule
+		self.__steps = []
+		codes = numpy.zeros(len(values), dtype=numpy.int64)
+		for k in schedule:
+			members, inverse = numpy.unique(keys[k], return_inverse=True)
+			combos, codes = numpy.unique(codes * len(members) + inverse.reshape(-1), return_inverse=True)
+			codes = codes.reshape(-1)
+			self.__steps.append((members, combos))
+		if len(values):
+			order = numpy.argsort(codes, kind='stable')
+			ordered = codes[order]
+			starts = numpy.flatnonzero(numpy.concatenate(([True], ordered[1:] != ordered[:-1])))
+			self.__values = numpy.add.reduceat(values[order], starts)
+			first = order[starts]
+		else:
+			self.__values = values
+			first = numpy.zeros(0, dtype=numpy.int64)
+		self.__keys = {k: keys[k][first] for k in schedule}
+
+	def __locate(self, point:Point):
+		""" Return the position of the given point in the value column, or None if absent. """
+		if not len(self.__values): return None
+		code = 0
+		for k, (members, combos) in zip(self.__schedule, self.__steps):
+			member = point[k]
+			i = numpy.searchsorted(members, member)
+			if i == len(members) or members[i] != member: return None
+			code = code * len(members) + i
+			j = numpy.searchsorted(combos, code)
+			if j == len(combos) or combos[j] != code: return None
+			code = j
+		return code
+
+	def get(self, point:Point):
+		""" Return the value associated with a given point """
+		at = self.__locate(point)
+		return 0 if at is None else self.__values[at].item()
+
+	def content(self) -> Generator:
+		""" Yield up all the <point, value> pairs in the buffer. """
+		keys = [self.__keys[k].tolist() for k in self.__schedule]
+		for key, value in zip(zip(*keys), self.__values.tolist()):
+			yield dict(zip(self.__schedule, key)), value
+
+	def __len__(self):
+		""" The number of distinct points in the buffer. """
+		return len(self.__values)
+
+	def columns(self) -> Tuple[Columns, numpy.ndarray]:
+		"""
+		Bulk export: a dictionary from axis name to key column, and the parallel value column.
+		Each distinct point appears exactly once. Please don't scribble on these arrays.
+		"""
+		return dict(self.__keys), self.__values
@@ -6,11 +6,13 @@ This file is still very much in KISS mode.
 It also stands a very good chance of completely dissipating into other modules.
 """
 
-from typing import Dict, NamedTuple, Callable, Generator, Any, Tuple, FrozenSet, Iterable, Mapping
+import bisect, math, operator
+from typing import Dict, NamedTuple, Callable, Generator, Any, Tuple, FrozenSet, Iterable, Mapping, Optional
 from . import semantics
 
 Space = FrozenSet[str]
 Point = Dict[str, Any]
+Batch = Mapping[str, Any] # From axis name to a column (NumPy array) of members; see `columnar`.
 
 
 # Let's start with an algebra of structure spaces, with the goal of being able to
@@ -22,6 +24,56 @@ Point = Dict[str, Any]
 # However, a particular tensor will have both data and context.
 
 
+class Schema:
+	"""
+	A fixed order for the axes of a space, so that the runtime can key its hash tables
+	by position rather than by building a fresh tuple out of each point's dictionary.
+	Operators work out their schemas once, when the plan is built (see `of`).
+	
+	Points remain dictionaries wherever they cross an extension point (sources, transforms,
+	criteria) because that's the contract applications write to. Inside an operator,
+	though, a point's identity is its key: the member itself for a one-axis space,
+	a tuple of members (in schema order) otherwise, and the empty tuple for no axes at all.
+	Keys of the same schema compare with `<` in the schema's order, so they sort too.
+	
+	That covers the keying of hash tables only: buffers, combiners, the hash joins, and the
+	memos of key sets and translated criteria. Points themselves are not positional:
+	streams between operators still carry a dictionary per point, transforms still update
+	them in place, and criteria still find members by axis name.
+	"""
+	
+	def __init__(self, axes:Iterable[str]):
+		self.axes = tuple(axes)
+		self.position = {axis:i for i, axis in enumerate(self.axes)}
+		# key(point) gives the positional key for a point. It's an itemgetter, so it runs at C speed.
+		self.key = operator.itemgetter(*self.axes) if self.axes else (lambda point: ())
+	
+	@staticmethod
+	def of(axes:Iterable[str]) -> "Schema":
+		""" The (shared) schema for a sequence of axes, in that order, or for a space, in sorted order. """
+		axes = tuple(axes) if isinstance(axes, (tuple, list)) else tuple(sorted(axes))
+		try: return _SCHEMAS[axes]
+		except KeyError:
+			schema = _SCHEMAS[axes] = Schema(axes)
+			return schema
+	
+	def point(self, key) -> Point:
+		""" A fresh point (dictionary) for the given key. """
+		if len(self.axes) == 1: return {self.axes[0]:key}
+		return dict(zip(self.axes, key))
+	
+	def getter(self, axis:str) -> Callable:
+		""" A function from keys to the member on one axis. """
+		i = self.position[axis]
+		if len(self.axes) == 1: return lambda key: key
+		return operator.itemgetter(i)
+	
+	def __len__(self): return len(self.axes)
+	def __repr__(self): return 'Schema(%r)'%(self.axes,)
+
+_SCHEMAS: Dict[Tuple[str, ...], Schema] = {}
+
+
 class AbstractTensor:
 	"""
 	This ABC establishes the operations a tensor (expression) must support at runtime.
@@ -48,6 +100,130 @@ class AbstractTensor:
 		However, if this tensor works by delegation, it may also delegate that responsibility.
 		"""
 		raise NotImplementedError(type(self))
+	
+	def capabilities(self) -> Optional["Capabilities"]:
+		"""
+		Sources may override this to tell the planner what sort of criteria they can serve
+		efficiently. The default (None) means "no comment": such a tensor gets the whole
+		predicate and must respect it all, which is how things always used to work.
+		If a tensor does declare capabilities, then the planner may arrange for it to be
+		asked only those criteria it claims to serve. The rest get tested downstream.
+		"""
+		return None
+	
+	def operands(self) -> Tuple["AbstractTensor", ...]:
+		""" Plan nodes return the tensors they work from. Sources have none. """
+		return ()
+	
+	def parameters(self) -> FrozenSet[str]:
+		""" The names of the environment variables this tensor actually reads. """
+		return frozenset().union(*(o.parameters() for o in self.operands()))
+	
+	def statistics(self) -> Optional["TensorStatistics"]:
+		"""
+		Data about the data, if known. Sources may collect theirs on demand; the planner
+		attaches what a `statistics.Catalog` knows. Plan nodes derive theirs from operands.
+		"""
+		return None
+	
+	def cardinality(self) -> Optional[int]:
+		"""
+		An estimate (really, an upper bound) of how many points this tensor will stream, if known.
+		Statistics, if any, have the last word. Otherwise sources report theirs by way of
+		`capabilities`, and plan nodes guess from their operands.
+		"""
+		statistics = self.statistics()
+		if statistics is not None: return statistics.rows
+		capabilities = self.capabilities()
+		if capabilities is not None: return capabilities.cardinality
+		estimates = [o.cardinality() for o in self.operands()]
+		if estimates and None not in estimates: return max(estimates)
+	
+	def sort_order(self) -> Tuple[str, ...]:
+		""" The axes (major to minor) along which this tensor streams its points, if any. """
+		capabilities = self.capabilities()
+		return () if capabilities is None else tuple(capabilities.sort_order)
+	
+	def watch(self, callback:Callable[["AbstractTensor"], None]) -> Callable[[], None]:
+		"""
+		Arrange for `callback(source)` to be called whenever the data under this tensor changes.
+		Plan nodes pass the request along to their operands, so it lands on the sources.
+		Returns a function to call when you no longer care, so the sources let go of the callback.
+		"""
+		operands = self.operands()
+		if operands:
+			handles = [o.watch(callback) for o in operands]
+			def unwatch():
+				for h in handles: h()
+			return unwatch
+		try: self.__watchers.append(callback)
+		except AttributeError: self.__watchers = [callback]
+		def unwatch():
+			try: self.__watchers.remove(callback)
+			except ValueError: pass
+		return unwatch
+	
+	def changed(self):
+		""" Sources should call this when their data changes, so that (e.g.) caches can forget. """
+		for callback in getattr(self, '_AbstractTensor__watchers', ()): callback(self)
+	
+	def relation(self) -> Optional["AbstractRelation"]:
+		"""
+		If this tensor is (a function of) the fields of a single row of some physical
+		relation, return that relation. The planner may then fuse element-wise expressions
+		over the same relation into a single scan, getting each row's value from `extract`.
+		"""
+		return None
+	
+	def extract(self, row) -> Any:
+		"""
+		Given a row from `self.relation().scan(...)`, return this tensor's value there,
+		or None if this tensor has no point at that row. Only called if `relation` is not None.
+		"""
+		raise NotImplementedError(type(self))
+	
+	def extract_column(self, rows) -> Optional[Any]:
+		"""
+		Vectorized `extract`: Given an array of rows from `self.relation().batches(...)`,
+		return the NumPy array of this tensor's values there, or None if it can't. Tensors
+		that answer this must have a point at every row. It lets fused scans go column-wise.
+		"""
+		return None
+	
+	def batches(self, predicate:"Predicate", environment:Mapping, size:int=4096) -> Generator:
+		"""
+		Column-oriented alternative to `stream`: yield <batch, values> pairs where the batch
+		maps each axis to a column of members and the values are a parallel array.
+		Unlike `stream`, this one requires NumPy.
+		
+		The default just gathers up the stream. Sources that hold their data column-wise
+		should override this to filter with `Predicate.mask` and skip the per-row work.
+		"""
+		from . import columnar
+		return columnar.gather(self.stream(predicate, environment), self.tensor_type().space, size)
+
+
+class AbstractRelation:
+	"""
+	A physical table (or file, or query...) from which several tensors draw different fields.
+	The key space of the relation is the space of every tensor drawn from it.
+	Relations which represent the same physical data should compare equal.
+	"""
+	
+	def scan(self, predicate:"Predicate", environment:Mapping) -> Generator:
+		"""
+		Yield <point, row> pairs for the rows which satisfy the predicate.
+		The row is whatever the relation likes; the tensors drawn from it know what to do.
+		This method must respect the whole predicate.
+		"""
+		raise NotImplementedError(type(self))
+	
+	def batches(self, predicate:"Predicate", environment:Mapping, size:int=4096) -> Optional[Generator]:
+		"""
+		Column-oriented alternative to `scan`: yield <batch, rows> pairs, where the rows are
+		an array suitable for `AbstractTensor.extract_column`. Return None if not supported.
+		"""
+		return None
 
 
 class AbstractCriterion:
@@ -63,6 +239,107 @@ class AbstractCriterion:
 	
 	def complement(self) -> "AbstractCriterion":
 		raise NotImplementedError(type(self))
+	
+	def parameters(self) -> FrozenSet[str]:
+		""" The names of the environment variables this criterion reads. """
+		return frozenset()
+	
+	def preimage(self, transform:"Transform") -> Optional["AbstractCriterion"]:
+		"""
+		If possible, return an equivalent criterion on the domain of the given transform.
+		This is how criteria get pushed through transforms which publish an inverse.
+		"""
+		return None
+	
+	def selectivity(self, statistics:"TensorStatistics", environment:Optional[Mapping]=None) -> float:
+		"""
+		Estimated fraction of points which pass, given statistics about the tensor they come from.
+		Without an environment (as at planning time) parameters are unknown. This is a guess.
+		"""
+		return DEFAULT_SELECTIVITY
+	
+	def mask(self, batch:Batch, environment:Mapping):
+		"""
+		Vectorized counterpart to `test`: Return a boolean array saying which rows of the
+		batch pass. The default falls back on calling `test` for each row in turn, so
+		subclasses should override this whenever they can do it with array operations.
+		"""
+		from . import columnar
+		return columnar.row_wise(self.test, batch, environment)
+	
+	def constraint(self, environment:Mapping) -> Optional["Constraint"]:
+		"""
+		If this criterion looks at one axis in a way a `Constraint` can express, say so.
+		That lets `Predicate.normalized` merge it with other criteria on the same axis.
+		"""
+		return None
+	
+	def key(self) -> Any:
+		"""
+		Something which compares equal for criteria which select the same points, such as
+		two copies of `productid < 10` made separately. By default, only the criterion itself.
+		"""
+		return self
+
+
+class Constraint(NamedTuple):
+	"""
+	What a criterion requires of the member along its axis: within the bounds (None
+	meaning unbounded), among the members (None meaning anything), and not excluded.
+	Constraints intersect, which is how the normaliser works out what a whole
+	predicate requires of each axis, and whether anything can satisfy it at all.
+	"""
+	lo: Any = None
+	lo_closed: bool = True
+	hi: Any = None
+	hi_closed: bool = True
+	members: Optional[FrozenSet] = None
+	excluded: FrozenSet = frozenset()
+	
+	def admits(self, member) -> bool:
+		if self.lo is not None and (member < self.lo if self.lo_closed else member <= self.lo): return False
+		if self.hi is not None and (member > self.hi if self.hi_closed else member >= self.hi): return False
+		if self.members is not None and member not in self.members: return False
+		return member not in self.excluded
+	
+	def intersection(self, other:"Constraint") -> "Constraint":
+		lo, lo_closed = _tighter(self.lo, self.lo_closed, other.lo, other.lo_closed, operator.gt)
+		hi, hi_closed = _tighter(self.hi, self.hi_closed, other.hi, other.hi_closed, operator.lt)
+		if self.members is None: members = other.members
+		elif other.members is None: members = self.members
+		else: members = self.members & other.members
+		return Constraint(lo, lo_closed, hi, hi_closed, members, self.excluded | other.excluded)
+	
+	def finite(self) -> Optional[FrozenSet]:
+		""" The members admitted, if there are only finitely many that could be. """
+		if self.members is not None: return frozenset(filter(self.admits, self.members))
+		if self.lo is not None and self.lo == self.hi: return frozenset(filter(self.admits, [self.lo]))
+		return None
+	
+	def is_empty(self) -> bool:
+		finite = self.finite()
+		if finite is not None: return not finite
+		return self.lo is not None and self.hi is not None and self.lo > self.hi
+	
+	def implies(self, other:"Constraint") -> bool:
+		""" Does every member this admits, the other admit too? """
+		finite = self.finite()
+		if finite is not None: return all(map(other.admits, finite))
+		if other.members is not None: return False
+		if other.lo is not None:
+			if self.lo is None or self.lo < other.lo: return False
+			if self.lo == other.lo and self.lo_closed and not other.lo_closed: return False
+		if other.hi is not None:
+			if self.hi is None or self.hi > other.hi: return False
+			if self.hi == other.hi and self.hi_closed and not other.hi_closed: return False
+		return not any(map(self.admits, other.excluded))
+
+def _tighter(a, a_closed, b, b_closed, beyond):
+	""" Of two bounds (None being no bound), the one which admits less. """
+	if a is None: return b, b_closed
+	if b is None or beyond(a, b): return a, a_closed
+	if beyond(b, a): return b, b_closed
+	return a, a_closed and b_closed
 
 
 class Transform(NamedTuple):
@@ -70,34 +347,219 @@ class Transform(NamedTuple):
 	Describes the type of a function from points in one space to points in another.
 	In geometric applications these spaces be the same, but that's not my main idea.
 	I'm thinking more like "OrderID -> ShipCountry" or "Date -> Month".
+	
+	The last four fields are optional, and only make sense for single-axis attributes
+	(see `attribute`) where the range member depends only on the domain member:
+		lookup: a function from domain member to range member.
+		table: if the attribute was declared as a lookup-table (Mapping), then that table.
+		vectorized: a function from a whole (NumPy) column of domain members to the
+			corresponding column of range members.
+		inverse: a function from a range member to the collection of domain members
+			which map to it. With this, criteria on the range can become criteria on
+			the domain, which indexed sources can serve directly. For a lookup-table,
+			this is an index built from the table once, on first use (see `inverse_index`).
 	"""
 	domain: Space
 	range: Space
 	update: Callable[[Point], None]
+	lookup: Optional[Callable[[Any], Any]] = None
+	table: Optional[Mapping] = None
+	vectorized: Optional[Callable] = None
+	inverse: Optional[Callable[[Any], FrozenSet]] = None
+	
+	def for_query(self) -> "Transform":
+		"""
+		Return a version of this transform to use for the duration of one query.
+		If the attribute is computed by a plain function, the function gets called once
+		per distinct domain member (per query) rather than once per point.
+		"""
+		if self.lookup is None or self.table is not None: return self
+		(domain_,), (range_,) = self.domain, self.range
+		memo, lookup = {}, self.lookup
+		def memoized(member):
+			try: return memo[member]
+			except KeyError:
+				result = memo[member] = lookup(member)
+				return result
+		def update(p): p[range_] = memoized(p[domain_])
+		memoized.__wrapped__ = lookup
+		return self._replace(update=update, lookup=memoized)
+	
+	def key(self) -> Any:
+		""" Something which compares equal for this transform and its `for_query` versions. """
+		if self.lookup is None: return self.domain, self.range, self.update
+		return self.domain, self.range, getattr(self.lookup, '__wrapped__', self.lookup)
+
+
+def attribute(domain_:str, range_:str, mapping, vectorized:Callable=None, inverse:Callable=None) -> Transform:
+	"""
+	Make a Transform for a single-axis attribute. The mapping may be a function
+	from domain member to range member, or else a lookup-table (a Mapping).
+	A lookup-table gets an inverse index for free (built on first use);
+	otherwise you may supply the inverse function yourself.
+	"""
+	if isinstance(mapping, Mapping):
+		lookup, table = mapping.__getitem__, mapping
+		if inverse is None: inverse = inverse_index(mapping)
+	else: lookup, table = mapping, None
+	def update(p): p[range_] = lookup(p[domain_])
+	return Transform(frozenset((domain_,)), frozenset((range_,)), update, lookup, table, vectorized, inverse)
+
+
+def inverse_index(table:Mapping) -> Callable[[Any], FrozenSet]:
+	"""
+	Return a function from range member to the set of keys which map there.
+	The index gets built from the table once, on first use, and never again: If you
+	mutate the table afterwards, the index goes stale. Register a fresh attribute instead.
+	"""
+	index = {}
+	def inverse(member) -> FrozenSet:
+		if not index and table:
+			for key, image in table.items(): index.setdefault(image, set()).add(key)
+		return frozenset(index.get(member, ()))
+	return inverse
+
+
+def compose(first:Transform, second:Transform) -> Transform:
+	""" One transform after another, as in `sum { a -> b; c -> d }` """
+	def update(p): first.update(p); second.update(p)
+	return Transform(first.domain | (second.domain - first.range), first.range | second.range, update)
 
 
 class TranslatedCriterion(AbstractCriterion):
 	"""
 	This would be used by Transformation nodes.
 
-	Still in KISS mode, this may result in a given translation being
-	performed more than once, but again for the moment the resource
-	to be optimized is programmer time (and brainpower), not cycles.
+	If the basis criterion looks only at the range of the transform (the usual case)
+	then the outcome depends only on the domain members, so it's computed once per
+	distinct domain key (per environment) on a scratch point. Otherwise, in KISS mode,
+	the transform updates the point itself and may thus be performed more than once.
 	"""
 	
 	def __init__(self, transform: Transform, basis: AbstractCriterion):
 		self.__transform = transform
 		self.__basis = basis
+		self.__schema = Schema.of(transform.domain) if basis.domain() <= transform.range else None
+		self.__memo, self.__environment = {}, None
 	
 	def test(self, point: Point, environment:Mapping) -> bool:
-		self.__transform.update(point)
-		return self.__basis.test(point, environment)
+		if self.__schema is None:
+			self.__transform.update(point)
+			return self.__basis.test(point, environment)
+		if environment is not self.__environment: self.__memo, self.__environment = {}, environment
+		key = self.__schema.key(point)
+		try: return self.__memo[key]
+		except KeyError:
+			scratch = self.__schema.point(key)
+			self.__transform.update(scratch)
+			result = self.__memo[key] = self.__basis.test(scratch, environment)
+			return result
 	
 	def domain(self) -> Space:
 		return self.__transform.domain
 	
 	def complement(self) -> AbstractCriterion:
 		return TranslatedCriterion(self.__transform, self.__basis.complement())
+	
+	def parameters(self) -> FrozenSet[str]:
+		return self.__basis.parameters()
+	
+	def key(self) -> Any:
+		return TranslatedCriterion, self.__transform.key(), self.__basis.key()
+	
+	def mask(self, batch:Batch, environment:Mapping):
+		from . import columnar
+		return self.__basis.mask(columnar.transformed(self.__transform, batch), environment)
+
+
+class Capabilities(NamedTuple):
+	"""
+	This is the "Tensor Service" side of the negotiation with the query planner.
+	
+	indexed: from axis name to the set of relation codes (e.g. 'EQ', 'LT') the source
+		can answer without a scan. A criterion is pushed down to the source only if it
+		has a single-axis domain and its `relop` attribute is among these.
+	sort_order: the axes (major to minor) along which the source yields points, if any.
+	cardinality: an estimate of the number of points in the source, if known.
+	"""
+	indexed: Mapping[str, FrozenSet[str]]
+	sort_order: Tuple[str, ...] = ()
+	cardinality: Optional[int] = None
+	
+	def serves(self, criterion:AbstractCriterion) -> bool:
+		domain = criterion.domain()
+		if len(domain) != 1: return False
+		axis, = domain
+		return getattr(criterion, 'relop', None) in self.indexed.get(axis, ())
+	
+	def split(self, predicate:"Predicate") -> Tuple["Predicate", "Predicate"]:
+		""" Return the pushed-down part and the residual part of a predicate. """
+		pushed, residual = [], []
+		for criterion in predicate:
+			(pushed if self.serves(criterion) else residual).append(criterion)
+		return Predicate(pushed), Predicate(residual)
+
+
+DEFAULT_SELECTIVITY = 1/3 # For criteria about which nothing better is known.
+
+class AxisStatistics(NamedTuple):
+	"""
+	What's known about the members of one axis within one tensor.
+	
+	distinct: the number of distinct members.
+	low, high: the least and greatest members, if the members are ordered.
+	boundaries: an equi-depth histogram: members splitting the rows into (roughly) equal
+		parts, from `low` through `high`. Empty if the members are not ordered.
+	"""
+	distinct: int
+	low: Any = None
+	high: Any = None
+	boundaries: Tuple = ()
+	
+	def equal(self, member) -> float:
+		""" Fraction of rows with the given member. (Zero if it's out of range.) """
+		if not self.distinct: return 0
+		try:
+			if self.boundaries and not (self.low <= member <= self.high): return 0
+		except TypeError: pass
+		return 1 / self.distinct
+	
+	def below(self, member, inclusive:bool) -> Optional[float]:
+		""" Fraction of rows less than (or with inclusive, not greater than) the member, if ordered. """
+		if not self.boundaries: return None
+		find = bisect.bisect_right if inclusive else bisect.bisect_left
+		try: i = find(self.boundaries, member)
+		except TypeError: return None
+		if i == 0: return 0
+		buckets = len(self.boundaries) - 1
+		if i > buckets: return 1
+		return (i - 0.5) / buckets
+	
+	def quantiles(self, count:int) -> list:
+		""" Members which split the rows into `count` parts of roughly equal size. """
+		if not self.boundaries or count < 2: return []
+		buckets = len(self.boundaries) - 1
+		cuts = [self.boundaries[round(i * buckets / count)] for i in range(1, count)]
+		return sorted(set(cuts))
+
+
+class TensorStatistics(NamedTuple):
+	""" Row count and per-axis statistics for one tensor. See `statistics` for how to collect them. """
+	rows: int
+	axes: Mapping[str, AxisStatistics]
+	
+	def filtered(self, predicate:"Predicate", environment:Optional[Mapping]=None) -> "TensorStatistics":
+		""" Estimated statistics after applying a predicate. Criteria are presumed independent. """
+		rows = self.rows * predicate.selectivity(self, environment)
+		axes = {axis: s._replace(distinct=min(s.distinct, math.ceil(rows))) for axis, s in self.axes.items()}
+		return TensorStatistics(math.ceil(rows), axes)
+	
+	def projected(self, space:Space) -> "TensorStatistics":
+		""" Estimated statistics after summing out all but the given axes. """
+		axes = {axis: self.axes[axis] for axis in space if axis in self.axes}
+		rows = self.rows
+		if len(axes) == len(space): rows = min(rows, math.prod(s.distinct for s in axes.values()))
+		return TensorStatistics(rows, axes)
 
 
 class Predicate:
@@ -108,6 +570,9 @@ class Predicate:
 	def __init__(self, criteria: Iterable[AbstractCriterion]):
 		self.__criteria = list(criteria)
 	
+	def __iter__(self): return iter(self.__criteria)
+	def __len__(self): return len(self.__criteria)
+	
 	def divmod(self, divisor: Space) -> Tuple["Predicate", "Predicate"]:
 		"""
 		This is in support of indexes. The idea is to skip loading blocks of data
@@ -124,15 +589,79 @@ class Predicate:
 	def test(self, point: Point, environment:Mapping) -> bool:
 		return all(criterion.test(point, environment) for criterion in self.__criteria)
 	
+	def mask(self, batch:Batch, environment:Mapping):
+		"""
+		Evaluate the predicate over a whole batch of points at once, giving a boolean array.
+		The batch must have at least one column, or else there's no telling how many rows it has.
+		"""
+		result = None
+		for criterion in self.__criteria:
+			m = criterion.mask(batch, environment)
+			result = m if result is None else result & m
+		if result is None:
+			from . import columnar
+			result = columnar.everything(batch)
+		return result
+	
+	def selectivity(self, statistics:TensorStatistics, environment:Optional[Mapping]=None) -> float:
+		return math.prod(c.selectivity(statistics, environment) for c in self.__criteria)
+	
 	def augmented(self, criterion:AbstractCriterion):
 		return Predicate(self.__criteria + [criterion])
 	
+	def normalized(self, environment:Mapping) -> Optional["Predicate"]:
+		"""
+		An equivalent predicate with fewer criteria, or None if nothing could satisfy it.
+		
+		Criteria which express a `Constraint` get grouped by axis. If the constraints on
+		some axis can't all hold at once (`productid < 10` along with `productid >= 10`,
+		say) then the whole predicate is empty. Otherwise, any criterion the rest of its
+		group already implies goes away: repeats, looser bounds, and so forth. (The
+		survivors are criteria from the original; nothing gets rewritten.) Other criteria
+		pass through untouched. This depends on the environment, so it's for stream time.
+		"""
+		groups: Dict[str, list] = {}
+		for position, criterion in enumerate(self.__criteria):
+			try: constraint = criterion.constraint(environment)
+			except (KeyError, TypeError): constraint = None
+			if constraint is not None:
+				axis, = criterion.domain()
+				groups.setdefault(axis, []).append((position, constraint))
+		redundant = set()
+		for group in groups.values():
+			try: implied = _implied(group)
+			except TypeError: continue # Members which don't compare; leave well enough alone.
+			if implied is None: return None
+			redundant.update(implied)
+		if not redundant: return self
+		return Predicate(c for i, c in enumerate(self.__criteria) if i not in redundant)
+	
 	def transformed(self, transform:Transform):
 		# TODO: This is very simplistic. A given transform might have a better way to
 		#  handle the problem. However, that's not important for a first version.
-		return Predicate([
-			TranslatedCriterion(transform, c) if transform.range & c.domain() else c
-			for c in self.__criteria
-		])
+		def translate(c:AbstractCriterion) -> AbstractCriterion:
+			if not (transform.range & c.domain()): return c
+			if transform.inverse is not None:
+				image = c.preimage(transform)
+				if image is not None: return image
+			return TranslatedCriterion(transform, c)
+		return Predicate(map(translate, self.__criteria))
 
 
+def _implied(group:list) -> Optional[list]:
+	"""
+	Given one axis's <position, constraint> pairs, the positions of criteria which the rest imply,
+	or None if they contradict. Of several equivalent criteria, the first survives.
+	"""
+	total = Constraint()
+	for _, constraint in group: total = total.intersection(constraint)
+	if total.is_empty(): return None
+	remaining, implied = list(group), []
+	for pair in reversed(group):
+		others = Constraint()
+		for other in remaining:
+			if other is not pair: others = others.intersection(other[1])
+		if others.implies(pair[1]):
+			remaining.remove(pair)
+			implied.append(pair[0])
+	return implied
@@ -0,0 +1,173 @@
+"""
+EXPLAIN and EXPLAIN ANALYZE: Show the tree of `runtime` nodes which the planner
+built for a query, with estimated rows and cost at each node. In analyze mode,
+also run the query and show what actually happened at each node: wall time,
+rows in and out, rows filtered, and the peak number of entries held in memory.
+
+The key tuning signal is the amount of data selected and then thrown away (or
+summed away). The rows in and out at each node show just where that happens.
+
+Analysis works by temporarily wrapping the `stream` and `batches` methods of each
+node in the plan with a meter. Times are inclusive of the node's operands, and only
+count time spent pulling points through the node. Analysis always runs serially and
+skips the query cache, so it measures the plan rather than the machinery around it.
+"""
+
+import time
+from typing import NamedTuple, Optional, Mapping, List, Dict
+from .domain import AbstractTensor, Predicate
+from . import runtime
+
+FILTERING = (runtime.Pushdown, runtime.Filter, runtime.Multiplex)
+PASSING = (runtime.Pushdown, runtime.Filter, runtime.ScaleTensor) # These just pass points along.
+
+
+class Node(NamedTuple):
+	"""
+	One line of the report.
+	estimate: the number of points the node should produce, if known.
+	cost: the estimated number of points produced throughout the subtree, if known.
+	The rest are measured, so they're None unless the query was analyzed.
+	calls: how many times the node was asked to stream. Some never are: for example,
+		the far side of an index join, or the fields under a fused scan.
+	filtered: points which arrived but didn't leave. (Only for filtering nodes and semijoins.)
+	peak: the most entries the node held at once. (Only for buffering nodes.)
+	"""
+	depth: int
+	tensor: AbstractTensor
+	label: str
+	estimate: Optional[int]
+	cost: Optional[int]
+	calls: Optional[int] = None
+	seconds: Optional[float] = None
+	rows_in: Optional[int] = None
+	rows_out: Optional[int] = None
+	filtered: Optional[int] = None
+	peak: Optional[int] = None
+
+	def __str__(self):
+		parts = ['rows=%s'%_number(self.estimate), 'cost=%s'%_number(self.cost)]
+		text = '  '*self.depth + '%s  (estimated %s)'%(self.label, ' '.join(parts))
+		if self.calls is None: return text
+		if not self.calls: return text + '  (never streamed)'
+		actual = ['time=%.3fms'%(self.seconds * 1000), 'out=%d'%self.rows_out]
+		if self.rows_in is not None: actual.insert(1, 'in=%d'%self.rows_in)
+		if self.filtered is not None: actual.append('filtered=%d'%self.filtered)
+		if self.peak is not None: actual.append('peak=%d'%self.peak)
+		return text + '  (actual %s)'%' '.join(actual)
+
+
+class Report(NamedTuple):
+	"""
+	The plan, one node per line, depth-first. With analyze, also the total wall
+	time of the query and the number of points in the final result.
+	"""
+	nodes: List[Node]
+	seconds: Optional[float] = None
+	result_size: Optional[int] = None
+
+	def __str__(self):
+		lines = [str(node) for node in self.nodes]
+		if self.seconds is not None:
+			lines.append('Total: %.3fms, %s points in the result.'%(self.seconds * 1000, _number(self.result_size)))
+		return '\n'.join(lines)
+
+
+def _number(n): return '?' if n is None else str(n)
+
+def label(tensor:AbstractTensor) -> str:
+	""" A short description of what the node does. """
+	name = type(tensor).__name__
+	space = '[%s]'%', '.join(sorted(tensor.tensor_type().space))
+	if isinstance(tensor, runtime.Filter): return 'Filter %s where %s'%(space, tensor.criterion)
+	if isinstance(tensor, runtime.Multiplex): return 'Multiplex %s if %s'%(space, tensor.criterion)
+	if isinstance(tensor, runtime.ElementwiseJoin): return '%s %s (%s)'%(name, space, tensor.join)
+	if isinstance(tensor, runtime.Transformation):
+		transform = tensor.transform
+		return 'Transformation {%s -> %s} by %s'%(', '.join(sorted(transform.domain)), ', '.join(sorted(transform.range)), space)
+	if isinstance(tensor, runtime.Aggregation): return 'Aggregation by %s'%space
+	if hasattr(tensor, 'field'): return '%s %s %r'%(name, space, tensor.field)
+	return '%s %s'%(name, space)
+
+
+def plan(tensor:AbstractTensor) -> List[Node]:
+	""" The estimated plan, depth-first. """
+	nodes = []
+	def visit(t:AbstractTensor, depth:int) -> Optional[int]:
+		at = len(nodes)
+		nodes.append(None)
+		estimate = t.cardinality()
+		costs = [visit(o, depth+1) for o in t.operands()]
+		if isinstance(t, runtime.FusedScan): costs = [] # The operands don't actually get streamed.
+		if isinstance(t, runtime.ElementwiseJoin) and t.join == 'index': costs = costs[:1] # Probes, not a scan.
+		own = 0 if isinstance(t, PASSING) else estimate
+		cost = None if own is None or None in costs else own + sum(costs)
+		nodes[at] = Node(depth, t, label(t), estimate, cost)
+		return cost
+	visit(tensor, 0)
+	return nodes
+
+
+class _Meter:
+	def __init__(self): self.calls, self.seconds, self.rows = 0, 0.0, 0
+
+	def wrap_stream(self, method):
+		def stream(predicate, environment):
+			self.calls += 1
+			clock, iterator = time.perf_counter, iter(method(predicate, environment))
+			while True:
+				start = clock()
+				try: item = next(iterator)
+				except StopIteration: return
+				finally: self.seconds += clock() - start
+				self.rows += 1
+				yield item
+		return stream
+
+	def wrap_batches(self, method):
+		def batches(predicate, environment, size=4096):
+			self.calls += 1
+			clock, iterator = time.perf_counter, iter(method(predicate, environment, size))
+			while True:
+				start = clock()
+				try: batch, values = next(iterator)
+				except StopIteration: return
+				finally: self.seconds += clock() - start
+				self.rows += len(values)
+				yield batch, values
+		return batches
+
+
+def analyze(tensor:AbstractTensor, environment:Mapping, buffer_class=runtime.TensorBuffer) -> Report:
+	""" Run the query with every node metered, and report. """
+	nodes = plan(tensor)
+	meters: Dict[int, _Meter] = {}
+	saved = {}
+	for node in nodes:
+		t = node.tensor
+		if id(t) in meters: continue
+		meter = meters[id(t)] = _Meter()
+		saved[id(t)] = t, {k:vars(t)[k] for k in ('stream', 'batches', 'peak') if k in vars(t)}
+		t.stream, t.batches = meter.wrap_stream(t.stream), meter.wrap_batches(t.batches)
+		if isinstance(t, runtime.Buffering): t.peak = 0
+	eliminated = {id(n.tensor): n.tensor.eliminated for n in nodes if isinstance(n.tensor, runtime.ElementwiseJoin)}
+	try:
+		start = time.perf_counter()
+		result = buffer_class(tensor, Predicate([]), environment)
+		seconds = time.perf_counter() - start
+		measured = []
+		for node in nodes:
+			t, meter = node.tensor, meters[id(node.tensor)]
+			leaf = not t.operands() or isinstance(t, runtime.FusedScan)
+			rows_in = None if leaf else sum(meters[id(o)].rows for o in t.operands())
+			filtered = None
+			if isinstance(t, FILTERING): filtered = rows_in - meter.rows
+			elif id(t) in eliminated: filtered = t.eliminated - eliminated[id(t)]
+			peak = t.peak if isinstance(t, runtime.Buffering) else None
+			measured.append(node._replace(calls=meter.calls, seconds=meter.seconds, rows_in=rows_in, rows_out=meter.rows, filtered=filtered, peak=peak))
+	finally:
+		for t, attributes in saved.values():
+			for k in ('stream', 'batches', 'peak'):
+				if k in attributes: setattr(t, k, attributes[k])
+				elif k in vars(t): delattr(t, k)
+	return Report(measured, seconds, len(result) if hasattr(result, '__len__') else None)
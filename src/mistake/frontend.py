@@ -1,13 +1,24 @@
-from typing import NamedTuple, Tuple, List, Optional
+from __future__ import annotations # So the Scanner annotations needn't import boozetools.
+from typing import NamedTuple, Tuple, List, Optional, TYPE_CHECKING
 from numbers import Number
 from functools import partial
-from boozetools.support import runtime as brt
-from boozetools.support.interfaces import Scanner
-from . import utility
+if TYPE_CHECKING: from boozetools.support.interfaces import Scanner
 
 Span = Tuple[int,int]
 
-TABLES = utility.tables(__file__, 'mistake_grammar.md')
+# The parse tables (and boozetools itself) load when the first Parser is made, not at import.
+_TABLES = None
+
+def tables() -> dict:
+	global _TABLES
+	if _TABLES is None:
+		from . import utility
+		_TABLES = utility.tables(__file__, 'mistake_grammar.md')
+	return _TABLES
+
+def __getattr__(name):
+	if name == 'TABLES': return tables()
+	raise AttributeError("module %r has no attribute %r"%(__name__, name))
 
 class Name(NamedTuple):
 	text: str
@@ -38,6 +49,21 @@ class ScalarComparison(NamedTuple):
 	relop: str
 	rhs: object
 
+class Within(NamedTuple):
+	""" Set membership, as in `axis in SET` or `axis not in SET`. The collection is an env_list Name, Enumeration, or Interval. """
+	axis: Name
+	collection: object
+	negate: bool = False
+
+class Enumeration(NamedTuple):
+	members: List[object]
+
+class Interval(NamedTuple):
+	lo: object
+	hi: object
+	lo_closed: bool
+	hi_closed: bool
+
 class Multiplex(NamedTuple):
 	if_true: object
 	keyword_span: Span
@@ -60,12 +86,20 @@ class SumImage(NamedTuple):
 	by_span:Optional[Span] = None
 	space: Optional[List[Name]] = None
 
-class Parser(brt.TypicalApplication):
+class Parser:
+	"""
+	The scanner and parser actions for the grammar in `mistake_grammar.md`.
+	Really this is a boozetools TypicalApplication, but boozetools gets mixed in
+	only on first instantiation (see `_application`) to keep imports quick.
+	"""
 	MONTHS = {m:n for n,m in enumerate('jan feb mar apr may jun jul aug sep oct nov dec'.split(),1)}
 	RESERVED_WORDS = frozenset('by else in is means not of space sum tensor week where'.split()) | MONTHS.keys()
 	
+	def __new__(cls):
+		return object.__new__(_application(cls))
+	
 	def __init__(self):
-		super(Parser, self).__init__(TABLES)
+		super(Parser, self).__init__(tables())
 		self.module = {}
 	
 	def scan_ignore(self, yy:Scanner, what):
@@ -124,6 +158,16 @@ class Parser(brt.TypicalApplication):
 	parse_quotient = staticmethod(partial(BinaryTensorOp, '/'))
 	
 	parse_criterion_relative = staticmethod(ScalarComparison)
+	parse_criterion_within = staticmethod(Within)
+	
+	@staticmethod
+	def parse_criterion_without(axis, collection): return Within(axis, collection, True)
+	
+	parse_enumeration = staticmethod(Enumeration)
+	parse_open_interval = staticmethod(partial(Interval, lo_closed=False, hi_closed=False))
+	parse_open_closed_interval = staticmethod(partial(Interval, lo_closed=False, hi_closed=True))
+	parse_closed_interval = staticmethod(partial(Interval, lo_closed=True, hi_closed=True))
+	parse_closed_open_interval = staticmethod(partial(Interval, lo_closed=True, hi_closed=False))
 	parse_filter = staticmethod(Filter)
 	parse_multiplex = staticmethod(Multiplex)
 	parse_mapping = staticmethod(MappingExpression)
@@ -140,3 +184,30 @@ class Parser(brt.TypicalApplication):
 	
 	parse_aggregate_by = staticmethod(Aggregation)
 	
+
+class StatementParser(Parser):
+	"""
+	For parsing a script a line at a time (see `planning.MistakeModule.reload`): Rather than
+	complain of syntax errors out of context, it sets `failed` so the caller can decide.
+	"""
+	failed = False
+	
+	def parse(self, text:str, **kwargs):
+		self.failed = False
+		return super().parse(text, **kwargs)
+	
+	def unexpected_token(self, kind, semantic, pds): self.failed = True
+	def unexpected_character(self, yy:Scanner): self.failed = True
+	def will_recover(self, tokens): pass
+	def did_not_recover(self): pass
+
+
+_APPLICATIONS = {}
+
+def _application(cls) -> type:
+	""" The class, with boozetools' TypicalApplication mixed in behind it. """
+	try: return _APPLICATIONS[cls]
+	except KeyError:
+		from boozetools.support import runtime as brt
+		result = _APPLICATIONS[cls] = type(cls.__name__, (cls, brt.TypicalApplication), {'__module__': cls.__module__})
+		return result
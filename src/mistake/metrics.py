@@ -0,0 +1,123 @@
+"""
+Always-on operational metrics: counters and summaries which the runtime reports as
+it goes, for export to a monitoring system.
+
+Metrics are off until you call `enable()`. While off, each report costs one function
+call and one test of a global, and reports happen per query or per scan, never per
+point, so the overhead is negligible. While on, the cost is a dictionary update.
+
+What gets reported:
+	mistake_queries_total{tensor}: queries, by tensor name.
+	mistake_execute_seconds{tensor}: time spent computing query results (not cache hits).
+	mistake_parse_seconds, mistake_plan_seconds: time spent loading scripts.
+	mistake_cache_requests_total{result}: query cache hits and misses.
+	mistake_buffer_points{buffer}: size of each buffer built, by kind of buffer.
+	mistake_buffer_spills_total: buffers that overran their budget and spilled to disk.
+	mistake_scan_rows_total{table}: rows examined by scans of each `sources.Table`.
+	mistake_semijoin_eliminated_total: points a semijoin's key set turned away.
+
+Summaries (the ones without _total) come out as a _sum and a _count, like Prometheus does.
+
+Worker processes of a `parallel.PartitionedExecutor` keep their own metrics, which die
+with them. The parent still reports the query, its time, and the buffer it merges into.
+"""
+
+import contextlib, os, tempfile, time
+from typing import Dict, Tuple, Optional, Callable
+
+REGISTRY: Optional["Registry"] = None
+
+
+class Registry:
+	""" A collection of named, labelled series of numbers. """
+
+	def __init__(self):
+		self.__series: Dict[Tuple[str, tuple], float] = {}
+		self.__kinds: Dict[str, str] = {}
+
+	def count(self, name:str, amount=1, **labels):
+		self.__add(name, 'counter', amount, labels)
+
+	def observe(self, name:str, value, **labels):
+		self.__add(name+'_sum', None, value, labels)
+		self.__add(name+'_count', None, 1, labels)
+		self.__kinds.setdefault(name, 'summary')
+
+	def __add(self, name:str, kind:Optional[str], amount, labels:dict):
+		key = name, tuple(sorted(labels.items()))
+		self.__series[key] = self.__series.get(key, 0) + amount
+		if kind is not None: self.__kinds.setdefault(name, kind)
+
+	def clear(self):
+		self.__series.clear()
+		self.__kinds.clear()
+
+	def snapshot(self) -> Dict[str, float]:
+		""" Every series at this moment, keyed in the style of Prometheus: `name{label="value",...}` """
+		return {_series_name(name, labels): value for (name, labels), value in sorted(self.__series.items())}
+
+	def prometheus(self) -> str:
+		""" The Prometheus text exposition format. """
+		lines = []
+		for family, kind in sorted(self.__kinds.items()):
+			lines.append('# TYPE %s %s'%(family, kind))
+			names = (family,) if kind == 'counter' else (family+'_sum', family+'_count')
+			for (name, labels), value in sorted(self.__series.items()):
+				if name in names: lines.append('%s %s'%(_series_name(name, labels), _number(value)))
+		return ''.join(line+'\n' for line in lines)
+
+	def write(self, path, exporter:Callable[["Registry"], str]=None):
+		"""
+		Export to a file, atomically, so a scraper (such as the node exporter's textfile
+		collector) never sees half a file. The exporter defaults to `prometheus`, but any
+		function from a registry to text will do.
+		"""
+		text = (exporter or Registry.prometheus)(self)
+		fd, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'w') as ofh: ofh.write(text)
+			os.replace(temporary, path)
+		except BaseException:
+			os.unlink(temporary)
+			raise
+
+
+def _series_name(name:str, labels:tuple) -> str:
+	if not labels: return name
+	def escape(value): return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+	return '%s{%s}'%(name, ','.join('%s="%s"'%(k, escape(v)) for k, v in labels))
+
+def _number(value) -> str:
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def enable(registry:Registry=None) -> Registry:
+	""" Start collecting, into the given registry or a fresh one. Returns the registry. """
+	global REGISTRY
+	REGISTRY = registry or Registry()
+	return REGISTRY
+
+def disable():
+	global REGISTRY
+	REGISTRY = None
+
+
+# The reporting side. These are what the rest of the package calls.
+
+def count(name:str, amount=1, **labels):
+	if REGISTRY is not None: REGISTRY.count(name, amount, **labels)
+
+def observe(name:str, value, **labels):
+	if REGISTRY is not None: REGISTRY.observe(name, value, **labels)
+
+_NOTHING = contextlib.nullcontext()
+
+def timed(name:str, **labels):
+	""" A context manager which observes how many seconds its body takes, under the given name. """
+	if REGISTRY is None: return _NOTHING
+	return _Timer(name, labels)
+
+class _Timer:
+	def __init__(self, name, labels): self.name, self.labels = name, labels
+	def __enter__(self): self.start = time.perf_counter()
+	def __exit__(self, *exc_info): observe(self.name, time.perf_counter() - self.start, **self.labels)
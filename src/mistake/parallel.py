@@ -0,0 +1,180 @@
+"""
+Partitioned map-reduce execution on a pool of worker processes.
+
+The idea is simple: Add one more criterion to the query's predicate, which selects
+one partition of the output space. Every operator respects the predicate already,
+so each worker computes just its share of the answer using the ordinary streaming
+operators. The partial results then get merged by summation, which the incremental
+semantics of points (see `runtime.SumTensor`) make perfectly legitimate.
+
+Plans are full of closures, which don't pickle. Therefore each executor forks its own
+pool of workers once it knows the plan, handing over the plans it knows by way of the
+pool's initializer, so the workers inherit them rather than receive them. Queries only
+send the environment and the number of a partition. The workers stay up for the next
+query on a plan they know. A plan they don't, or a change in the data under one they do,
+means forking a fresh pool. Where fork is unavailable, execution is serial.
+"""
+
+import multiprocessing, threading, zlib
+from typing import Any, Mapping, Optional, Sequence, List
+from .domain import AbstractTensor, AbstractCriterion, Predicate, Point, Batch, Space, TensorStatistics
+from . import runtime
+
+
+def stable_hash(member) -> int:
+	""" Unlike the built-in hash of a string, this agrees between processes. """
+	if isinstance(member, int): return member
+	if isinstance(member, str): return zlib.crc32(member.encode('utf-8'))
+	return zlib.crc32(repr(member).encode('utf-8'))
+
+
+class HashPartition(AbstractCriterion):
+	"""
+	Selects the points whose member on the given axis hashes to partition `index` of `count`.
+	The relop is 'HASH' (or 'NOT_HASH', negated) so that an index can serve it: A `sources.Table`
+	does so by hashing each distinct member of the axis, rather than testing each row.
+	"""
+	def __init__(self, dim:str, count:int, index:int, negate:bool=False):
+		self.dim, self.count, self.index, self.negate = dim, count, index, negate
+		self.relop = 'NOT_HASH' if negate else 'HASH'
+		self.__space = frozenset([dim])
+
+	def admits(self, member) -> bool:
+		return (stable_hash(member) % self.count == self.index) != self.negate
+
+	def test(self, point: Point, environment:Mapping) -> bool:
+		return self.admits(point[self.dim])
+
+	def mask(self, batch:Batch, environment:Mapping):
+		import numpy
+		column = batch[self.dim]
+		if numpy.issubdtype(column.dtype, numpy.integer): hashes = column
+		else: hashes = numpy.fromiter(map(stable_hash, column.tolist()), dtype=numpy.int64, count=len(column))
+		return (hashes % self.count == self.index) != self.negate
+
+	def domain(self) -> Space:
+		return self.__space
+
+	def complement(self) -> AbstractCriterion:
+		return HashPartition(self.dim, self.count, self.index, not self.negate)
+
+	def selectivity(self, statistics:TensorStatistics, environment:Mapping=None) -> float:
+		return 1 - 1 / self.count if self.negate else 1 / self.count
+
+	def __str__(self):
+		return "hash(%s) %% %d %s %d"%(self.dim, self.count, '<>' if self.negate else '=', self.index)
+
+	def key(self) -> Any:
+		return HashPartition, self.dim, self.count, self.index, self.negate
+
+
+JOBS = 32 # The most plans an executor's workers know at once. Past that, it starts afresh.
+
+_jobs = () # In a worker: the <plan, buffer_class, partitions> triples it was forked knowing.
+
+def _adopt(jobs:tuple):
+	""" The pool's initializer. Under fork, the jobs are inherited, not pickled. """
+	global _jobs
+	_jobs = jobs
+
+def _work(job:int, environment:Mapping, index:int) -> list:
+	plan, buffer_class, partitions = _jobs[job]
+	return list(buffer_class(plan, partitions[index], environment).content())
+
+
+class PartitionedExecutor:
+	"""
+	Give one of these to `MistakeModule` (as `executor`) to spread each query over several processes.
+
+	workers: how many processes. (Defaults to the number of CPUs.)
+	axis: which axis of the result to partition on. (Defaults to the first, alphabetically.)
+		A result with no axes at all just runs serially.
+	boundaries: if given, partition by ranges of the axis rather than by hash. The partitions are
+		everything below the first boundary, each interval between boundaries, and everything
+		from the last boundary up. Range criteria can be served by sorted indexes, so if your
+		sources have such an index on the axis, each worker scans only its own range.
+		Or, say 'auto' to draw boundaries from the plan's statistics (see `statistics`) so that
+		the ranges hold roughly equal numbers of rows. Without a histogram, it's back to hashing.
+
+	Either way, the partitioning splits the scan itself only where a source can serve the
+	partition criterion from an index: a sorted index for ranges, or any index on the axis
+	for hashing (see `sources.Table`). Otherwise every worker scans the whole source and
+	tests each row, so only the operators above the scan get spread across the workers.
+	So choose an indexed axis; the default (the first, alphabetically) may not be one.
+
+	The workers last until you `close` the executor (or leave its `with` block).
+	One query at a time gets the workers; others wait their turn. `forks` counts the pools started.
+	"""
+
+	def __init__(self, workers:int=None, *, axis:str=None, boundaries:Sequence=None):
+		self.workers = workers or multiprocessing.cpu_count()
+		self.axis = axis
+		self.boundaries = boundaries if boundaries in (None, 'auto') else sorted(boundaries)
+		self.forks = 0
+		self.__lock = threading.Lock()
+		self.__pool = None
+		self.__jobs = [] # <plan, buffer_class, partitions> triples, as the workers know them.
+		self.__numbers = {} # From <plan, buffer_class> to its position among the jobs.
+		self.__unwatch = []
+		self.__stale = False
+
+	def __enter__(self): return self
+	def __exit__(self, *exc_info): self.close()
+
+	def partitions(self, space:Space, statistics:TensorStatistics=None) -> Optional[List[Predicate]]:
+		if not space: return None
+		axis = self.axis or min(space)
+		if axis not in space: raise ValueError("Cannot partition on %r; the space is %r"%(axis, sorted(space)))
+		boundaries = self.boundaries
+		if boundaries == 'auto':
+			histogram = None if statistics is None else statistics.axes.get(axis)
+			boundaries = (histogram and histogram.quantiles(self.workers)) or None
+		if boundaries is None:
+			return [Predicate([HashPartition(axis, self.workers, i)]) for i in range(self.workers)]
+		def bound(relop, b): return runtime.ScalarComparison(axis, relop, runtime.Constant(b))
+		edges = [None] + list(boundaries) + [None]
+		return [
+			Predicate(([] if lo is None else [bound('GE', lo)]) + ([] if hi is None else [bound('LT', hi)]))
+			for lo, hi in zip(edges, edges[1:])
+		]
+
+	def execute(self, plan:AbstractTensor, environment:Mapping, buffer_class):
+		tt = plan.tensor_type()
+		try: context = multiprocessing.get_context('fork')
+		except ValueError: context = None
+		if not tt.space or context is None or self.workers < 2:
+			return buffer_class(plan, Predicate([]), environment)
+		with self.__lock:
+			job = self.__job(context, plan, buffer_class)
+			tasks = [(job, environment, index) for index in range(len(self.__jobs[job][2]))]
+			partials = self.__pool.starmap(_work, tasks)
+		merged = [pair for partial in partials for pair in partial]
+		return buffer_class(runtime.Literal(tt, merged), Predicate([]), environment)
+
+	def __job(self, context, plan:AbstractTensor, buffer_class) -> int:
+		""" The number by which the workers know this plan. If they don't, fork some that do. """
+		if self.__stale: self.__retire()
+		try: return self.__numbers[plan, buffer_class]
+		except KeyError: pass
+		if len(self.__jobs) >= JOBS: self.__retire()
+		partitions = self.partitions(plan.tensor_type().space, plan.statistics() if self.boundaries == 'auto' else None)
+		self.__unwatch.append(plan.watch(self.__changed))
+		job = self.__numbers[plan, buffer_class] = len(self.__jobs)
+		self.__jobs.append((plan, buffer_class, partitions))
+		if self.__pool is not None: self.__pool.terminate()
+		self.__pool = context.Pool(self.workers, _adopt, (tuple(self.__jobs),))
+		self.forks += 1
+		return job
+
+	def __changed(self, source:AbstractTensor):
+		# The workers have the data as it was when they forked. Fork afresh before the next query.
+		self.__stale = True
+
+	def __retire(self):
+		if self.__pool is not None: self.__pool.terminate()
+		for unwatch in self.__unwatch: unwatch()
+		self.__pool, self.__jobs, self.__numbers, self.__unwatch, self.__stale = None, [], {}, [], False
+
+	def close(self):
+		""" Let the workers go. The executor still works; it'll fork again when next asked. """
+		with self.__lock: self.__retire()
@@ -1,10 +1,10 @@
 """
 This is turning into the API submodule for
 """
-from typing import Callable, Iterable, Dict, Tuple, FrozenSet, Set, NamedTuple
+from typing import Callable, Iterable, Dict, Tuple, FrozenSet, Set, NamedTuple, Mapping
 import operator
 from boozetools.support import foundation
-from . import frontend, runtime, domain, semantics
+from . import frontend, runtime, domain, semantics, metrics
 
 __ALL__ = ['Universe', 'AlreadyRegistered']
 
@@ -14,6 +14,12 @@ class AlreadyRegistered(Exception):
 class UsageConflict(Exception):
 	""" The same-named query variable is used in conflicting ways. """
 
+class Definition(NamedTuple):
+	""" What a module remembers about each tensor defined in a script, so as to `reload` just what changed. """
+	shape: tuple # The definition's syntax tree, less source positions. (See `_shape`.)
+	references: FrozenSet[str] # The names it mentions.
+	variables: Mapping[str, Tuple[str, bool]] # The query variables it uses, as `cast_variable` hears of them.
+
 class MistakeModule:
 	"""
 	Think of this as like a schema for a database. A application has
@@ -24,14 +30,27 @@ class MistakeModule:
 	
 	__transforms: Dict[Tuple[FrozenSet, FrozenSet], domain.Transform]
 	__tensors: Dict[str, domain.AbstractTensor]
+	__definitions: Dict[str, Definition]
 	__variables: Dict[str, Tuple[str, bool]] # from variable name to (axis, plural)
 	__units: Set[str]
 	
-	def __init__(self, universe:semantics.UniverseOfDiscourse):
+	def __init__(self, universe:semantics.UniverseOfDiscourse, *, buffer_class=runtime.TensorBuffer, cache=None, executor=None, statistics=None):
 		assert isinstance(universe, semantics.UniverseOfDiscourse), type(universe)
 		self.__universe = universe
+		# Anything with the same constructor signature and `get`/`content` contract as
+		# `runtime.TensorBuffer` will do here. For example, `columnar.ColumnarBuffer`.
+		self.buffer_class = buffer_class
+		# Optionally, a `caching.QueryCache`. Cached results are shared, so please don't modify them.
+		self.cache = cache
+		# Optionally, a `parallel.PartitionedExecutor` to spread queries over several processes. Close it when done.
+		self.executor = executor
+		# Optionally, a `statistics.Catalog`. The planner consults it, so set it before loading scripts.
+		self.statistics = statistics
 		self.__transforms = {}
 		self.__tensors = {}
+		self.__definitions = {}
+		self.__lines = {} # Script lines, parsed, as of the last `reload`.
+		self.__pushdowns = {} # name -> <tensor, statistics, plan>; see `reference`.
 		self.__variables = {}
 	
 	def register_transform(self, transform:domain.Transform):
@@ -50,12 +69,19 @@ class MistakeModule:
 		if key in self.__transforms: raise AlreadyRegistered(key)
 		else: self.__transforms[key] = transform
 	
-	def register_attribute(self, domain_:str, range_:str, function):
+	def register_attribute(self, domain_:str, range_:str, function, vectorized=None, inverse=None):
+		"""
+		The function may be a plain function (which gets memoized per query) or
+		a lookup-table (any Mapping). Optionally, `vectorized` maps a NumPy column
+		of domain members to the corresponding column of range members all at once.
+		Lookup-tables publish their own inverse index, which lets criteria on the range
+		become criteria on the domain. (That index is built once; so don't mutate the table
+		after registering it.) For a plain function, you may supply `inverse`
+		as a function from range member to the collection of domain members.
+		"""
 		# This should really be an aspect of a dimension.
 		# Attribute access (or mapping) should probably have corresponding grammar.
-		def update(p): p[range_] = function(p[domain_])
-		transform = domain.Transform(frozenset((domain_,)), frozenset((range_,)), update)
-		self.register_transform(transform)
+		self.register_transform(domain.attribute(domain_, range_, function, vectorized, inverse))
 	
 	def register_tensor(self, name:str, tensor:domain.AbstractTensor):
 		if name != name.lower(): raise ValueError(name)
@@ -63,6 +89,11 @@ class MistakeModule:
 		assert isinstance(tensor, domain.AbstractTensor), type(tensor)
 		self.__tensors[name] = tensor
 	
+	def register_definition(self, name:str, tensor:domain.AbstractTensor, definition:Definition):
+		""" The planner registers tensors defined in scripts this way, so that `reload` can tell what changed. """
+		self.register_tensor(name, tensor)
+		self.__definitions[name] = definition
+	
 	def cast_variable(self, name:str, axis:str, plural:bool):
 		if name not in self.__variables: self.__variables[name] = (axis, plural)
 		elif self.__variables[name] != (axis, plural): raise UsageConflict(name)
@@ -77,19 +108,220 @@ class MistakeModule:
 	def get_tensor(self, name:str):
 		return self.__tensors[name]
 	
+	def reference(self, name:str) -> domain.AbstractTensor:
+		"""
+		The plan for a reference to a name. A source which declares its capabilities gets
+		only the criteria it can serve, and if the catalog knows about it, the planner gets
+		to know too: that takes a `runtime.Pushdown` over the tensor. Every reference to the
+		same tensor (with the same statistics) gets the same one, so `sharing` sees one node.
+		"""
+		tensor = self.__tensors[name]
+		statistics = None if self.statistics is None else self.statistics.get(name)
+		if isinstance(tensor, runtime.Pushdown) or (tensor.capabilities() is None and statistics is None): return tensor
+		try:
+			known, seen, plan = self.__pushdowns[name]
+			if known is tensor and seen is statistics: return plan
+		except KeyError: pass
+		plan = runtime.Pushdown(tensor, statistics)
+		self.__pushdowns[name] = tensor, statistics, plan
+		return plan
+	
+	def collect_statistics(self, names:Iterable[str]=None):
+		"""
+		Survey tensors (by default, every registered tensor which isn't defined in terms of
+		others) and every lookup-table attribute, into the statistics catalog. Makes a catalog
+		if there isn't one yet. Returns the catalog, which you may wish to save.
+		"""
+		from . import statistics
+		if self.statistics is None: self.statistics = statistics.Catalog()
+		if names is None: names = [name for name, tensor in self.__tensors.items() if not tensor.operands()]
+		for name in names: self.statistics.collect(name, self.get_tensor(name))
+		for transform in self.__transforms.values(): self.statistics.collect_transform(transform)
+		return self.statistics
+	
 	def query(self, name:str, /, **kwargs):
-		tensor = self.get_tensor(name.lower())
+		name = name.lower()
+		tensor = self.get_tensor(name)
+		metrics.count('mistake_queries_total', tensor=name)
 		# TODO: Validate that the correct environment variables are provided,
 		#  and with a value acceptable to the variable's inferred dimension.
-		return runtime.TensorBuffer(tensor, domain.Predicate([]), kwargs)
+		def compute():
+			with metrics.timed('mistake_execute_seconds', tensor=name):
+				if self.executor is None: return self.buffer_class(tensor, domain.Predicate([]), kwargs)
+				else: return self.executor.execute(tensor, kwargs, self.buffer_class)
+		if self.cache is None: return compute()
+		else: return self.cache.fetch(tensor, kwargs, compute)
+	
+	def query_stream(self, name:str, /, **kwargs) -> runtime.ResultStream:
+		"""
+		Like `query`, but the result comes out a piece at a time as it's computed, rather than
+		all at once in a buffer. See `runtime.ResultStream`. This skips the cache and the
+		executor, both of which deal in whole results.
+		"""
+		name = name.lower()
+		tensor = self.get_tensor(name)
+		metrics.count('mistake_queries_total', tensor=name)
+		return runtime.ResultStream(tensor, domain.Predicate([]), kwargs)
+	
+	def query_set(self, names:Iterable[str], /, **kwargs) -> Dict[str, object]:
+		"""
+		Query several tensors at once, in the same environment, for a dictionary from name to result.
+		Subexpressions they have in common (including the same name used twice within one
+		definition) get computed once for the lot, rather than once per reference. See `sharing`.
+		"""
+		from . import sharing
+		names = [name.lower() for name in names]
+		with sharing.Materialized(self.get_tensor(name) for name in names):
+			return {name: self.query(name, **kwargs) for name in names}
+
+	def explain(self, name:str, /, analyze:bool=False, **kwargs):
+		"""
+		Return a report (see `explain.Report`) of the plan for the named tensor, with estimated
+		rows and costs per node. Print it to read it. With `analyze=True`, also run the query
+		(serially, and without the cache) and report what actually happened at each node.
+		"""
+		from . import explain
+		tensor = self.get_tensor(name.lower())
+		if analyze: return explain.analyze(tensor, kwargs, self.buffer_class)
+		return explain.Report(explain.plan(tensor))
+	
+	def query_many(self, name:str, environments:Iterable[Mapping]) -> list:
+		"""
+		Same as calling `query` once per environment, but often cheaper: If the environments
+		differ only in one scalar variable, used only for equality on an axis which survives
+		into the result, then this computes the result for every binding in a single pass
+		and slices it up afterwards. Otherwise it falls back to one query per environment.
+		"""
+		environments = [dict(env) for env in environments]
+		tensor = self.get_tensor(name.lower())
+		if not environments: return []
+		common = environments[0]
+		varying = [v for v in sorted(tensor.parameters()) if any(env.get(v) != common.get(v) for env in environments)]
+		if not varying:
+			result = self.query(name, **common)
+			return [result] * len(environments)
+		if len(varying) == 1 and self.__sweepable(tensor, varying[0]):
+			return self.__sweep(tensor, varying[0], environments)
+		return [self.query(name, **env) for env in environments]
+	
+	def __sweepable(self, tensor:domain.AbstractTensor, variable:str) -> bool:
+		"""
+		The sweep slices the result by the variable's axis, so every point must come from
+		under an equality filter on that axis. In other words, every path down from the root to
+		a source must pass through one, and the axis must survive all the way back up.
+		"""
+		axis, plural = self.__variables[variable]
+		if plural: return False
+		def ok(node:domain.AbstractTensor, covered:bool) -> bool:
+			if variable in node.parameters():
+				if axis not in node.tensor_type().space: return False
+				if isinstance(node, runtime.Transformation) and axis in getattr(node.transform, 'range', (axis,)): return False
+				if isinstance(node, (runtime.Filter, runtime.Multiplex)) and variable in node.criterion.parameters():
+					c = node.criterion
+					if isinstance(node, runtime.Multiplex): return False # The complement won't slice.
+					if not (isinstance(c, runtime.ScalarComparison) and c.relop == 'EQ' and c.dim == axis): return False
+					covered = True
+			operands = node.operands()
+			if not operands: return covered
+			return all(ok(o, covered) for o in operands)
+		return ok(tensor, False)
+	
+	def __sweep(self, tensor:domain.AbstractTensor, variable:str, environments:list) -> list:
+		axis = self.__variables[variable][0]
+		environment = dict(environments[0])
+		environment[variable] = runtime.Sweep(env[variable] for env in environments)
+		slices = {}
+		for point, value in self.buffer_class(tensor, domain.Predicate([]), environment).content():
+			slices.setdefault(point[axis], []).append((point, value))
+		tt = tensor.tensor_type()
+		return [
+			self.buffer_class(runtime.Literal(tt, slices.get(env[variable], ())), domain.Predicate([]), env)
+			for env in environments
+		]
 
 	def script(self, text:str):
 		""" Call this to parse and load a script full of definitions. """
 		parser = frontend.Parser()
-		ast = parser.parse(text)
+		with metrics.timed('mistake_parse_seconds'): ast = parser.parse(text)
 		if ast is not None:
-			Planner(self, parser.source.complain).visit(ast)
+			with metrics.timed('mistake_plan_seconds'): Planner(self, parser.source.complain).visit(ast)
 		return self
+	
+	def reload(self, text:str):
+		"""
+		Bring the module up to date with an edited script. The text stands for everything
+		loaded by way of `script` (or `reload`) so far: definitions not in it go away.
+		
+		Only the definitions which changed (apart from whitespace, comments, and position)
+		get planned again, along with whatever depends on them, directly or otherwise.
+		Every other plan stays just as it was, and so do its cached results. Definitions
+		which had errors weren't kept in the first place, so you'll hear about them again.
+		"""
+		with metrics.timed('mistake_parse_seconds'): entries, source = self.__parse_lines(text)
+		if entries is None: return self
+		shapes, position = {}, {}
+		for statement, shape, offset in entries:
+			if shape is not None and statement.name.text not in shapes:
+				shapes[statement.name.text], position[statement.name.text] = shape, len(position)
+		def changed(name, definition):
+			# A reference to something defined further down is an error now, even if it wasn't before.
+			if shapes.get(name) != definition.shape: return True
+			return any(position.get(reference, -1) > position[name] for reference in definition.references)
+		dependents = {}
+		for name, definition in self.__definitions.items():
+			for reference in definition.references: dependents.setdefault(reference, []).append(name)
+		stale = [name for name, definition in self.__definitions.items() if changed(name, definition)]
+		seen = set(stale)
+		for name in stale:
+			for d in dependents.get(name, ()):
+				if d not in seen: seen.add(d); stale.append(d)
+		for name in stale:
+			del self.__definitions[name]
+			tensor = self.__tensors.pop(name)
+			self.__pushdowns.pop(name, None)
+			if self.cache is not None: self.cache.release(tensor)
+		self.__variables = {}
+		for definition in self.__definitions.values(): self.__variables.update(definition.variables)
+		keep = frozenset(self.__definitions)
+		# The planner looks no further than the name of a definition it keeps, so don't bother moving the rest.
+		ast = [
+			statement._replace(name=_moved(statement.name, offset)) if shape is not None and statement.name.text in keep
+			else _moved(statement, offset)
+			for statement, shape, offset in entries
+		]
+		with metrics.timed('mistake_plan_seconds'): Planner(self, source.complain, keep=keep).visit(ast)
+		return self
+	
+	def __parse_lines(self, text:str):
+		"""
+		Statements go one per line, so each line parses on its own, and a line seen last time
+		needn't be parsed again; its statements just move to where the line now sits.
+		Block comments may span lines, and syntax errors want reporting in context,
+		so either of those means parsing the whole text in the ordinary way.
+		Returns <statement, shape, offset> triples (see `_shape`) and the source text.
+		"""
+		from boozetools.support import failureprone
+		if '{-' in text: return self.__parse_whole(text)
+		fresh, entries, offset, parser = {}, [], 0, None
+		for line in text.split('\n'):
+			try: parsed = self.__lines[line]
+			except KeyError:
+				if parser is None: parser = frontend.StatementParser()
+				statements = parser.parse(line)
+				if parser.failed or statements is None: return self.__parse_whole(text)
+				parsed = [(statement, _definition_shape(statement)) for statement in statements]
+			fresh[line] = parsed
+			entries.extend((statement, shape, offset) for statement, shape in parsed)
+			offset += len(line) + 1
+		self.__lines = fresh
+		return entries, failureprone.SourceText(text)
+	
+	@staticmethod
+	def __parse_whole(text:str):
+		parser = frontend.Parser()
+		ast = parser.parse(text)
+		if ast is None: return None, parser.source
+		return [(statement, _definition_shape(statement), 0) for statement in ast], parser.source
 
 class Gripe(Exception):
 	""" The Planner raises this with target-language source diagnostic data. """
@@ -100,12 +332,36 @@ class BTOS(NamedTuple):
 	combine_space:Callable
 	combine_units:Callable
 	construct_plan:Callable
+	combine_rows:Callable # For fusing operations on fields of the same relation into one scan.
+
+PROBE_COST = 4 # Roughly how many scanned points one index probe is worth.
+
+def choose_join(lhs:domain.AbstractTensor, rhs:domain.AbstractTensor) -> str:
+	"""
+	Pick a strategy for an element-wise join (see `runtime.ElementwiseJoin`) based on
+	cardinality estimates and source capabilities. Absent any evidence, it's the classic plan.
+	"""
+	space = lhs.tensor_type().space
+	order = lhs.sort_order()
+	if order and order == rhs.sort_order() and set(order) == space: return 'merge'
+	n_left, n_right = lhs.cardinality(), rhs.cardinality()
+	selective = isinstance(lhs, runtime.Filter) # A `where` on the left only: Its keys can prune the right.
+	if n_left is None: return 'semijoin' if selective else 'build_right'
+	capabilities = rhs.capabilities()
+	probe = hasattr(rhs, 'get') and capabilities is not None and any('EQ' in ops for ops in capabilities.indexed.values())
+	if probe and (n_right is None or n_left * PROBE_COST < n_right): return 'index'
+	if selective or (n_right is not None and n_left < n_right): return 'semijoin'
+	return 'build_right'
+
+def _join(kind):
+	def construct_plan(lhs, rhs, tt): return kind(lhs, rhs, tt, choose_join(lhs, rhs))
+	return construct_plan
 
 STRATEGY = {
-	"+": BTOS(semantics.require_spatial_symmetry, operator.add, runtime.SumTensor),
-	"-": BTOS(semantics.require_spatial_symmetry, operator.sub, runtime.difference),
-	"*": BTOS(semantics.require_spatial_symmetry, operator.mul, runtime.Product),
-	"/": BTOS(semantics.require_spatial_symmetry, operator.truediv, runtime.Quotient),
+	"+": BTOS(semantics.require_spatial_symmetry, operator.add, runtime.SumTensor, runtime.fused_sum),
+	"-": BTOS(semantics.require_spatial_symmetry, operator.sub, runtime.difference, runtime.fused_difference),
+	"*": BTOS(semantics.require_spatial_symmetry, operator.mul, _join(runtime.Product), runtime.fused_product),
+	"/": BTOS(semantics.require_spatial_symmetry, operator.truediv, _join(runtime.Quotient), runtime.fused_quotient),
 }
 
 class Planner(foundation.Visitor):
@@ -117,11 +373,14 @@ class Planner(foundation.Visitor):
 	otherwise, then localizing the inconsistencies for easy
 	diagnosis and repair.
 	"""
-	def __init__(self, universe:MistakeModule, complain:Callable, verbose=False):
+	def __init__(self, universe:MistakeModule, complain:Callable, verbose=False, *, keep:FrozenSet[str]=frozenset()):
 		self.__universe = universe
 		self.__complain = complain
 		self.__verbose = verbose
-		self.__type_env = universe.tensor_types()
+		# Definitions to keep as already planned (see `MistakeModule.reload`) come into scope as they're reached.
+		self.__keep = keep
+		self.__type_env = {name:tt for name, tt in universe.tensor_types().items() if name not in keep}
+		self.__references, self.__variables = set(), {}
 		
 	def visit_list(self, items):
 		for i in items: self.visit(i)
@@ -129,14 +388,18 @@ class Planner(foundation.Visitor):
 	def visit_DefineTensor(self, dt:frontend.DefineTensor):
 		if dt.name.text in self.__type_env:
 			self.__complain(*dt.name.span, message="Name was previously defined; ignoring redefinition.")
+		elif dt.name.text in self.__keep:
+			self.__type_env[dt.name.text] = self.__universe.get_tensor(dt.name.text).tensor_type()
 		else:
+			self.__references, self.__variables = set(), {}
 			try: tensor = self.visit(dt.expr)
 			except Gripe as e:
 				self.__complain(*dt.name.span, message="Tensor variable has invalid type, because...")
 				e.gripe(self.__complain)
 				tt = None
 			else:
-				self.__universe.register_tensor(dt.name.text, tensor) # Contains type assertion.
+				definition = Definition(_shape(dt.expr), frozenset(self.__references), self.__variables)
+				self.__universe.register_definition(dt.name.text, tensor, definition) # Contains type assertion.
 				tt = tensor.tensor_type()
 				if self.__verbose: print("%s has shape %r and units of '%s'"%(dt.name.text, sorted(tt.space), tt.unit))
 			self.__type_env[dt.name.text] = tt
@@ -150,7 +413,8 @@ class Planner(foundation.Visitor):
 			unit = strategy.combine_units(lt.unit, rt.unit)
 		except semantics.Invalid as e:
 			raise Gripe(d.span, e.message)
-		return strategy.construct_plan(lhs, rhs, semantics.TensorType(space, unit))
+		tt = semantics.TensorType(space, unit)
+		return runtime.fuse(strategy.combine_rows, lhs, rhs, tt) or strategy.construct_plan(lhs, rhs, tt)
 	
 	def visit_Multiplex(self, m:frontend.Multiplex):
 		if_true, if_false = self.visit(m.if_true), self.visit(m.if_false)
@@ -165,15 +429,30 @@ class Planner(foundation.Visitor):
 	def visit_ScalarComparison(self, c:frontend.ScalarComparison, tt:semantics.TensorType) -> runtime.ScalarComparison:
 		assert isinstance(tt, semantics.TensorType), type(tt)
 		if c.axis.text not in tt.space: _unavailable(c.axis, tt.space)
-		if isinstance(c.rhs, frontend.Name):
-			try: self.__universe.cast_variable(c.rhs.text, c.axis.text, False)
-			except UsageConflict: _conflict(c.rhs)
-			scalar = runtime.Variable(c.rhs.text)
-		elif isinstance(c.rhs, (str,int,float)):
-			# TODO: Compare the argument and the relation to the type of the dimension.
-			scalar = runtime.Constant(c.rhs)
-		else: assert False, type(c.rhs)
-		return runtime.ScalarComparison(c.axis.text, c.relop, scalar)
+		return runtime.ScalarComparison(c.axis.text, c.relop, self.__scalar(c.axis, c.rhs))
+	
+	def visit_Within(self, c:frontend.Within, tt:semantics.TensorType) -> domain.AbstractCriterion:
+		assert isinstance(tt, semantics.TensorType), type(tt)
+		if c.axis.text not in tt.space: _unavailable(c.axis, tt.space)
+		collection = c.collection
+		if isinstance(collection, frontend.Interval):
+			lo, hi = self.__scalar(c.axis, collection.lo), self.__scalar(c.axis, collection.hi)
+			return runtime.Interval(c.axis.text, lo, hi, collection.lo_closed, collection.hi_closed, c.negate)
+		if isinstance(collection, frontend.Enumeration):
+			members = runtime.Members([self.__scalar(c.axis, m) for m in collection.members])
+		else: members = self.__scalar(c.axis, collection, plural=True)
+		return runtime.Membership(c.axis.text, members, c.negate)
+	
+	def __scalar(self, axis:frontend.Name, rhs, plural:bool=False) -> runtime.Value:
+		""" A constant, or else an environment variable (which may be a list) compared along the axis. """
+		if isinstance(rhs, frontend.Name):
+			try: self.__universe.cast_variable(rhs.text, axis.text, plural)
+			except UsageConflict: _conflict(rhs)
+			self.__variables[rhs.text] = (axis.text, plural)
+			return runtime.Variable(rhs.text)
+		# TODO: Compare the argument and the relation to the type of the dimension.
+		assert isinstance(rhs, (str,int,float)), type(rhs)
+		return runtime.Constant(rhs)
 	
 	def visit_Aggregation(self, agg:frontend.Aggregation):
 		basis = self.visit(agg.a_exp)
@@ -190,10 +469,10 @@ class Planner(foundation.Visitor):
 		return runtime.Aggregation(basis, new_space)
 	
 	def visit_Name(self, n:frontend.Name) -> domain.AbstractTensor:
-		try: return self.__universe.get_tensor(n.text)
-		except KeyError:
-			if n.text in self.__type_env: raise Gripe(n.span, "ill-typed name.")
-			else: raise Gripe(n.span, "undefined name.")
+		self.__references.add(n.text)
+		if n.text not in self.__type_env: raise Gripe(n.span, "undefined name.")
+		try: return self.__universe.reference(n.text)
+		except KeyError: raise Gripe(n.span, "ill-typed name.")
 	
 	def visit_ScaleBy(self, s:frontend.ScaleBy):
 		return self.visit(s.a_exp)
@@ -205,6 +484,7 @@ class Planner(foundation.Visitor):
 		assert isinstance(basis, domain.AbstractTensor), type(basis)
 		effective_space = set(basis.tensor_type().space)
 		procedure = None
+		catalog, range_statistics = self.__universe.statistics, {}
 		for mx in si.sums:
 			# First, apply a simple textual test:
 			for dim in mx.domain:
@@ -218,6 +498,7 @@ class Planner(foundation.Visitor):
 			step = self.__universe.find_transform(texts(mx.domain), texts(mx.range))
 			if step is None: raise Gripe(mx.op_span, "No known transform applies.")
 			procedure = _sequence(procedure, step)
+			if catalog is not None: range_statistics.update(catalog.transform(step.domain, step.range) or {})
 		# Last step: Consider any explicit aggregation. (See also visit_Aggregation.)
 		if si.space is not None:
 			new_space = set()
@@ -226,7 +507,7 @@ class Planner(foundation.Visitor):
 				if dim.text not in effective_space: _unavailable(dim, effective_space)
 				new_space.add(dim.text)
 			effective_space = new_space
-		return runtime.Transformation(basis, frozenset(effective_space), procedure)
+		return runtime.Transformation(basis, frozenset(effective_space), procedure, range_statistics)
 
 def _unavailable(dim:frontend.Name, ops:Iterable[str]):
 	raise Gripe(dim.span, "Dimension %r is not available here. options are %r." % (dim.text, sorted(ops)))
@@ -234,10 +515,29 @@ def _unavailable(dim:frontend.Name, ops:Iterable[str]):
 def _already(dim:frontend.Name):
 	raise Gripe(dim.span, "Dimension %r is already present and may not be duplicated." % dim.text)
 
+def _shape(node):
+	""" A syntax tree less its source positions, so that moving a definition about doesn't count as changing it. """
+	if isinstance(node, tuple) and hasattr(node, '_fields'):
+		return (type(node).__name__,) + tuple(_shape(getattr(node, f)) for f in node._fields if not f.endswith('span'))
+	if isinstance(node, list): return tuple(map(_shape, node))
+	return node
+
+def _definition_shape(statement):
+	return _shape(statement.expr) if isinstance(statement, frontend.DefineTensor) else None
+
+def _moved(node, offset:int):
+	""" A syntax tree with all its source positions moved along by the offset. """
+	if isinstance(node, tuple) and hasattr(node, '_fields'):
+		return node._make(
+			(value[0] + offset, value[1]) if f.endswith('span') and value is not None else _moved(value, offset)
+			for f, value in zip(node._fields, node)
+		)
+	if isinstance(node, list): return [_moved(item, offset) for item in node]
+	return node
+
 def _sequence(procedure, step):
 	if procedure is None: return step
-	def two_step(p): procedure(p); step(p)
-	return two_step
+	return domain.compose(procedure, step)
 
 def _conflict(var:frontend.Name):
 	raise Gripe(var.span, "Variable %r is used earlier in an incompatible manner. (It must agree in dimension and grammatical number.)" % var.text)
@@ -13,10 +13,11 @@ apply to an object depending on what phase that object is in. I'm happier to be
 to completely throw away the AST once it's no longer necessary. Objects defined in this
 file are a bit closer to the metal. Semantic soundness has already been checked. Etc.
 """
-import operator
-from typing import Generator, Callable, NamedTuple, Any, Mapping
-from .domain import Space, Point, AbstractTensor, Transform, AbstractCriterion, Predicate
-from . import semantics
+import operator, itertools
+from typing import Generator, Callable, NamedTuple, Any, Mapping, FrozenSet, Tuple, Optional
+from .domain import Space, Point, Batch, Schema, AbstractTensor, AbstractRelation, Transform, AbstractCriterion, Predicate
+from .domain import TensorStatistics, AxisStatistics, Constraint, DEFAULT_SELECTIVITY
+from . import semantics, metrics
 
 class TensorBuffer:
 	"""
@@ -25,37 +26,134 @@ class TensorBuffer:
 	involved in things that look more like "reduce", whereas the AbstractTensor
 	hierarchy has the "map" role.
 	
-	For now this bit remains somewhat simplistic.
+	For now this bit remains somewhat simplistic, with one concession to size:
+	Given a budget (a number of entries) the buffer spills to disk once it has more
+	distinct points than that, and carries on from there (see `spilling`). Either say
+	`budget=` or set BUFFER_BUDGET to cover every buffer, including the build side of joins.
+	To give just the query results a budget, `MistakeModule(buffer_class=functools.partial(
+	TensorBuffer, budget=...))` does the trick. A spilled buffer works the same, only slower.
 	"""
 	
-	def __init__(self, upstream:AbstractTensor, predicate:Predicate, environment:Mapping):
+	def __init__(self, upstream:AbstractTensor, predicate:Predicate, environment:Mapping, budget:int=None):
 		self.__upstream = upstream
-		self.__storage = {}
-		self.__schedule = tuple(upstream.tensor_type().space)
-		for point, value in self.__upstream.stream(predicate, environment):
-			key = self.__key(point)
-			self.__storage[key] = self.__storage.get(key, 0) + value
-
-	def __key(self, point:Point) -> tuple:
-		""" Find the (hashable) indexing information for the given point """
-		return tuple(point[k] for k in self.__schedule)
+		self.__schema = schema = Schema.of(upstream.tensor_type().space)
+		self.__spill = None
+		if budget is None: budget = BUFFER_BUDGET
+		stream = self.__upstream.stream(predicate, environment)
+		if budget is None: self.__storage = _sums(stream, schema)
+		else: self.__storage = self.__bounded_sums(stream, budget)
+		metrics.observe('mistake_buffer_points', len(self), buffer='dict' if self.__spill is None else 'spill')
+	
+	def __bounded_sums(self, stream, budget:int) -> dict:
+		table = {}
+		key_of, get = self.__schema.key, table.get
+		stream = iter(stream)
+		for p, v in stream:
+			key = key_of(p)
+			table[key] = get(key, 0) + v
+			if len(table) > budget:
+				from . import spilling
+				metrics.count('mistake_buffer_spills_total')
+				self.__spill = spilling.Spill(table, ((key_of(p), v) for p, v in stream), budget)
+				return {}
+		return table
+	
+	@property
+	def spilled(self) -> bool: return self.__spill is not None
+	
+	@property
+	def table(self) -> Optional[dict]:
+		""" The summed values by schema key (see `Schema`), or None once they've spilled to disk. """
+		return self.__storage if self.__spill is None else None
 	
 	def get(self, point:Point):
 		""" Return the value associated with a given point """
-		return self.__storage.get(self.__key(point), 0)
+		if self.__spill is not None: return self.__spill.get(self.__schema.key(point), 0)
+		return self.__storage.get(self.__schema.key(point), 0)
+	
+	def probe(self, stream) -> Generator:
+		"""
+		Look up many points at once: For each <point, value> in the stream, yield <point, value, entry>.
+		It's the same as calling `get` on each point, except that a spilled buffer reads each
+		of its partitions once rather than as the points happen to demand them.
+		"""
+		key_of = self.__schema.key
+		if self.__spill is not None: yield from self.__spill.probe(stream, key_of)
+		else:
+			get = self.__storage.get
+			for p, v in stream: yield p, v, get(key_of(p), 0)
 	
 	def content(self) -> Generator:
 		""" Yield up all the <point, value> pairs in the buffer. """
-		for key, value in self.__storage.items():
-			yield dict(zip(self.__schedule, key)), value
+		point = self.__schema.point
+		items = self.__storage.items() if self.__spill is None else self.__spill.items()
+		for key, value in items: yield point(key), value
+	
+	def __len__(self):
+		""" The number of distinct points in the buffer. """
+		return len(self.__storage) if self.__spill is None else self.__spill.size
+	
+BUFFER_BUDGET = None # Default budget (in distinct points) for every TensorBuffer. None means no limit.
+
+class ResultStream:
+	"""
+	The alternative to a TensorBuffer when you'd rather not hold the whole result at once:
+	The plan runs only as fast as you consume its output, so the first points arrive as
+	soon as the sources produce them, and memory stays bounded by whatever the operators
+	of the plan themselves buffer (the build side of a join, say) rather than the result.
+	
+	Iterate for <point, value> pairs, or over `chunks(size)` for lists of at most that many.
+	Points are incremental, so the same point may come out more than once (from a `+`,
+	or from an aggregation whose combiner filled up); add them up if that matters to you.
+	Call `close` (or use a `with` block) to stop early: the sources stop right away.
+	"""
+	
+	def __init__(self, upstream:AbstractTensor, predicate:Predicate, environment:Mapping):
+		self.__tensor_type = upstream.tensor_type()
+		self.__stream = iter(upstream.stream(predicate, environment))
+		self.count = 0 # Pairs delivered so far.
+	
+	def tensor_type(self) -> semantics.TensorType: return self.__tensor_type
+	
+	def __iter__(self): return self
+	
+	def __next__(self):
+		pair = next(self.__stream)
+		self.count += 1
+		return pair
+	
+	def chunks(self, size:int=4096) -> Generator:
+		while True:
+			chunk = list(itertools.islice(self.__stream, size))
+			if not chunk: return
+			self.count += len(chunk)
+			yield chunk
+	
+	def close(self):
+		close = getattr(self.__stream, 'close', None)
+		if close is not None: close()
+	
+	def __enter__(self): return self
+	def __exit__(self, *exc_info): self.close()
 	
 
+class Buffering:
+	"""
+	Mix-in for operators which hold some of their input in memory while streaming.
+	They note the size (in entries) of what they hold; `peak` is the most so far.
+	This is how EXPLAIN ANALYZE (see `explain`) reports memory per node.
+	"""
+	peak = 0
+	def note_peak(self, size:int):
+		if size > self.peak: self.peak = size
+
 class BinaryTensorOperation(AbstractTensor):
 	def __init__(self, lhs:AbstractTensor, rhs:AbstractTensor, tt:semantics.TensorType):
 		self._lhs = lhs
 		self._rhs = rhs
 		self.__tt = tt
 	def tensor_type(self) -> semantics.TensorType: return self.__tt
+	def operands(self): return self._lhs, self._rhs
 
 class SumTensor(BinaryTensorOperation):
 	""" Simplest possible "work-flow" class """
@@ -64,6 +162,10 @@ class SumTensor(BinaryTensorOperation):
 		if hasattr(lhs, 'get') and hasattr(rhs, 'get'):
 			self.get = lambda point: lhs.get(point) + rhs.get(point)
 	
+	def cardinality(self):
+		a, b = self._lhs.cardinality(), self._rhs.cardinality()
+		return None if a is None or b is None else a + b
+	
 	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
 		# Note this could possibly yield increments to the same point twice. That's OK because
 		# points are incremental -- at least under the assumption that everything else is...
@@ -84,42 +186,450 @@ class ScaleTensor(AbstractTensor):
 	def tensor_type(self) -> semantics.TensorType:
 		return self.__basis.tensor_type()
 	
+	def operands(self): return self.__basis,
+	def sort_order(self): return self.__basis.sort_order()
+	def statistics(self): return self.__basis.statistics()
+	
 	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
 		for p, v in self.__basis.stream(predicate, environment):
 			yield p, v * self.__factor
 
-class Transformation(AbstractTensor):
-	def __init__(self, basis: AbstractTensor, effective_space:Space, transform:Transform):
+class Transformation(Buffering, AbstractTensor):
+	def __init__(self, basis: AbstractTensor, effective_space:Space, transform:Transform, range_statistics:Mapping[str, AxisStatistics]=None):
 		self.__basis = basis
 		self.__tensor_type = semantics.TensorType(effective_space, basis.tensor_type().unit)
 		self.__transform = transform
+		self.__range_statistics = range_statistics or {} # From a catalog, if the planner had one.
+	@property
+	def transform(self) -> Transform: return self.__transform
 	def tensor_type(self) -> semantics.TensorType: return self.__tensor_type
+	def operands(self): return self.__basis,
+	def statistics(self):
+		statistics = self.__basis.statistics()
+		if statistics is None: return None
+		axes = dict(statistics.axes)
+		axes.update(self.__range_statistics)
+		return TensorStatistics(statistics.rows, axes).projected(self.__tensor_type.space)
 	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
-		for p,v in self.__basis.stream(predicate.transformed(self.__transform), environment):
-			self.__transform.update(p)
-			yield p,v
+		transform = self.__transform.for_query()
+		def transformed():
+			for p,v in self.__basis.stream(predicate.transformed(transform), environment):
+				transform.update(p)
+				yield p,v
+		# The domain of the transform always drops out of the effective space, so this is an aggregation too.
+		return combine(transformed(), self.__tensor_type.space, note=self.note_peak)
+
+COMBINER_LIMIT = 1 << 16
 
-class Aggregation(AbstractTensor):
+def combine(stream, space:Space, limit:int=None, note:Callable[[int], None]=None) -> Generator:
+	"""
+	Project each point onto the given (smaller) space and pre-combine the values, after
+	the fashion of a map-side combiner in map-reduce. Downstream work and memory then go
+	with the size of the output space rather than the input. The hash table is bounded:
+	when it gets to `limit` entries, it gets flushed downstream and started over. That's
+	fine because points are incremental: the same point may be yielded more than once.
+	If given, `note` hears the size of the table at each flush.
+	"""
+	limit = limit or COMBINER_LIMIT
+	schema = Schema.of(space)
+	key_of, point_of = schema.key, schema.point
+	table = {}
+	get = table.get
+	for p, v in stream:
+		key = key_of(p)
+		table[key] = get(key, 0) + v
+		if len(table) >= limit:
+			if note is not None: note(len(table))
+			for key, v in table.items(): yield point_of(key), v
+			table.clear()
+	if note is not None: note(len(table))
+	for key, v in table.items(): yield point_of(key), v
+
+class Aggregation(Buffering, AbstractTensor):
 	def __init__(self, basis: AbstractTensor, effective_space: Space):
 		assert effective_space < basis.tensor_type().space
 		self.__basis = basis
 		self.__tensor_type = semantics.TensorType(effective_space, basis.tensor_type().unit)
 	def tensor_type(self) -> semantics.TensorType: return self.__tensor_type
+	def operands(self): return self.__basis,
+	def statistics(self):
+		statistics = self.__basis.statistics()
+		return None if statistics is None else statistics.projected(self.__tensor_type.space)
 	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
-		return self.__basis.stream(predicate, environment)
+		return combine(self.__basis.stream(predicate, environment), self.__tensor_type.space, note=self.note_peak)
+	def batches(self, predicate: Predicate, environment:Mapping, size:int=4096) -> Generator:
+		# Projection is just a matter of leaving out columns. Whoever consumes these will combine them.
+		space = self.__tensor_type.space
+		for batch, values in self.__basis.batches(predicate, environment, size):
+			yield {k:c for k,c in batch.items() if k in space}, values
 
-class Product(BinaryTensorOperation):
+class ElementwiseJoin(Buffering, BinaryTensorOperation):
+	"""
+	Common structure of `Product` and `Quotient`: For each point of the left-hand side,
+	combine its value with the right-hand side's value at the same point (zero if absent).
+	Subclasses say how, by way of `combine`, which may return None for "no point".
+	
+	There are several ways to line up the two sides; the planner picks one (see `JOINS`):
+		build_right: Buffer the right-hand side; stream the left against it. (The classic.)
+		build_left: Buffer the (smaller) left-hand side; stream the right against it,
+			keeping only the sums for points the left-hand side actually has.
+		merge: Both sides stream in the same order covering the whole space,
+			so walk them in lock-step with no buffer at all.
+		index: Stream the left-hand side and look up each point with the right's `get`.
+		semijoin: Like build_left, but also send the left-hand side's keys down into the
+			right-hand side's stream (see `KeySet`) so that non-matching points get dropped
+			at the source -- by way of its indexes, if it has any -- before anything is summed.
+	All of these give the same answer (up to the order and grouping of points).
+	
+	The semijoin keeps score: `passed` and `eliminated` count the right-hand points which
+	reached the key-set test and how many of them it turned away. (Points that an index
+	never fetched at all don't get counted; that's the cheapest kind of elimination.)
+	"""
+	def __init__(self, lhs:AbstractTensor, rhs:AbstractTensor, tt:semantics.TensorType, join:str='build_right'):
+		super().__init__(lhs, rhs, tt)
+		assert join in JOINS, join
+		self.join = join
+		self.passed = self.eliminated = 0
+		self._schema = Schema.of(tt.space)
+	
+	@staticmethod
+	def combine(v, d): raise NotImplementedError
+	
+	def statistics(self):
+		# Every point of the result is a point of the left-hand side.
+		return self._lhs.statistics()
+	
 	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
+		return JOINS[self.join](self, predicate, environment)
+	
+	def _build_right(self, predicate: Predicate, environment:Mapping) -> Generator:
+		denominator = TensorBuffer(self._rhs, predicate, environment)
+		self.note_peak(len(denominator))
+		for p, v, d in denominator.probe(self._lhs.stream(predicate, environment)):
+			r = self.combine(v, d)
+			if r is not None: yield p, r
+	
+	def _build_left(self, predicate: Predicate, environment:Mapping) -> Generator:
+		buffer = TensorBuffer(self._lhs, predicate, environment)
+		if buffer.spilled:
+			yield from self.__probed(buffer, predicate, environment)
+			return
+		numerator, denominator = buffer.table, {}
+		key_of = self._schema.key
+		for p, d in self._rhs.stream(predicate, environment):
+			key = key_of(p)
+			if key in numerator: denominator[key] = denominator.get(key, 0) + d
+		self.note_peak(len(numerator) + len(denominator))
+		yield from self.__combined(numerator, denominator)
+	
+	def _merge(self, predicate: Predicate, environment:Mapping) -> Generator:
+		order = self._lhs.sort_order()
+		right = _runs(self._rhs.stream(predicate, environment), order)
+		r_key, r_total = next(right, (None, 0))
+		for key, point, v in _runs_with_points(self._lhs.stream(predicate, environment), order):
+			while r_key is not None and r_key < key: r_key, r_total = next(right, (None, 0))
+			r = self.combine(v, r_total if r_key == key else 0)
+			if r is not None: yield point, r
+	
+	def _semijoin(self, predicate: Predicate, environment:Mapping) -> Generator:
+		schema = self._schema
+		buffer = TensorBuffer(self._lhs, predicate, environment)
+		if buffer.spilled:
+			yield from self.__probed(buffer, predicate, environment)
+			return
+		numerator = buffer.table
+		if not numerator: return
+		keys = KeySet(schema, frozenset(numerator), self)
+		before = self.eliminated
+		reduced = predicate.augmented(keys)
+		capabilities = self._rhs.capabilities()
+		if capabilities is not None:
+			for axis in schema.axes:
+				if 'IN' in capabilities.indexed.get(axis, ()):
+					reduced = reduced.augmented(Membership(axis, Constant(frozenset(map(schema.getter(axis), numerator)))))
+		denominator = _sums(self._rhs.stream(reduced, environment), schema)
+		self.note_peak(len(numerator) + len(denominator))
+		metrics.count('mistake_semijoin_eliminated_total', self.eliminated - before)
+		yield from self.__combined(numerator, denominator)
+	
+	def __probed(self, numerator:TensorBuffer, predicate: Predicate, environment:Mapping) -> Generator:
+		"""
+		When the left side overran its buffer's budget, a key set of it would be no help.
+		Buffer the right side too, and probe it with the left, partition by partition.
+		"""
 		denominator = TensorBuffer(self._rhs, predicate, environment)
+		self.note_peak(len(numerator) + len(denominator))
+		for p, v, d in denominator.probe(numerator.content()):
+			r = self.combine(v, d)
+			if r is not None: yield p, r
+	
+	def __combined(self, numerator:dict, denominator:dict) -> Generator:
+		combine, point = self.combine, self._schema.point
+		for key, v in numerator.items():
+			r = combine(v, denominator.get(key, 0))
+			if r is not None: yield point(key), r
+	
+	def _index(self, predicate: Predicate, environment:Mapping) -> Generator:
+		get = self._rhs.get
 		for p,v in self._lhs.stream(predicate, environment):
-			yield p, v * denominator.get(p)
+			r = self.combine(v, get(p))
+			if r is not None: yield p, r
+
+JOINS = {
+	'build_right': ElementwiseJoin._build_right,
+	'build_left': ElementwiseJoin._build_left,
+	'merge': ElementwiseJoin._merge,
+	'index': ElementwiseJoin._index,
+	'semijoin': ElementwiseJoin._semijoin,
+}
+
+class KeySet(AbstractCriterion):
+	"""
+	The semijoin's filter: Selects points whose key (according to the given `Schema`)
+	is among a fixed set. It reports to a score-keeper with `passed` and
+	`eliminated` attributes, if given one. No index serves this; it has no relop.
+	"""
+	def __init__(self, schema:Schema, keys:FrozenSet, score=None, negate:bool=False):
+		self.schema, self.keys, self.score, self.negate = schema, keys, score, negate
+		self.__space = frozenset(schema.axes)
+	
+	def test(self, point: Point, environment:Mapping) -> bool:
+		result = (self.schema.key(point) in self.keys) != self.negate
+		if self.score is not None:
+			if result: self.score.passed += 1
+			else: self.score.eliminated += 1
+		return result
+	
+	def domain(self) -> Space:
+		return self.__space
+	
+	def complement(self) -> AbstractCriterion:
+		return KeySet(self.schema, self.keys, None, not self.negate)
+	
+	def __str__(self): return "[%s] %s (%d keys)"%(', '.join(self.schema.axes), 'not in' if self.negate else 'in', len(self.keys))
+
+def _sums(stream, schema:Schema) -> dict:
+	""" Sum a stream into a table keyed according to the schema. """
+	table = {}
+	key_of, get = schema.key, table.get
+	for p, v in stream:
+		key = key_of(p)
+		table[key] = get(key, 0) + v
+	return table
+
+def _runs_with_points(stream, order:tuple) -> Generator:
+	""" Combine consecutive points with the same key (in the given order), yielding <key, point, total> """
+	key, point, total = None, None, 0
+	key_of = Schema.of(order).key
+	for p, v in stream:
+		k = key_of(p)
+		if k == key: total += v
+		else:
+			if point is not None: yield key, point, total
+			key, point, total = k, p, v
+	if point is not None: yield key, point, total
+
+def _runs(stream, order:tuple) -> Generator:
+	for key, point, total in _runs_with_points(stream, order): yield key, total
+
+class Product(ElementwiseJoin):
+	@staticmethod
+	def combine(v, d): return v * d
+
+class Quotient(ElementwiseJoin):
+	@staticmethod
+	def combine(v, d): return v/d if d else None
 
-class Quotient(BinaryTensorOperation):
+class FusedScan(AbstractTensor):
+	"""
+	An element-wise expression whose leaves are all fields of the same relation,
+	computed in a single scan of that relation. The planner builds these in place of
+	`SumTensor`, `Product` and friends whenever it can. Scans per query then depend
+	on the number of relations, not the number of references to them.
+	
+	The expression is a tree: Each leaf is a tensor drawn from the relation, and each
+	inner node is a tuple of (combine, left, right) where `combine` works on row values
+	with None meaning no point. This relies on each point appearing in at most one row,
+	which is what it means for the relation's key space to be a key.
+	
+	The whole tree gets compiled (on first use) into a single Python function of the row,
+	so there's one call per row no matter how big the expression. Where the relation
+	offers `batches` and every leaf offers `extract_column`, the tree also evaluates as
+	NumPy operations on whole columns.
+	"""
+	def __init__(self, relation:AbstractRelation, expression, tt:semantics.TensorType, operands=()):
+		self.__relation = relation
+		self.expression = expression
+		self.__kernel = None
+		self.__tt = tt
+		self.__operands = tuple(operands) # Not used for streaming, but part of the plan all the same.
+	
+	def tensor_type(self) -> semantics.TensorType: return self.__tt
+	def operands(self): return self.__operands
+	def sort_order(self): return self.__operands[0].sort_order() if self.__operands else ()
+	def statistics(self): return self.__operands[0].statistics() if self.__operands else None
+	def relation(self) -> AbstractRelation: return self.__relation
+	def extract(self, row) -> Any: return self.kernel()(row)
+	
+	def kernel(self) -> Callable[[Any], Any]:
+		if self.__kernel is None: self.__kernel = compile_kernel(self.expression)
+		return self.__kernel
+	
 	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
-		denominator = TensorBuffer(self._rhs, predicate, environment)
-		for p,v in self._lhs.stream(predicate, environment):
-			d = denominator.get(p)
-			if d: yield p, v/d
+		predicate = predicate.normalized(environment)
+		if predicate is None: return
+		kernel = self.kernel()
+		for point, row in self.__relation.scan(predicate, environment):
+			value = kernel(row)
+			if value is not None: yield point, value
+	
+	def batches(self, predicate: Predicate, environment:Mapping, size:int=4096) -> Generator:
+		predicate = predicate.normalized(environment)
+		if predicate is None: return iter(())
+		batches = self.__relation.batches(predicate, environment, size)
+		if batches is None: return super().batches(predicate, environment, size)
+		return self.__batches(batches)
+	
+	def __batches(self, batches) -> Generator:
+		for batch, rows in batches:
+			evaluated = evaluate_columns(self.expression, rows)
+			if evaluated is None:
+				# Some leaf can't do columns, so fall back on the compiled kernel row by row.
+				import numpy
+				kernel = self.kernel()
+				values = [kernel(row) for row in rows.tolist()]
+				present = numpy.array([v is not None for v in values], dtype=bool)
+				evaluated = numpy.array([0 if v is None else v for v in values], dtype=float), present
+			values, present = evaluated
+			if present is not None:
+				batch, values = {k:c[present] for k,c in batch.items()}, values[present]
+			yield batch, values
+
+def fuse(combine:Callable[[Any, Any], Any], lhs:AbstractTensor, rhs:AbstractTensor, tt:semantics.TensorType):
+	"""
+	Return a FusedScan for an element-wise operation if both operands draw from the same
+	relation, or else None. The `combine` function works on row values, where None means
+	no point. The functions below give the same answers the streaming operators would.
+	A FusedScan operand contributes its whole expression, so the result covers the
+	maximal element-wise subtree.
+	"""
+	relation = lhs.relation()
+	if relation is None or relation != rhs.relation(): return None
+	def expression(t): return t.expression if isinstance(t, FusedScan) else t
+	return FusedScan(relation, (combine, expression(lhs), expression(rhs)), tt, (lhs, rhs))
+
+def fused_sum(a, b):
+	if a is None: return b
+	if b is None: return a
+	return a + b
+
+def fused_difference(a, b):
+	if b is None: return a
+	if a is None: return -b
+	return a - b
+
+def fused_product(a, b):
+	# Like `Product`, an absent right-hand side counts as zero but an absent left-hand side means no point.
+	if a is None: return None
+	return 0 if b is None else a * b
+
+def fused_quotient(a, b):
+	if a is None or not b: return None
+	return a / b
+
+class Kernel(NamedTuple):
+	"""
+	How to compile one of the functions above: as a Python expression in `{a}` and `{b}`,
+	and as a function on NumPy columns. The column function takes and returns pairs of
+	<values, present>, where `present` is a boolean mask, or None to mean "all present".
+	"""
+	source: str
+	columns: Callable
+
+def _both(pa, pb):
+	if pa is None: return pb
+	if pb is None: return pa
+	return pa & pb
+
+def _either(pa, pb):
+	if pa is None or pb is None: return None
+	return pa | pb
+
+def _zeroed(v, p):
+	if p is None: return v
+	import numpy
+	return numpy.where(p, v, 0)
+
+def _quotient_columns(a, b):
+	import numpy
+	(va, pa), (vb, pb) = a, b
+	present = _both(_both(pa, pb), vb != 0)
+	return va / numpy.where(present, vb, 1), present
+
+KERNELS = {
+	fused_sum: Kernel("({b} if {a} is None else {a} if {b} is None else {a} + {b})",
+		lambda a, b: (_zeroed(*a) + _zeroed(*b), _either(a[1], b[1]))),
+	fused_difference: Kernel("({a} if {b} is None else -{b} if {a} is None else {a} - {b})",
+		lambda a, b: (_zeroed(*a) - _zeroed(*b), _either(a[1], b[1]))),
+	fused_product: Kernel("(None if {a} is None else 0 if {b} is None else {a} * {b})",
+		lambda a, b: (a[0] * _zeroed(*b), a[1])),
+	fused_quotient: Kernel("(None if {a} is None or not {b} else {a} / {b})", _quotient_columns),
+}
+
+def compile_kernel(expression) -> Callable[[Any], Any]:
+	"""
+	Turn an expression tree (see `FusedScan`) into one Python function of a row.
+	Each leaf or shared subexpression is computed once, however often it appears.
+	Combining functions without an entry in `KERNELS` still work; they just get called.
+	"""
+	bound, lines, names = {}, [], {}
+	def bind(thing) -> str:
+		name = 'f%d'%len(bound)
+		bound[name] = thing
+		return name
+	def emit(e) -> str:
+		if id(e) not in names:
+			if isinstance(e, AbstractTensor): code = '%s(row)'%bind(e.extract)
+			else:
+				combine, left, right = e
+				a, b = emit(left), emit(right)
+				kernel = KERNELS.get(combine)
+				code = '%s(%s, %s)'%(bind(combine), a, b) if kernel is None else kernel.source.format(a=a, b=b)
+			names[id(e)] = 'v%d'%len(lines)
+			lines.append('%s = %s'%(names[id(e)], code))
+		return names[id(e)]
+	result = emit(expression)
+	source = 'def kernel(row, %s):\n%s\treturn %s\n'%(
+		', '.join('%s=%s'%(name, name) for name in bound),
+		''.join('\t%s\n'%line for line in lines),
+		result,
+	)
+	namespace = dict(bound)
+	exec(source, namespace)
+	kernel = namespace['kernel']
+	kernel.source = source
+	return kernel
+
+def evaluate_columns(expression, rows):
+	"""
+	Evaluate an expression tree (see `FusedScan`) on whole columns at once.
+	Returns <values, present> as in `Kernel`, or None if any part of the tree can't.
+	"""
+	results = {}
+	def evaluate(e):
+		if id(e) in results: return results[id(e)]
+		if isinstance(e, AbstractTensor):
+			column = e.extract_column(rows)
+			result = None if column is None else (column, None)
+		else:
+			combine, left, right = e
+			kernel = KERNELS.get(combine)
+			a = None if kernel is None else evaluate(left)
+			b = None if a is None else evaluate(right)
+			result = None if b is None else kernel.columns(a, b)
+		results[id(e)] = result
+		return result
+	return evaluate(expression)
 
 class Multiplex(AbstractTensor):
 	def __init__(self, lhs:AbstractTensor, criterion:AbstractCriterion, rhs:AbstractTensor):
@@ -128,21 +638,108 @@ class Multiplex(AbstractTensor):
 		self.__criterion = criterion
 		self.__rhs = rhs
 	
+	@property
+	def criterion(self) -> AbstractCriterion: return self.__criterion
 	def tensor_type(self) -> semantics.TensorType: return self.__lhs.tensor_type()
+	def operands(self): return self.__lhs, self.__rhs
+	def parameters(self): return super().parameters() | self.__criterion.parameters()
+	
+	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
+		# A branch whose predicate contradicts itself never gets streamed at all.
+		for basis, criterion in (self.__lhs, self.__criterion), (self.__rhs, self.__criterion.complement()):
+			branch = predicate.augmented(criterion).normalized(environment)
+			if branch is not None: yield from basis.stream(branch, environment)
+
+class Pushdown(AbstractTensor):
+	"""
+	The planner puts one of these over each source tensor that declares capabilities.
+	It splits each predicate: The source sees only the part it claims to serve well,
+	and the residual gets tested here. That way the source neither has to re-test
+	everything nor guess about which parts of the predicate are its problem.
+	
+	Given statistics (from a catalog) this also keeps back criteria that would select
+	too much of the source to be worth an index probe. It also passes the statistics
+	along to the planner. Over a source without capabilities, that's all it does.
+	"""
+	def __init__(self, source:AbstractTensor, statistics:TensorStatistics=None):
+		self.__source = source
+		self.__capabilities = source.capabilities()
+		self.__statistics = statistics
+		assert self.__capabilities is not None or statistics is not None
+		if hasattr(source, 'get'): self.get = source.get
+	
+	def tensor_type(self) -> semantics.TensorType: return self.__source.tensor_type()
+	def operands(self): return self.__source,
+	def capabilities(self): return self.__capabilities
+	def statistics(self): return self.__statistics or self.__source.statistics()
+	def relation(self): return self.__source.relation()
+	def extract(self, row): return self.__source.extract(row)
+	def extract_column(self, rows): return self.__source.extract_column(rows)
+	
+	def split(self, predicate: Predicate, environment:Mapping) -> Tuple[Predicate, Predicate]:
+		if self.__capabilities is None: return predicate, Predicate([])
+		pushed, residual = self.__capabilities.split(predicate)
+		statistics = self.statistics()
+		if statistics is not None and len(pushed):
+			keep = [c for c in pushed if c.selectivity(statistics, environment) <= PUSHDOWN_LIMIT]
+			if len(keep) < len(pushed):
+				residual = Predicate(list(residual) + [c for c in pushed if c not in keep])
+				pushed = Predicate(keep)
+		return pushed, residual
 	
 	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
-		yield from self.__lhs.stream(predicate.augmented(self.__criterion), environment)
-		yield from self.__rhs.stream(predicate.augmented(self.__criterion.complement()), environment)
+		predicate = predicate.normalized(environment)
+		if predicate is None: return iter(()) # The source needn't bother.
+		pushed, residual = self.split(predicate, environment)
+		if not len(residual): return self.__source.stream(pushed, environment)
+		return (
+			(p, v) for p, v in self.__source.stream(pushed, environment)
+			if residual.test(p, environment)
+		)
+	
+	def batches(self, predicate: Predicate, environment:Mapping, size:int=4096) -> Generator:
+		predicate = predicate.normalized(environment)
+		if predicate is None: return
+		pushed, residual = self.split(predicate, environment)
+		for batch, values in self.__source.batches(pushed, environment, size):
+			if len(residual):
+				mask = residual.mask(batch, environment)
+				batch, values = {k:c[mask] for k,c in batch.items()}, values[mask]
+			yield batch, values
+
+PUSHDOWN_LIMIT = 0.5 # A criterion passing more than this fraction of a source is cheaper to test on a scan.
 
 class Filter(AbstractTensor):
 	def __init__(self, basis:AbstractTensor, criterion:AbstractCriterion):
 		self.__basis = basis
 		self.__criterion = criterion
 	
+	@property
+	def criterion(self) -> AbstractCriterion: return self.__criterion
 	def tensor_type(self) -> semantics.TensorType: return self.__basis.tensor_type()
+	def operands(self): return self.__basis,
+	def parameters(self): return super().parameters() | self.__criterion.parameters()
+	def sort_order(self): return self.__basis.sort_order()
+	def statistics(self):
+		statistics = self.__basis.statistics()
+		return None if statistics is None else statistics.filtered(Predicate([self.__criterion]))
 
 	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
-		yield from self.__basis.stream(predicate.augmented(self.__criterion), environment)
+		predicate = predicate.augmented(self.__criterion).normalized(environment)
+		if predicate is not None: yield from self.__basis.stream(predicate, environment)
+
+
+class Literal(AbstractTensor):
+	""" A tensor over a fixed collection of <point, value> pairs, such as a slice of some larger result. """
+	def __init__(self, tt:semantics.TensorType, pairs):
+		self.__tt = tt
+		self.__pairs = pairs
+	
+	def tensor_type(self) -> semantics.TensorType: return self.__tt
+	
+	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
+		for p, v in self.__pairs:
+			if predicate.test(p, environment): yield p, v
 
 
 ##############################################################################
@@ -151,17 +748,26 @@ class RelOp(NamedTuple):
 	relop: str
 	inverse: str
 	fn: Callable[[Any, Any], bool]
+	symbol: str
 
 RELOP_CATALOG = {
-	'LT' : RelOp('LT', 'GE', operator.lt),
-	'LE' : RelOp('LE', 'GT', operator.le),
-	'EQ' : RelOp('EQ', 'NE', operator.eq),
-	'NE' : RelOp('NE', 'EQ', operator.ne),
-	'GE' : RelOp('GE', 'LT', operator.ge),
-	'GT' : RelOp('GT', 'LE', operator.gt),
+	'LT' : RelOp('LT', 'GE', operator.lt, '<'),
+	'LE' : RelOp('LE', 'GT', operator.le, '<='),
+	'EQ' : RelOp('EQ', 'NE', operator.eq, '='),
+	'NE' : RelOp('NE', 'EQ', operator.ne, '<>'),
+	'GE' : RelOp('GE', 'LT', operator.ge, '>='),
+	'GT' : RelOp('GT', 'LE', operator.gt, '>'),
 }
 
 
+class Sweep(frozenset):
+	"""
+	Bind a scalar variable to one of these to mean "any of these members" in an
+	equality comparison. `MistakeModule.query_many` uses this to compute the answer
+	for several bindings of a variable in one pass, then slice it per binding.
+	"""
+
+
 class Value:
 	"""
 	We need an abstraction covering both constants and environmental variables.
@@ -169,6 +775,13 @@ class Value:
 	
 	def value(self, environment:Mapping) -> Any:
 		raise NotImplementedError(type(self))
+	
+	def parameters(self) -> FrozenSet[str]:
+		return frozenset()
+	
+	def key(self) -> Any:
+		""" As for `AbstractCriterion.key`: equal for values which mean the same thing. """
+		return self
 
 
 class ScalarComparison(AbstractCriterion):
@@ -189,18 +802,197 @@ class ScalarComparison(AbstractCriterion):
 		self.__fn = RELOP_CATALOG[relop].fn
 	
 	def test(self, point: Point, environment:Mapping) -> bool:
-		return self.__fn(point[self.dim], self.scalar.value(environment))
+		scalar = self.scalar.value(environment)
+		if isinstance(scalar, Sweep): return point[self.dim] in scalar
+		return self.__fn(point[self.dim], scalar)
+	
+	def mask(self, batch:Batch, environment:Mapping):
+		scalar = self.scalar.value(environment)
+		if isinstance(scalar, Sweep):
+			import numpy
+			return numpy.isin(batch[self.dim], list(scalar))
+		# The functions in the RELOP_CATALOG work element-wise on NumPy arrays already.
+		return self.__fn(batch[self.dim], scalar)
 	
 	def domain(self) -> Space:
 		return self.__space
 	
 	def complement(self) -> "AbstractCriterion":
 		return ScalarComparison(self.dim, RELOP_CATALOG[self.relop].inverse, self.scalar)
+	
+	def __str__(self): return "%s %s %s"%(self.dim, RELOP_CATALOG[self.relop].symbol, self.scalar)
+	
+	def key(self) -> Any: return ScalarComparison, self.dim, self.relop, self.scalar.key()
+	
+	def parameters(self) -> FrozenSet[str]:
+		return self.scalar.parameters()
+	
+	def selectivity(self, statistics:TensorStatistics, environment:Mapping=None) -> float:
+		axis = statistics.axes.get(self.dim)
+		if axis is None: return DEFAULT_SELECTIVITY
+		if environment is None and self.parameters():
+			# Planning time: The member is unknown, but equality still has a fair guess.
+			fraction = 1 / axis.distinct if axis.distinct else 0
+			if self.relop == 'EQ': return fraction
+			if self.relop == 'NE': return 1 - fraction
+			return DEFAULT_SELECTIVITY
+		scalar = self.scalar.value(environment or {})
+		if isinstance(scalar, Sweep): return min(1, sum(map(axis.equal, scalar)))
+		if self.relop in ('EQ', 'NE'):
+			fraction = axis.equal(scalar)
+			return fraction if self.relop == 'EQ' else 1 - fraction
+		inclusive = self.relop in ('LE', 'GT')
+		fraction = axis.below(scalar, inclusive)
+		if fraction is None: return DEFAULT_SELECTIVITY
+		return fraction if self.relop in ('LT', 'LE') else 1 - fraction
+	
+	def constraint(self, environment:Mapping) -> Constraint:
+		scalar = self.scalar.value(environment)
+		if isinstance(scalar, Sweep): return Constraint(members=scalar)
+		if self.relop == 'EQ': return Constraint(members=frozenset([scalar]))
+		if self.relop == 'NE': return Constraint(excluded=frozenset([scalar]))
+		if scalar is None: return None # None means "unbounded" to a Constraint.
+		if self.relop in ('LT', 'LE'): return Constraint(hi=scalar, hi_closed=self.relop == 'LE')
+		return Constraint(lo=scalar, lo_closed=self.relop == 'GE')
+	
+	def preimage(self, transform:Transform):
+		if self.relop in ('EQ', 'NE') and transform.range == self.__space and len(transform.domain) == 1:
+			dim, = transform.domain
+			return Membership(dim, Preimage(transform, self.scalar), self.relop == 'NE')
+
+class Membership(AbstractCriterion):
+	"""
+	Set-membership criterion: The point's member on the given axis is (or with negate, is not)
+	among the collection given by the value. Indexes may serve the positive form with one
+	probe per member; the relop is 'IN' or 'NOT_IN' accordingly.
+	"""
+	def __init__(self, dim:str, members:Value, negate:bool=False):
+		self.dim, self.members_value, self.negate = dim, members, negate
+		self.relop = 'NOT_IN' if negate else 'IN'
+		self.__space = frozenset([dim])
+		self.__environment, self.__members = None, None
+	
+	def members(self, environment:Mapping) -> FrozenSet:
+		if environment is not self.__environment:
+			self.__members = frozenset(self.members_value.value(environment))
+			self.__environment = environment
+		return self.__members
+	
+	def test(self, point: Point, environment:Mapping) -> bool:
+		return (point[self.dim] in self.members(environment)) != self.negate
+	
+	def mask(self, batch:Batch, environment:Mapping):
+		import numpy
+		return numpy.isin(batch[self.dim], list(self.members(environment)), invert=self.negate)
+	
+	def domain(self) -> Space:
+		return self.__space
+	
+	def complement(self) -> "AbstractCriterion":
+		return Membership(self.dim, self.members_value, not self.negate)
+	
+	def __str__(self): return "%s %s %s"%(self.dim, 'not in' if self.negate else 'in', self.members_value)
+	
+	def key(self) -> Any: return Membership, self.dim, self.negate, self.members_value.key()
+	
+	def selectivity(self, statistics:TensorStatistics, environment:Mapping=None) -> float:
+		axis = statistics.axes.get(self.dim)
+		if axis is None or (environment is None and self.parameters()): return DEFAULT_SELECTIVITY
+		fraction = min(1, sum(map(axis.equal, self.members(environment or {}))))
+		return 1 - fraction if self.negate else fraction
+	
+	def parameters(self) -> FrozenSet[str]:
+		return self.members_value.parameters()
+	
+	def constraint(self, environment:Mapping) -> Constraint:
+		members = self.members(environment)
+		return Constraint(excluded=members) if self.negate else Constraint(members=members)
+
+class Interval(AbstractCriterion):
+	"""
+	Range criterion: The point's member on the given axis lies between the bounds, each of
+	which may be open or closed. The complement (with negate) is a disjunction, so no index
+	will serve that; the relop is 'RANGE' or 'NOT_RANGE' accordingly. A sorted index
+	serves the positive form with one range scan.
+	"""
+	def __init__(self, dim:str, lo:Value, hi:Value, lo_closed:bool, hi_closed:bool, negate:bool=False):
+		self.dim, self.lo, self.hi, self.lo_closed, self.hi_closed, self.negate = dim, lo, hi, lo_closed, hi_closed, negate
+		self.relop = 'NOT_RANGE' if negate else 'RANGE'
+		self.__space = frozenset([dim])
+		self.__above = operator.ge if lo_closed else operator.gt
+		self.__below = operator.le if hi_closed else operator.lt
+	
+	def bounds(self, environment:Mapping) -> Tuple[Any, Any]:
+		return self.lo.value(environment), self.hi.value(environment)
+	
+	def test(self, point: Point, environment:Mapping) -> bool:
+		member = point[self.dim]
+		lo, hi = self.bounds(environment)
+		return (self.__above(member, lo) and self.__below(member, hi)) != self.negate
+	
+	def mask(self, batch:Batch, environment:Mapping):
+		column = batch[self.dim]
+		lo, hi = self.bounds(environment)
+		result = self.__above(column, lo) & self.__below(column, hi)
+		return ~result if self.negate else result
+	
+	def domain(self) -> Space:
+		return self.__space
+	
+	def complement(self) -> "AbstractCriterion":
+		return Interval(self.dim, self.lo, self.hi, self.lo_closed, self.hi_closed, not self.negate)
+	
+	def __str__(self):
+		return "%s %s %s%s, %s%s"%(self.dim, 'not in' if self.negate else 'in', '[' if self.lo_closed else '(', self.lo, self.hi, ']' if self.hi_closed else ')')
+	
+	def key(self) -> Any: return Interval, self.dim, self.lo.key(), self.hi.key(), self.lo_closed, self.hi_closed, self.negate
+	
+	def parameters(self) -> FrozenSet[str]:
+		return self.lo.parameters() | self.hi.parameters()
+	
+	def selectivity(self, statistics:TensorStatistics, environment:Mapping=None) -> float:
+		axis = statistics.axes.get(self.dim)
+		if axis is None or (environment is None and self.parameters()): return DEFAULT_SELECTIVITY
+		lo, hi = self.bounds(environment or {})
+		below_hi, below_lo = axis.below(hi, self.hi_closed), axis.below(lo, not self.lo_closed)
+		if below_hi is None or below_lo is None: return DEFAULT_SELECTIVITY
+		fraction = max(0, below_hi - below_lo)
+		return 1 - fraction if self.negate else fraction
+	
+	def constraint(self, environment:Mapping) -> Constraint:
+		lo, hi = self.bounds(environment)
+		if self.negate or lo is None or hi is None: return None # The complement is a disjunction.
+		return Constraint(lo, self.lo_closed, hi, self.hi_closed)
+
+class Preimage(Value):
+	""" The domain members which a transform maps onto a given (scalar or swept) range member """
+	def __init__(self, transform:Transform, scalar:Value):
+		self.__inverse, self.__scalar = transform.inverse, scalar
+	def value(self, environment:Mapping) -> Any:
+		member = self.__scalar.value(environment)
+		if isinstance(member, Sweep): return frozenset().union(*map(self.__inverse, member))
+		return self.__inverse(member)
+	def parameters(self) -> FrozenSet[str]: return self.__scalar.parameters()
+	def __str__(self): return "preimage(%s)"%self.__scalar
+	def key(self) -> Any: return Preimage, self.__inverse, self.__scalar.key()
+
+class Members(Value):
+	""" An enumerated set, such as `{1, 2, $three}`, with some of its members taken from the environment. """
+	def __init__(self, members:Tuple[Value, ...]): self.__members = tuple(members)
+	def value(self, environment:Mapping) -> Any: return frozenset(m.value(environment) for m in self.__members)
+	def parameters(self) -> FrozenSet[str]: return frozenset().union(*(m.parameters() for m in self.__members))
+	def __str__(self): return "{%s}"%', '.join(map(str, self.__members))
+	def key(self) -> Any: return Members, tuple(m.key() for m in self.__members)
 
 class Constant(Value):
 	def __init__(self, value:Any): self.__value = value
 	def value(self, environment:Mapping) -> Any: return self.__value
+	def __str__(self): return repr(self.__value)
+	def key(self) -> Any: return Constant, self.__value
 
 class Variable(Value):
 	def __init__(self, name:str): self.__name = name
 	def value(self, environment:Mapping) -> Any: return environment[self.__name]
+	def parameters(self) -> FrozenSet[str]: return frozenset([self.__name])
+	def __str__(self): return '$'+self.__name
+	def key(self) -> Any: return Variable, self.__name
@@ -0,0 +1,112 @@
+"""
+Evaluating several queries together, so that work they have in common gets done once.
+
+Definitions refer to one another by name, and a reference to a defined name gets that
+definition's plan. So `by_product is gross by [productid]`, `average_price is by_product / units`
+and `net is by_product - by_product * 0.1` all hang off one plan for `by_product`, which
+ordinary queries stream once per reference. A reference to a source gets the source, or else
+a `runtime.Pushdown` over it, and the module hands out the same one each time
+(see `planning.MistakeModule.reference`). The plans, taken together, form a graph.
+Any node with more than one consumer is a common subexpression. (Fields of one relation
+fuse into a single scan (see `runtime.FusedScan`) which never streams its operands,
+so there's nothing to share within one of those.)
+
+While a report runs, each common node serves its consumers from a buffer, computed on
+first demand. A consumer with the same criteria (or more) as some earlier demand gets
+the buffered points, filtered by the extra criteria; no need to compute them again.
+A consumer asking for something the buffer can't cover (a different selection, say)
+gets a buffer of its own. Criteria count as the same if their `key`s are equal, so
+`productid < 10` written in two places (or translated afresh through a transform) matches.
+
+This works by temporarily replacing the `stream` (and `batches`) of the common nodes,
+much as `explain.analyze` does for metering. The buffers last only as long as the report.
+"""
+
+import functools
+from typing import Dict, Iterable, List, Mapping
+from .domain import AbstractTensor, Predicate
+from . import runtime
+
+
+def consumers(plans:Iterable[AbstractTensor]) -> Dict[int, int]:
+	"""
+	For each node (by id) reachable from the given plans, how many consumers it has:
+	one per reference from a parent node, and one per appearance among the plans themselves.
+	"""
+	counts, seen = {}, set()
+	def visit(node:AbstractTensor):
+		counts[id(node)] = counts.get(id(node), 0) + 1
+		if id(node) in seen: return
+		seen.add(id(node))
+		# A fused scan computes its fields row by row; it never streams them.
+		if not isinstance(node, runtime.FusedScan):
+			for o in node.operands(): visit(o)
+	for plan in plans: visit(plan)
+	return counts
+
+def common(plans:Iterable[AbstractTensor]) -> List[AbstractTensor]:
+	""" The nodes with more than one consumer, in depth-first order. """
+	plans = list(plans)
+	counts, found, seen = consumers(plans), [], set()
+	def visit(node:AbstractTensor):
+		if id(node) in seen: return
+		seen.add(id(node))
+		if counts[id(node)] > 1: found.append(node)
+		if not isinstance(node, runtime.FusedScan):
+			for o in node.operands(): visit(o)
+	for plan in plans: visit(plan)
+	return found
+
+
+class Materialized:
+	"""
+	A context manager: Within it, the common nodes of the given plans buffer their results
+	(see the module docstring). `built` counts the buffers made; `served` counts the demands
+	answered from an existing buffer.
+	"""
+
+	def __init__(self, plans:Iterable[AbstractTensor]):
+		self.nodes = common(plans)
+		self.built = self.served = 0
+		self.__saved = []
+
+	def __enter__(self):
+		for node in self.nodes:
+			self.__saved.append((node, {k:vars(node)[k] for k in ('stream', 'batches') if k in vars(node)}))
+			node.stream = self.__memoized(node, node.stream)
+			node.batches = functools.partial(AbstractTensor.batches, node) # Which gathers from the stream.
+		return self
+
+	def __exit__(self, *exc_info):
+		for node, attributes in self.__saved:
+			for k in ('stream', 'batches'):
+				if k in attributes: setattr(node, k, attributes[k])
+				else: delattr(node, k)
+		self.__saved.clear()
+
+	def __memoized(self, node:AbstractTensor, stream):
+		buffers = [] # <criterion keys, environment, buffer> triples
+		def memoized(predicate:Predicate, environment:Mapping):
+			criteria = list(predicate)
+			keys = [c.key() for c in criteria]
+			for done, env, buffer in buffers:
+				if env == environment and all(k in keys for k in done):
+					self.served += 1
+					return _filtered(buffer, Predicate(c for c, k in zip(criteria, keys) if k not in done), environment)
+			buffer = runtime.TensorBuffer(_Stream(node, stream), predicate, environment)
+			buffers.append((keys, environment, buffer))
+			self.built += 1
+			return buffer.content()
+		return memoized
+
+
+class _Stream(AbstractTensor):
+	""" Just so a `runtime.TensorBuffer` can consume the node's original stream. """
+	def __init__(self, node:AbstractTensor, stream): self.__node, self.stream = node, stream
+	def tensor_type(self): return self.__node.tensor_type()
+
+def _filtered(buffer, predicate:Predicate, environment:Mapping):
+	if not len(predicate): yield from buffer.content()
+	else:
+		for point, value in buffer.content():
+			if predicate.test(point, environment): yield point, value
@@ -0,0 +1,266 @@
+"""
+Ready-made implementations of AbstractTensor for applications to plug in.
+These are meant to be the better toys from the sandbox, promoted to proper members
+of the toolkit. Applications with oddball data sources will still write their own.
+"""
+
+import bisect
+from typing import Dict, Callable, Iterable, Mapping, Generator, List, Optional, Tuple
+from .domain import AbstractTensor, AbstractRelation, Predicate, Capabilities, TensorStatistics
+from . import semantics, runtime, metrics, parallel
+
+
+class Table(AbstractRelation):
+	"""
+	A relation loaded into memory (once) and held column-wise, with optional indexes.
+
+	The key_space maps each key column (axis) to a function for converting the raw
+	field into a proper member of that axis. Other columns are kept raw: it's up to
+	each `TableTensor` how to interpret them.
+
+	You may ask for a hash index (for equality) or a sorted index (for equality and
+	ranges) on any of the key axes. Each one costs memory proportional to the table.
+	
+	If the rows arrive sorted along some key axes (major to minor) then say so with
+	`sort_order`; it gets checked. The planner can exploit it for merge-joins.
+	
+	The name is just for labelling metrics (see `metrics`).
+	
+	Nothing stops two rows having the same key. Such rows simply add up, as points do,
+	but then a row is no longer the whole story for its key, so fields of a table
+	with repeated keys don't fuse (see `runtime.fuse`). `unique` says whether that's so.
+	"""
+
+	def __init__(self, rows:Iterable[Mapping], key_space:Dict[str, Callable], *, hashed:Iterable[str]=(), ordered:Iterable[str]=(), sort_order:Iterable[str]=(), name:str='table'):
+		self.key_space = dict(key_space)
+		self.name = name
+		self.__columns: Dict[str, list] = {}
+		self.__size = 0
+		for row in rows:
+			if not self.__columns: self.__columns = {k:[] for k in row}
+			for k, column in self.__columns.items():
+				fn = self.key_space.get(k)
+				column.append(row[k] if fn is None else fn(row[k]))
+			self.__size += 1
+		missing = self.key_space.keys() - self.__columns.keys()
+		if self.__size and missing: raise KeyError("Table lacks key columns %r"%sorted(missing))
+		self.__hashed: Dict[str, Dict[object, List[int]]] = {}
+		self.__ordered: Dict[str, Tuple[list, List[int]]] = {}
+		self.__arrays = {}
+		self.__statistics = None
+		for axis in hashed: self.__build_hash(axis)
+		for axis in ordered: self.__build_sort(axis)
+		self.sort_order = tuple(sort_order)
+		keys = list(zip(*(self.column(axis) for axis in self.sort_order)))
+		if any(a > b for a, b in zip(keys, keys[1:])): raise ValueError("Table rows are not sorted by %r"%(self.sort_order,))
+		self.unique = len(set(zip(*(self.column(axis) for axis in self.key_space)))) == self.__size
+
+	def __len__(self): return self.__size
+
+	def __build_hash(self, axis:str):
+		assert axis in self.key_space, axis
+		index = {}
+		for i, member in enumerate(self.column(axis)): index.setdefault(member, []).append(i)
+		self.__hashed[axis] = index
+
+	def __build_sort(self, axis:str):
+		assert axis in self.key_space, axis
+		column = self.column(axis)
+		rowids = sorted(range(self.__size), key=column.__getitem__)
+		self.__ordered[axis] = [column[i] for i in rowids], rowids
+
+	def column(self, name:str) -> list:
+		return self.__columns[name] if self.__size else []
+
+	def array(self, name:str):
+		""" The same column as a NumPy array, built on first request. Requires NumPy. """
+		try: return self.__arrays[name]
+		except KeyError:
+			import numpy
+			a = self.__arrays[name] = numpy.asarray(self.column(name))
+			return a
+
+	def statistics(self) -> TensorStatistics:
+		""" Statistics about the key columns, worked out when first requested. """
+		if self.__statistics is None:
+			from . import statistics
+			self.__statistics = statistics.describe_columns(self.__size, {axis:self.column(axis) for axis in self.key_space})
+		return self.__statistics
+	
+	def indexed_axes(self) -> frozenset:
+		return frozenset(self.__hashed) | frozenset(self.__ordered)
+	
+	def capabilities(self) -> Capabilities:
+		indexed = {axis: frozenset(['EQ', 'IN', 'HASH']) for axis in self.__hashed}
+		for axis in self.__ordered: indexed[axis] = frozenset(['EQ', 'IN', 'HASH', 'LT', 'LE', 'GT', 'GE', 'RANGE'])
+		return Capabilities(indexed, self.sort_order, self.__size)
+
+	def select(self, predicate:Predicate, environment:Mapping) -> Tuple[Optional[List[int]], Predicate]:
+		"""
+		Use the indexes to answer as much of the predicate as they can.
+		Returns the selected row numbers (in table order, or None meaning "all of them")
+		and the residual predicate which must still be tested on each selected row.
+
+		This is what `Predicate.divmod` is for: For each indexed axis, the quotient
+		is the part an index might serve; whatever it can't serve goes in the residual
+		along with the modulus.
+		"""
+		selected = None
+		residual = []
+		for axis in self.indexed_axes():
+			quotient, predicate = predicate.divmod(frozenset([axis]))
+			for criterion in quotient:
+				rows = self.__probe(axis, criterion, environment)
+				if rows is None: residual.append(criterion)
+				else: selected = rows if selected is None else selected & rows
+		residual.extend(predicate)
+		if selected is not None: selected = sorted(selected)
+		return selected, Predicate(residual)
+
+	def lookup(self, point:Mapping) -> List[int]:
+		""" Row numbers with exactly the given key, found by way of the most selective index. """
+		candidates = None
+		for axis, index in self.__hashed.items():
+			rows = index.get(point[axis], ())
+			if candidates is None or len(rows) < len(candidates): candidates = rows
+		for axis, (members, rowids) in self.__ordered.items():
+			if candidates is not None and len(candidates) <= 1: break
+			member = point[axis]
+			rows = rowids[bisect.bisect_left(members, member):bisect.bisect_right(members, member)]
+			if candidates is None or len(rows) < len(candidates): candidates = rows
+		if candidates is None: candidates = range(self.__size)
+		columns = [(self.column(axis), point[axis]) for axis in self.key_space]
+		return [i for i in candidates if all(column[i] == member for column, member in columns)]
+
+	def batches(self, predicate:Predicate, environment:Mapping, size:int=4096) -> Generator:
+		""" Yield <batch, row-numbers> pairs, with the key columns and row numbers as NumPy arrays. """
+		import numpy
+		selected, residual = self.select(predicate, environment)
+		if selected is None: selected = numpy.arange(self.__size)
+		else: selected = numpy.asarray(selected, dtype=numpy.intp)
+		metrics.count('mistake_scan_rows_total', len(selected), table=self.name)
+		for start in range(0, len(selected), size):
+			rows = selected[start:start+size]
+			batch = {axis:self.array(axis)[rows] for axis in self.key_space}
+			mask = residual.mask(batch, environment)
+			yield {axis:column[mask] for axis, column in batch.items()}, rows[mask]
+
+	def scan(self, predicate:Predicate, environment:Mapping) -> Generator:
+		""" Yield <point, row-number> pairs. """
+		selected, residual = self.select(predicate, environment)
+		if selected is None: selected = range(self.__size)
+		metrics.count('mistake_scan_rows_total', len(selected), table=self.name)
+		columns = [(axis, self.column(axis)) for axis in self.key_space]
+		for i in selected:
+			point = {axis:column[i] for axis, column in columns}
+			if residual.test(point, environment): yield point, i
+
+	def __probe(self, axis:str, criterion, environment:Mapping) -> Optional[set]:
+		""" The set of row numbers satisfying the criterion, or None if no index applies. """
+		if isinstance(criterion, runtime.Membership) and criterion.relop == 'IN':
+			return self.__probe_members(axis, criterion.members(environment))
+		if isinstance(criterion, runtime.Interval) and criterion.relop == 'RANGE':
+			if axis not in self.__ordered: return None
+			members, rowids = self.__ordered[axis]
+			lo, hi = criterion.bounds(environment)
+			start = (bisect.bisect_left if criterion.lo_closed else bisect.bisect_right)(members, lo)
+			stop = (bisect.bisect_right if criterion.hi_closed else bisect.bisect_left)(members, hi)
+			return set(rowids[start:stop])
+		if isinstance(criterion, parallel.HashPartition) and criterion.relop == 'HASH':
+			return self.__probe_hash(axis, criterion)
+		if not isinstance(criterion, runtime.ScalarComparison): return None
+		relop, scalar = criterion.relop, criterion.scalar.value(environment)
+		if isinstance(scalar, runtime.Sweep):
+			if relop != 'EQ': return None
+			return self.__probe_members(axis, scalar)
+		if relop == 'EQ' and axis in self.__hashed:
+			return set(self.__hashed[axis].get(scalar, ()))
+		if axis in self.__ordered:
+			members, rowids = self.__ordered[axis]
+			if relop == 'EQ': lo, hi = bisect.bisect_left(members, scalar), bisect.bisect_right(members, scalar)
+			elif relop == 'LT': lo, hi = 0, bisect.bisect_left(members, scalar)
+			elif relop == 'LE': lo, hi = 0, bisect.bisect_right(members, scalar)
+			elif relop == 'GT': lo, hi = bisect.bisect_right(members, scalar), len(members)
+			elif relop == 'GE': lo, hi = bisect.bisect_left(members, scalar), len(members)
+			else: return None
+			return set(rowids[lo:hi])
+		return None
+	
+	def __probe_hash(self, axis:str, partition) -> Optional[set]:
+		""" Rows in one hash partition (see `parallel`), hashing each distinct member once. """
+		rows = set()
+		if axis in self.__hashed:
+			for m, rowids in self.__hashed[axis].items():
+				if partition.admits(m): rows.update(rowids)
+		elif axis in self.__ordered:
+			members, rowids = self.__ordered[axis]
+			i = 0
+			while i < len(members):
+				j = bisect.bisect_right(members, members[i], i)
+				if partition.admits(members[i]): rows.update(rowids[i:j])
+				i = j
+		else: return None
+		return rows
+	
+	def __probe_members(self, axis:str, wanted:Iterable) -> Optional[set]:
+		""" Rows with any of the wanted members: one hash probe, or else one bisection, per member. """
+		rows = set()
+		if axis in self.__hashed:
+			index = self.__hashed[axis]
+			for m in wanted: rows.update(index.get(m, ()))
+		elif axis in self.__ordered:
+			members, rowids = self.__ordered[axis]
+			for m in wanted: rows.update(rowids[bisect.bisect_left(members, m):bisect.bisect_right(members, m)])
+		else: return None
+		return rows
+
+
+class TableTensor(AbstractTensor):
+	"""
+	One (numeric) field of a `Table`, viewed as a tensor over the table's key space.
+	Several of these may share the same table, and thus the same data and indexes.
+	"""
+
+	def __init__(self, table:Table, field:str, unit:semantics.UnitOfMeasure, convert:Callable=float):
+		assert isinstance(unit, semantics.UnitOfMeasure), type(unit)
+		self.table = table
+		self.field = field
+		self.__values = [convert(x) for x in table.column(field)]
+		self.__array = None # NumPy version of the values, made on first use by `extract_column`.
+		self.__axes = tuple(table.key_space)
+		self.__tensor_type = semantics.TensorType(self.__axes, unit)
+
+	def tensor_type(self) -> semantics.TensorType:
+		return self.__tensor_type
+	
+	def capabilities(self) -> Capabilities:
+		return self.table.capabilities()
+	
+	def statistics(self) -> TensorStatistics:
+		return self.table.statistics()
+
+	def get(self, point:Mapping):
+		""" Point lookup by way of the table's indexes. Without indexes, this will be slow. """
+		values = self.__values
+		return sum(values[i] for i in self.table.lookup(point))
+
+	def relation(self) -> Optional[Table]:
+		# Fusing works row by row, which is only right if each key has at most one row.
+		return self.table if self.table.unique else None
+	
+	def extract(self, row:int):
+		return self.__values[row]
+
+	def stream(self, predicate: Predicate, environment:Mapping) -> Generator:
+		values = self.__values
+		for point, i in self.table.scan(predicate, environment): yield point, values[i]
+
+	def extract_column(self, rows):
+		if self.__array is None:
+			import numpy
+			self.__array = numpy.asarray(self.__values, dtype=float)
+		return self.__array[rows]
+	
+	def batches(self, predicate:Predicate, environment:Mapping, size:int=4096) -> Generator:
+		for batch, rows in self.table.batches(predicate, environment, size):
+			yield batch, self.extract_column(rows)
@@ -0,0 +1,173 @@
+"""
+Spilling to disk, for buffers too big for memory. A `runtime.TensorBuffer` with a budget
+turns to this when it finds itself holding more entries than the budget allows.
+
+The entries get hash-partitioned into runs on disk: files of pickled chunks of <key, value>
+pairs. Once the input is exhausted, each partition is read back and summed, which is
+the same thing the in-memory buffer would have done. A partition that still holds more
+distinct keys than the budget gets partitioned again, on the next bits of the hash, and so on.
+The result is a little tree of files, each small enough to load whole. Looking up a key
+means following the hashes down to the right file; reading everything means visiting
+each file in turn. Memory use stays within the budget (give or take a chunk) throughout.
+
+Random lookups one at a time would mean loading a different file for almost every
+lookup, so `probe` does a whole stream's worth of lookups at once, partition by partition
+(spilling the stream the same way, a level at a time, to keep open files few),
+which is how the build side of a join works when it doesn't fit. (The grace hash join.)
+
+Files live in a private temporary directory, which goes away with the `Spill` object.
+"""
+
+import os, pickle, shutil, tempfile, weakref
+from typing import Any, Callable, Dict, Generator, Iterator, List, Optional, Union
+
+BITS = 4 # Bits of the hash per level,
+FANOUT = 1 << BITS # so this many partitions per level.
+DEPTH = 16 # Levels, before the 64-bit hash runs out. Beyond that, a partition stays as big as it is.
+CHUNK = 4096 # Pairs per pickle.
+MASK = (1 << 64) - 1
+
+Node = Union[None, str, List] # A file of summed entries, or a list of FANOUT more nodes. None is empty.
+
+
+def _mixed(key) -> int:
+	"""
+	The built-in hash, thoroughly scrambled (by the splitmix64 finalizer). Each level of
+	partitioning takes its own four bits of this. Small integers hash to themselves,
+	so without the scrambling, neighbouring levels would split keys along the same lines.
+	"""
+	h = hash(key) & MASK
+	h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & MASK
+	h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & MASK
+	return h ^ (h >> 31)
+
+def _bucket(key, depth:int) -> int:
+	return (_mixed(key) >> (BITS * depth)) & (FANOUT - 1)
+
+def _read(path:str) -> Generator:
+	""" Yield the pairs in a run file, in the order written. """
+	with open(path, 'rb') as ifh:
+		while True:
+			try: chunk = pickle.load(ifh)
+			except EOFError: return
+			yield from chunk
+
+def _write(ofh, pairs:list):
+	for start in range(0, len(pairs), CHUNK): pickle.dump(pairs[start:start+CHUNK], ofh, pickle.HIGHEST_PROTOCOL)
+
+
+class Spill:
+	"""
+	A summed table of <key, value> entries, kept on disk in partitions of at most `budget` entries.
+	Start it with the entries accumulated so far, plus an iterator of <key, value> pairs yet to come.
+	"""
+
+	def __init__(self, table:Dict[Any, Any], pairs:Iterator, budget:int):
+		self.budget = budget
+		self.directory = tempfile.mkdtemp(prefix='mistake-spill-')
+		self.__cleanup = weakref.finalize(self, shutil.rmtree, self.directory, True)
+		self.__serial = 0
+		self.__loaded = None, {}
+		self.size = 0 # The number of distinct keys.
+		self.root = self.__partition(table, pairs, 0)
+
+	def __path(self) -> str:
+		self.__serial += 1
+		return os.path.join(self.directory, '%d.run'%self.__serial)
+
+	def __partition(self, table:dict, pairs:Iterator, depth:int) -> List[Node]:
+		paths = [self.__path() for _ in range(FANOUT)]
+		files = [open(path, 'wb') for path in paths]
+		try:
+			def flush():
+				buckets = [[] for _ in range(FANOUT)]
+				for key, value in table.items(): buckets[_bucket(key, depth)].append((key, value))
+				for ofh, bucket in zip(files, buckets): _write(ofh, bucket)
+				table.clear()
+			flush()
+			for key, value in pairs:
+				table[key] = table.get(key, 0) + value
+				if len(table) > self.budget: flush()
+			flush()
+		finally:
+			for ofh in files: ofh.close()
+		return [self.__merge(path, depth + 1) for path in paths]
+
+	def __merge(self, path:str, depth:int) -> Node:
+		""" Sum the runs in the file. Re-partition if they won't fit. """
+		pairs, table = _read(path), {}
+		for key, value in pairs:
+			table[key] = table.get(key, 0) + value
+			if len(table) > self.budget and depth < DEPTH:
+				node = self.__partition(table, pairs, depth)
+				os.unlink(path)
+				return node
+		os.unlink(path)
+		if not table: return None
+		path = self.__path()
+		with open(path, 'wb') as ofh: _write(ofh, list(table.items()))
+		self.size += len(table)
+		return path
+
+	def __leaf(self, key) -> Optional[str]:
+		node, depth = self.root, 0
+		while isinstance(node, list):
+			node = node[_bucket(key, depth)]
+			depth += 1
+		return node
+
+	def leaves(self) -> Generator:
+		stack = [self.root]
+		while stack:
+			node = stack.pop()
+			if isinstance(node, list): stack.extend(reversed(node))
+			elif node is not None: yield node
+
+	def __load(self, path:str) -> dict:
+		if self.__loaded[0] != path: self.__loaded = path, dict(_read(path))
+		return self.__loaded[1]
+
+	def get(self, key, default=0):
+		path = self.__leaf(key)
+		return default if path is None else self.__load(path).get(key, default)
+
+	def items(self) -> Generator:
+		for path in self.leaves(): yield from _read(path)
+
+	def probe(self, pairs:Iterator, key_of:Callable) -> Generator:
+		"""
+		For each <point, value> pair, yield <point, value, entry>, where the entry is this table's
+		value at `key_of(point)` (or zero). The pairs get sorted out on disk, level by level,
+		the same way the entries were, so each partition gets loaded just once. They come out
+		grouped by partition, too. At most FANOUT files are open for writing at a time.
+		"""
+		yield from self.__probe(self.root, 0, pairs, key_of)
+	
+	def __probe(self, node:Node, depth:int, pairs:Iterator, key_of:Callable) -> Generator:
+		if node is None:
+			for point, value in pairs: yield point, value, 0
+		elif not isinstance(node, list):
+			table = self.__load(node)
+			for point, value in pairs: yield point, value, table.get(key_of(point), 0)
+		else:
+			paths = [self.__path() for _ in range(FANOUT)]
+			files = [open(path, 'wb') for path in paths]
+			try:
+				buckets = [[] for _ in range(FANOUT)]
+				held = 0
+				for point, value in pairs:
+					buckets[_bucket(key_of(point), depth)].append((point, value))
+					held += 1
+					if held > self.budget:
+						for ofh, bucket in zip(files, buckets): _write(ofh, bucket); bucket.clear()
+						held = 0
+				for ofh, bucket in zip(files, buckets): _write(ofh, bucket)
+			finally:
+				for ofh in files: ofh.close()
+			for child, path in zip(node, paths):
+				yield from self.__probe(child, depth + 1, _read(path), key_of)
+				os.unlink(path)
+	
+	def close(self):
+		""" Delete the files now, rather than whenever this object gets collected. """
+		self.__cleanup()
@@ -0,0 +1,119 @@
+"""
+Data about data: Row counts, distinct counts, extremes, and equi-depth histograms.
+
+The planner uses these (by way of `AbstractTensor.statistics`) to estimate how many
+points each part of a plan will produce. That informs the choice of join strategy,
+which criteria are worth pushing down to an index, and (optionally) where to draw
+the boundaries between partitions for parallel execution.
+
+Sources may describe themselves on demand, as `sources.Table` does. For anything
+else, collect statistics into a `Catalog` with one scan per tensor, save the catalog
+in a file next to your module's script, and load it again next time. Give the catalog
+to your `MistakeModule` (as `statistics`) before loading the script, because the planner
+consults it while planning.
+"""
+
+import bisect, os, pickle, tempfile
+from typing import Dict, Iterable, Mapping, Optional, Tuple, FrozenSet
+from .domain import AbstractTensor, AxisStatistics, TensorStatistics, Transform, Predicate, Space
+
+BUCKETS = 16 # Resolution of the histograms.
+FORMAT = 1 # Bump this whenever the pickled form of a catalog changes.
+
+
+def summarize(tally:Mapping[object, int]) -> AxisStatistics:
+	""" Statistics for one axis, given the number of rows for each distinct member. """
+	if not tally: return AxisStatistics(0)
+	try: members = sorted(tally)
+	except TypeError: return AxisStatistics(len(tally))
+	cumulative, running = [], 0
+	for m in members:
+		running += tally[m]
+		cumulative.append(running)
+	boundaries = [members[0]] + [
+		members[bisect.bisect_left(cumulative, i * running / BUCKETS)]
+		for i in range(1, BUCKETS + 1)
+	]
+	return AxisStatistics(len(members), members[0], members[-1], tuple(boundaries))
+
+def describe(stream:Iterable, space:Iterable[str]) -> TensorStatistics:
+	""" Statistics from a stream of <point, value> pairs, in one pass. """
+	tallies = {axis:{} for axis in space}
+	rows = 0
+	for point, value in stream:
+		rows += 1
+		for axis, tally in tallies.items():
+			member = point[axis]
+			tally[member] = tally.get(member, 0) + 1
+	return TensorStatistics(rows, {axis:summarize(tally) for axis, tally in tallies.items()})
+
+def describe_columns(rows:int, columns:Mapping[str, list]) -> TensorStatistics:
+	""" Same thing, for data already held column-wise. """
+	def tally(column):
+		result = {}
+		for member in column: result[member] = result.get(member, 0) + 1
+		return result
+	return TensorStatistics(rows, {axis:summarize(tally(column)) for axis, column in columns.items()})
+
+
+class Catalog:
+	"""
+	Statistics for named tensors, and for the ranges of transforms, keyed as `MistakeModule` keys them.
+	Collection is on demand; see `collect`. Statistics don't update themselves as data changes,
+	so collect again (and save again) whenever the data changes much.
+	"""
+
+	def __init__(self):
+		self.__tensors: Dict[str, TensorStatistics] = {}
+		self.__transforms: Dict[Tuple[FrozenSet, FrozenSet], Dict[str, AxisStatistics]] = {}
+
+	def get(self, name:str) -> Optional[TensorStatistics]:
+		return self.__tensors.get(name)
+
+	def transform(self, domain_:Space, range_:Space) -> Optional[Dict[str, AxisStatistics]]:
+		return self.__transforms.get((frozenset(domain_), frozenset(range_)))
+
+	def names(self): return sorted(self.__tensors)
+
+	def record(self, name:str, statistics:TensorStatistics):
+		self.__tensors[name] = statistics
+
+	def collect(self, name:str, tensor:AbstractTensor) -> TensorStatistics:
+		""" Scan the whole tensor once and record what's in it. """
+		statistics = tensor.statistics()
+		if statistics is None:
+			statistics = describe(tensor.stream(Predicate([]), {}), tensor.tensor_type().space)
+		self.record(name, statistics)
+		return statistics
+
+	def collect_transform(self, transform:Transform):
+		"""
+		For an attribute backed by a lookup-table, record statistics about the range as
+		seen across the domain. (A plain function has no table to survey, so it's skipped.)
+		"""
+		if transform.table is None: return
+		(range_,) = transform.range
+		tally = {}
+		for member in transform.table.values(): tally[member] = tally.get(member, 0) + 1
+		self.__transforms[(transform.domain, transform.range)] = {range_: summarize(tally)}
+
+	def save(self, path):
+		""" Write the catalog atomically: Readers see either the old file or the new one, never half. """
+		directory = os.path.dirname(os.path.abspath(path))
+		fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as ofh: pickle.dump((FORMAT, self.__tensors, self.__transforms), ofh)
+			os.replace(temporary, path)
+		except BaseException:
+			os.unlink(temporary)
+			raise
+
+	@classmethod
+	def load(cls, path) -> "Catalog":
+		""" Read a saved catalog. A missing, stale, or damaged file gives an empty catalog. """
+		self = cls()
+		try:
+			with open(path, 'rb') as ifh: version, tensors, transforms = pickle.load(ifh)
+		except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError): return self
+		if version == FORMAT: self.__tensors, self.__transforms = tensors, transforms
+		return self
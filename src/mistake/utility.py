@@ -1,50 +1,89 @@
-import pathlib, tempfile, pickle, os
+import pathlib, tempfile, pickle, os, hashlib, json
 from typing import Callable
 
-def pickle_cache(source_path, cache_path, method:Callable):
+PREBUILT = '.automaton' # Suffix of the prebuilt tables shipped next to a grammar.
+
+def pickle_cache(source_path, cache_dir, method:Callable, version:str=''):
 	"""
 	Generically, suppose some input-file changes only rarely but you apply a complex
-	computation to that file to produce a working data structure. You'd like to check
-	a couple timestamps rather than rebuild a complete parsing automaton every time,
-	for example.
-	
+	computation to that file to produce a working data structure. You'd like to compute
+	it once and then reuse the result, for example rather than rebuild a complete parsing
+	automaton every time.
+
+	The cache file's name carries a hash of the input's content and of the version
+	string, so a changed input (or a different version of whatever does the computing)
+	simply misses, and different versions can share a directory without trouble.
+	The file is written atomically: many processes may race to fill the same cache,
+	but none ever reads a partial file. If the directory isn't writable, no matter.
+
 	:param source_path: The path to the input file
-	:param cache_path: The path to the cache pickle.
+	:param cache_dir: Where to keep cache pickles.
 	:param method: (computationally-intensive) function from source-path to result.
-	:return: whatever method(source_path) does, but only recomputed when source_path changes.
+	:param version: Something which changes whenever the method's results might.
+	:return: whatever method(source_path) does, but only recomputed when something changes.
 	"""
-	
-	def rebuild():
-		result = method(source_path)
-		with open(cache_path, 'wb') as ofh:
-			pickle.dump((src_stat.st_mtime, src_stat.st_size, result), ofh)
-		return result
-	
-	src_stat = os.stat(source_path)
-	try: cache_stat = os.stat(cache_path)
-	except FileNotFoundError: return rebuild()
-	if src_stat.st_mtime > cache_stat.st_mtime: return rebuild()
+	source_path = pathlib.Path(source_path)
+	digest = hashlib.sha256(source_path.read_bytes() + version.encode('utf-8')).hexdigest()[:32]
+	cache_path = pathlib.Path(cache_dir)/('%s-%s.pickle'%(source_path.name, digest))
 	try:
-		with open(cache_path, 'rb') as ifh:
-			saved_mtime, saved_size, saved_result = pickle.load(ifh)
-	except: return rebuild()
-	if (saved_mtime, saved_size) == (src_stat.st_mtime, src_stat.st_size): return saved_result
-	else: return rebuild()
+		with open(cache_path, 'rb') as ifh: return pickle.load(ifh)
+	except (OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError): pass
+	result = method(source_path)
+	try: atomic_write(cache_path, pickle.dumps(result))
+	except OSError: pass
+	return result
+
+
+def atomic_write(path, data:bytes, mode:int=0o644):
+	""" Readers see either the old file or the new one, never half. """
+	fd, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+	try:
+		with os.fdopen(fd, 'wb') as ofh: ofh.write(data)
+		os.chmod(temporary, mode) # mkstemp makes the file private to its owner.
+		os.replace(temporary, path)
+	except BaseException:
+		os.unlink(temporary)
+		raise
 
 
 def tables(basis, doc) -> dict:
 	"""
 	Perhaps this routine belies a deficiency in the stack, but the object is to be able to
 	compile the grammar only once (or whenever it changes) and use it over and over.
-	In a fully-packaged solution a pre-pickled table may seem desirable, but for now
-	this adaptive approach is better for hacking on.
+
+	The package ships prebuilt tables (see `prebuild`) which get used so long as they
+	were built from the grammar as it stands. If you're hacking on the grammar, they
+	won't be, so the tables get compiled and cached in the temp directory instead.
 	"""
-	def method(source_path):
-		from boozetools.macroparse import compiler
-		return compiler.compile_file(source_path, method='LR1')
-	
-	return pickle_cache(
-		pathlib.Path(basis).parent/doc,
-		pathlib.Path(tempfile.gettempdir())/(doc+'.pickle'),
-		method,
-	)
+	source_path = pathlib.Path(basis).parent/doc
+	try:
+		with open(str(source_path)+PREBUILT) as ifh: prebuilt = json.load(ifh)
+		if prebuilt['digest'] == _digest(source_path): return prebuilt['tables']
+	except (OSError, ValueError, KeyError, TypeError): pass
+	return pickle_cache(source_path, tempfile.gettempdir(), _compile, 'booze-tools '+_boozetools_version())
+
+
+def prebuild(basis, doc):
+	""" Compile the grammar and write the tables that get shipped with the package. """
+	source_path = pathlib.Path(basis).parent/doc
+	prebuilt = {'digest': _digest(source_path), 'tables': _compile(source_path)}
+	atomic_write(str(source_path)+PREBUILT, json.dumps(prebuilt, separators=(',', ':')).encode('utf-8'))
+
+
+def _compile(source_path) -> dict:
+	from boozetools.macroparse import compiler
+	return compiler.compile_file(str(source_path), method='LR1')
+
+def _digest(source_path) -> str:
+	return hashlib.sha256(pathlib.Path(source_path).read_bytes()).hexdigest()
+
+def _boozetools_version() -> str:
+	try:
+		from importlib import metadata # New in Python 3.8
+		return metadata.version('booze-tools')
+	except ImportError: return 'unknown' # PackageNotFoundError is a kind of ImportError.
+
+
+if __name__ == '__main__':
+	# After changing the grammar, run `python -m mistake.utility` to refresh the prebuilt tables.
+	prebuild(__file__, 'mistake_grammar.md')